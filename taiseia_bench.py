@@ -0,0 +1,295 @@
+# taiseia_bench.py
+# HNA 伺服器負載與延遲量測工具
+#
+# 在同一個程序內啟動 TCP 服務 (或連到指定的伺服器)，開啟 N 條模擬 HC 連線，
+# 每條連線先完成網路重建，再依設定的比例與速率執行 03/02、04/01、04/02、04/03、05/01 流程，
+# 最後輸出吞吐量、各功能碼的 p50/p99/p999 延遲與連線建立時間 (可輸出 JSON 以便跨版本比較)。
+# --reconnect-storm 在負載階段後讓所有連線同時斷線重連，量測重新連線 (快速恢復或完整重建) 的時間。
+#
+#   python taiseia_bench.py -c 200 -d 10 --rate 20 --json result.json
+#   python taiseia_bench.py -c 2000 -d 0 --reconnect-storm [--no-resume]
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+
+from taiseia_common import *
+from taiseia_client import TaiseiaClient
+import taiseia_server
+
+# 功能碼名稱 -> (F, SF, 請求資料)
+FLOWS = {
+    '03/02': (0x03, 0x02, b''),               # 讀取 HNA 支援能力
+    '04/01': (0x04, 0x01, b''),               # 讀取 SA 狀態 (預設的模擬屬性)
+    '04/02': (0x04, 0x02, None),              # 設定 SA 狀態 (每次寫入不同的數值)
+    '04/03': (0x04, 0x03, None),              # 讀取該連線上次讀取之後的 SA 狀態變更
+    '05/01': (0x05, 0x01, b'\x01\x00\x01'),   # SA 管理/轉傳 (等到 05/04 報告才算完成)
+}
+DEFAULT_MIX = '03/02:1,04/01:4,04/02:2,05/01:1'
+
+
+def parse_mix(text: str) -> dict:
+    """解析 '04/01:4,04/02:2' 形式的流程比例"""
+    mix = {}
+    for item in text.split(','):
+        name, _, weight = item.strip().partition(':')
+        if name not in FLOWS:
+            raise ValueError(f"unknown flow {name!r}, expected one of {', '.join(FLOWS)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def summarize(samples: list) -> dict:
+    """延遲樣本 (秒) 的統計，輸出單位為毫秒"""
+    if not samples:
+        return {"count": 0}
+    samples = sorted(samples)
+    n = len(samples)
+
+    def pct(p):
+        return round(samples[min(n - 1, int(p * n))] * 1000, 3)
+
+    return {
+        "count": n,
+        "mean_ms": round(sum(samples) / n * 1000, 3),
+        "p50_ms": pct(0.50),
+        "p99_ms": pct(0.99),
+        "p999_ms": pct(0.999),
+        "max_ms": round(samples[-1] * 1000, 3),
+    }
+
+
+class BenchConnection:
+    """一條模擬 HC 連線：建立連線 (含網路重建) 後依比例送出請求並記錄延遲"""
+
+    def __init__(self, host, port, mix, rate, timeout, latencies, errors, subscribe=False, resume=True, index=0):
+        # 每條連線使用不同的 HC ID，HNA 的身分快取才能分辨
+        local_id = SENDER_ID[:2] + index.to_bytes(4, 'big')
+        self.client = TaiseiaClient(host, port, local_id, request_timeout=timeout, resume=resume)
+        self.subscribe = subscribe
+        self.notifications = 0
+        self.names = list(mix)
+        self.weights = [mix[name] for name in self.names]
+        self.rate = rate
+        self.latencies = latencies
+        self.errors = errors
+        self.setup_time = None
+        self.sa_version = (0, 0) # 上次 04/03 回應的 (epoch, 版本)
+        self._relay_done = None
+        self.client.on(0x05, 0x04, self._on_report)
+        self.client.on(0x05, 0x05, self._on_notify)
+
+    def _on_report(self, frame):
+        if self._relay_done is not None and not self._relay_done.done():
+            self._relay_done.set_result(None)
+
+    def _on_notify(self, frame):
+        self.notifications += 1
+
+    async def connect(self) -> None:
+        start = time.perf_counter()
+        await self.client.connect()
+        self.setup_time = time.perf_counter() - start
+        if self.subscribe:
+            await self.client.request(0x04, 0x00) # 訂閱 SA 狀態變更通知
+
+    async def _run_flow(self, name: str) -> None:
+        func_id, sub_func_id, data = FLOWS[name]
+        if name == '04/02':
+            # 數值沒有改變的寫入不會觸發狀態變更通知
+            await self.client.request(func_id, sub_func_id, encode_sa_records([(1, 1, random.randrange(0x10000))]))
+        elif name == '04/03':
+            response = await self.client.request(func_id, sub_func_id, encode_sa_delta_request(*self.sa_version))
+            self.sa_version = parse_sa_delta(response.data)[:2]
+        elif func_id == 0x05:
+            self._relay_done = asyncio.get_running_loop().create_future()
+            await self.client.request(func_id, sub_func_id, data)
+            await asyncio.wait_for(self._relay_done, self.client.request_timeout)
+        else:
+            await self.client.request(func_id, sub_func_id, data)
+
+    async def run(self, deadline: float) -> None:
+        interval = 1.0 / self.rate if self.rate > 0 else 0.0
+        # 各連線的起始時間錯開，避免所有請求同時送出
+        next_send = time.perf_counter() + random.random() * interval
+        while True:
+            now = time.perf_counter()
+            if now >= deadline:
+                return
+            if interval:
+                if next_send > now:
+                    await asyncio.sleep(next_send - now)
+                next_send += interval
+            name = random.choices(self.names, self.weights)[0]
+            start = time.perf_counter()
+            try:
+                await self._run_flow(name)
+            except asyncio.TimeoutError:
+                self.errors[name + ' timeout'] = self.errors.get(name + ' timeout', 0) + 1
+                continue
+            except (ConnectionError, OSError):
+                self.errors['connection'] = self.errors.get('connection', 0) + 1
+                return
+            self.latencies[name].append(time.perf_counter() - start)
+
+
+async def run_bench(connections: int, duration: float, rate: float, mix: dict,
+                    host: str = None, port: int = None, timeout: float = 5.0,
+                    connect_concurrency: int = 100, engine: str = 'stream', subscribe: bool = False,
+                    reconnect_storm: bool = False, resume: bool = True) -> dict:
+    """執行一次負載測試並回傳結果 dict；未指定 host/port 時在本程序內以指定引擎啟動伺服器。
+
+    subscribe 為真時每條連線都訂閱狀態變更通知 (04/00)，04/02 會觸發對所有連線的推送。
+    reconnect_storm 為真時負載階段後所有連線同時斷線並重新連線 (resume 決定是否要求快速恢復)。
+    """
+    server = None
+    if host is None:
+        server = await taiseia_server.create_tcp_server('127.0.0.1', 0, engine)
+        host, port = server.sockets[0].getsockname()[:2]
+
+    latencies = {name: [] for name in mix}
+    errors = {}
+    conns = [BenchConnection(host, port, mix, rate, timeout, latencies, errors, subscribe, resume, index)
+             for index in range(connections)]
+    storm = None
+
+    try:
+        # --- 連線建立 (含網路重建流程) ---
+        limit = asyncio.Semaphore(connect_concurrency)
+
+        async def connect(conn):
+            async with limit:
+                try:
+                    await conn.connect()
+                except (asyncio.TimeoutError, ConnectionError, OSError):
+                    errors['connect'] = errors.get('connect', 0) + 1
+
+        setup_start = time.perf_counter()
+        await asyncio.gather(*(connect(conn) for conn in conns))
+        setup_wall = time.perf_counter() - setup_start
+        ready = [conn for conn in conns if conn.setup_time is not None]
+        # 重新連線風暴會覆寫 setup_time，先記下初次連線的統計
+        setup = dict(summarize([conn.setup_time for conn in ready]), wall_s=round(setup_wall, 3))
+
+        # --- 負載階段 ---
+        start = time.perf_counter()
+        await asyncio.gather(*(conn.run(start + duration) for conn in ready))
+        elapsed = time.perf_counter() - start
+
+        # --- 重新連線風暴 (所有連線同時斷線後立即重連) ---
+        if reconnect_storm:
+            await asyncio.gather(*(conn.client.close() for conn in ready), return_exceptions=True)
+            for conn in ready:
+                conn.setup_time = None
+            resumed = taiseia_server.STATS.sessions_resumed
+            storm_start = time.perf_counter()
+            await asyncio.gather(*(connect(conn) for conn in ready))
+            storm_wall = time.perf_counter() - storm_start
+            storm = dict(summarize([conn.setup_time for conn in ready if conn.setup_time is not None]),
+                         wall_s=round(storm_wall, 3))
+    finally:
+        await asyncio.gather(*(conn.client.close() for conn in conns), return_exceptions=True)
+        if server is not None:
+            server.close()
+            await server.wait_closed()
+
+    total = sum(len(samples) for samples in latencies.values())
+    result = {
+        "config": {
+            "connections": connections,
+            "duration_s": duration,
+            "rate_per_connection": rate,
+            "mix": mix,
+            "server": f"in-process ({engine})" if server is not None else f"{host}:{port}",
+        },
+        "connected": len(ready),
+        "elapsed_s": round(elapsed, 3),
+        "completed": total,
+        "throughput_rps": round(total / elapsed, 1) if elapsed else 0.0,
+        "setup": setup,
+        "latency": {name: summarize(samples) for name, samples in latencies.items()},
+        "errors": errors,
+    }
+    if storm is not None:
+        result["reconnect"] = storm
+        if server is not None:
+            result["reconnect"]["resumed"] = taiseia_server.STATS.sessions_resumed - resumed
+    if subscribe:
+        result["notifications_received"] = sum(conn.notifications for conn in ready)
+        if server is not None:
+            result["fanout"] = taiseia_server.HUB.snapshot()
+    return result
+
+
+def print_report(result: dict) -> None:
+    print(f"\n連線數 {result['connected']}/{result['config']['connections']}，"
+          f"{result['elapsed_s']} s 內完成 {result['completed']} 個流程，"
+          f"吞吐量 {result['throughput_rps']} flows/s")
+    rows = [('setup', result['setup'])] + list(result['latency'].items())
+    if 'reconnect' in result:
+        rows.append(('reconnect', result['reconnect']))
+    print(f"{'flow':<10}{'count':>9}{'mean':>10}{'p50':>10}{'p99':>10}{'p999':>10}{'max':>10}  (ms)")
+    for name, stats in rows:
+        if not stats.get('count'):
+            print(f"{name:<10}{0:>9}")
+            continue
+        print(f"{name:<10}{stats['count']:>9}{stats['mean_ms']:>10}{stats['p50_ms']:>10}"
+              f"{stats['p99_ms']:>10}{stats['p999_ms']:>10}{stats['max_ms']:>10}")
+    if 'reconnect' in result:
+        reconnect = result['reconnect']
+        print(f"reconnect storm: all connections back in {reconnect['wall_s']} s"
+              + (f", {reconnect['resumed']} resumed" if 'resumed' in reconnect else ''))
+    if result['errors']:
+        print(f"errors: {result['errors']}")
+    if 'notifications_received' in result:
+        print(f"notifications received: {result['notifications_received']}")
+    fanout = result.get('fanout')
+    if fanout:
+        print(f"fan-out: published {fanout['published']}, direct {fanout['sent_direct']}, "
+              f"batched {fanout['sent_batched']}, coalesced {fanout['coalesced']}, dropped {fanout['dropped']}, "
+              f"max queue depth {fanout['max_queue_depth']}")
+        print(f"fan-out latency {fanout['fanout_latency']}, queued latency {fanout['queued_latency']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="TaiSEIA HNA server load benchmark")
+    parser.add_argument('-c', '--connections', type=int, default=50, help="同時連線的 HC 數量")
+    parser.add_argument('-d', '--duration', type=float, default=10.0, help="負載階段秒數")
+    parser.add_argument('-r', '--rate', type=float, default=10.0,
+                        help="每條連線每秒的流程數 (0 = 不限速，前一個完成即送下一個)")
+    parser.add_argument('-m', '--mix', default=DEFAULT_MIX, help=f"流程比例 (預設 {DEFAULT_MIX})")
+    parser.add_argument('--server', help="連到已啟動的伺服器 host:port，而不是在程序內啟動")
+    parser.add_argument('--engine', choices=taiseia_server.ENGINES, default='stream',
+                        help="程序內伺服器使用的 TCP 引擎")
+    parser.add_argument('--subscribe', action='store_true', help="每條連線都訂閱狀態變更通知 (04/00)")
+    parser.add_argument('--reconnect-storm', action='store_true',
+                        help="負載階段後所有連線同時斷線重連，量測重新連線時間")
+    parser.add_argument('--no-resume', action='store_true', help="重新連線時不要求快速恢復 (走完整網路重建)")
+    parser.add_argument('--timeout', type=float, default=5.0, help="單一請求逾時秒數")
+    parser.add_argument('--json', metavar='PATH', help="把結果寫成 JSON ('-' 為標準輸出)")
+    args = parser.parse_args(argv)
+
+    host = port = None
+    if args.server:
+        host, _, port = args.server.rpartition(':')
+        port = int(port)
+
+    result = asyncio.run(run_bench(args.connections, args.duration, args.rate,
+                                   parse_mix(args.mix), host, port, args.timeout,
+                                   engine=args.engine, subscribe=args.subscribe,
+                                   reconnect_storm=args.reconnect_storm, resume=not args.no_resume))
+
+    if args.json == '-':
+        json.dump(result, sys.stdout, indent=2)
+        print()
+    else:
+        print_report(result)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
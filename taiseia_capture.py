@@ -0,0 +1,431 @@
+# taiseia_capture.py
+# HNA 伺服器的二進位流量錄製、重播與離線驗證
+#
+# 錄製檔為 8 bytes 檔頭 (CAPTURE_MAGIC) 之後接連續的紀錄，每筆紀錄為
+#   CAPTURE_RECORD (時間 d, 連線編號 I, 方向 B (0 = HC -> HNA, 1 = HNA -> HC), 長度 H) + 原始封包
+# 檔案只會附加寫入；伺服器異常結束時最後一筆可能不完整，讀取時會略過。
+#
+#   python taiseia_server.py --capture traffic.cap
+#   python taiseia_capture.py info traffic.cap
+#   python taiseia_capture.py validate traffic.cap
+#   python taiseia_capture.py replay traffic.cap --server 127.0.0.1:50001 --speed 10   # 0 = 不等待
+#
+# 重播時依錄製檔扮演 HC：依原本的時間間隔 (除以 speed) 送出 HC 的封包，並逐一比對
+# 伺服器送出的封包與錄製內容 (忽略事件序號、CRC 與 VOLATILE_REPLY_FIELDS 中每次回覆
+# 都不同的欄位，例如 RTC 時間與狀態表的 epoch)。HC 對 HNA 主動封包的回覆會改寫為
+# 伺服器這次實際使用的事件序號，HNA 的流程才能照常進行。
+# 錄製時走完整網路重建的連線，重播時會移除 01/00 ACK 中的快速恢復 ID 資料，結果不受
+# 伺服器 IdentityCache 內容影響 (例如對錄製的同一個伺服器重播)；錄製時即為快速恢復的
+# 連線則需要伺服器仍快取該 HC 的身分，否則伺服器改走完整重建而回報不符。
+import argparse
+import asyncio
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+
+from taiseia_common import *
+
+CAPTURE_MAGIC = b'TSCAP\x00\x01\n'
+CAPTURE_RECORD = struct.Struct('!dIBH')
+CAPTURE_IN = 0  # HC -> HNA
+CAPTURE_OUT = 1 # HNA -> HC
+
+# 重播比對時忽略的回覆資料欄位：請求的 F << 8 | SF -> 回覆資料中的 (起點, 終點)
+VOLATILE_REPLY_FIELDS = {
+    0x0006: (0, 7), # 讀取 RTC：目前時間
+    0x0403: (0, 4), # 讀取變更：狀態表的 epoch (每個伺服器程序隨機產生)
+}
+
+_LENGTH_FIELD = struct.Struct('!H') # 封包第 1~2 byte 的總長度
+_CRC_SLICE = slice(-CRC_LENGTH, None)
+
+
+class CaptureStream:
+    """單一連線的錄製介面 (與 taiseia_log.FrameTrace 相同的 record(direction, packet))"""
+    __slots__ = ('writer', 'conn_id')
+
+    def __init__(self, writer: 'CaptureWriter', conn_id: int):
+        self.writer = writer
+        self.conn_id = conn_id
+
+    def record(self, direction: str, packet) -> None:
+        """direction: 'in' (收到) 或 'out' (送出)"""
+        self.writer.write(self.conn_id, CAPTURE_OUT if direction == 'out' else CAPTURE_IN, packet)
+
+
+class CaptureWriter:
+    """所有連線共用的錄製檔；附加到既有檔案時連線編號接續檔案中最大的編號"""
+    __slots__ = ('path', 'records', '_file', '_next_id')
+
+    def __init__(self, path: str, buffer_size: int = 64 * 1024):
+        self.path = path
+        self.records = 0
+        self._next_id = 0
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            with open_capture(path) as buf:
+                for _, _, conn_id, _, _ in iter_records(buf):
+                    if conn_id > self._next_id:
+                        self._next_id = conn_id
+        self._file = open(path, 'ab', buffering=buffer_size)
+        if self._file.tell() == 0:
+            self._file.write(CAPTURE_MAGIC)
+
+    def connection(self) -> CaptureStream:
+        self._next_id += 1
+        return CaptureStream(self, self._next_id)
+
+    def write(self, conn_id: int, direction: int, packet) -> None:
+        write = self._file.write
+        write(CAPTURE_RECORD.pack(time.time(), conn_id, direction, len(packet)))
+        write(packet)
+        self.records += 1
+
+    def flush(self) -> None:
+        self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
+
+
+# --- 讀取 ---
+class open_capture:
+    """以 mmap 唯讀開啟錄製檔：with open_capture(path) as buf: ...；buf 為檔頭之後的 memoryview"""
+
+    def __init__(self, path: str):
+        self._file = open(path, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+        self._view = None
+        if size < len(CAPTURE_MAGIC) or self._map[:len(CAPTURE_MAGIC)] != CAPTURE_MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not a TaiSEIA capture file")
+
+    def __enter__(self) -> memoryview:
+        self._view = memoryview(self._map)[len(CAPTURE_MAGIC):]
+        return self._view
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+
+def iter_records(buf):
+    """依序產生 (封包位移, 時間, 連線編號, 方向, 長度)；封包內容為 buf[位移:位移 + 長度]"""
+    unpack_from = CAPTURE_RECORD.unpack_from
+    header = CAPTURE_RECORD.size
+    end = len(buf)
+    pos = 0
+    while pos + header <= end:
+        t, conn_id, direction, length = unpack_from(buf, pos)
+        pos += header
+        if pos + length > end:
+            return # 最後一筆寫到一半
+        yield pos, t, conn_id, direction, length
+        pos += length
+
+
+def load_connections(buf) -> dict:
+    """依連線分組：{連線編號: [(時間, 方向, 封包 memoryview), ...]}"""
+    connections = {}
+    for pos, t, conn_id, direction, length in iter_records(buf):
+        records = connections.get(conn_id)
+        if records is None:
+            records = connections[conn_id] = []
+        records.append((t, direction, buf[pos:pos + length]))
+    return connections
+
+
+def capture_info(path: str) -> dict:
+    with open_capture(path) as buf:
+        records = frames_in = bytes_in = bytes_out = 0
+        first = last = None
+        connections = set()
+        for _, t, conn_id, direction, length in iter_records(buf):
+            records += 1
+            connections.add(conn_id)
+            if direction == CAPTURE_IN:
+                frames_in += 1
+                bytes_in += length
+            else:
+                bytes_out += length
+            if first is None:
+                first = t
+            last = t
+    return {
+        "records": records,
+        "connections": len(connections),
+        "frames_in": frames_in,
+        "frames_out": records - frames_in,
+        "bytes_in": bytes_in,
+        "bytes_out": bytes_out,
+        "duration_s": round(last - first, 6) if records else 0.0,
+    }
+
+
+# --- 離線驗證 ---
+def validate_capture(path: str, max_errors: int = 20) -> dict:
+    """檢查每個封包的分框 (標頭、長度欄位) 與 CRC。
+
+    不建立 Frame 或解析欄位：長度欄位以 unpack_from 直接讀出，分框正確的封包再以
+    crc16_check_frames 一次批次驗證 CRC，都在 mmap 上以 memoryview 切片進行，不複製資料。
+    """
+    length_field = _LENGTH_FIELD.unpack_from
+    header = CAPTURE_RECORD.size
+    bad_crc = bad_framing = records = 0
+    errors = []
+    with open_capture(path) as buf:
+        unpack_from = CAPTURE_RECORD.unpack_from
+        end = len(buf)
+        pos = 0
+        framed = [] # 分框正確、待批次驗證 CRC 的 (紀錄編號, 連線編號, 封包)
+        while pos + header <= end:
+            conn_id, length = unpack_from(buf, pos)[1::2]
+            pos += header
+            if pos + length > end:
+                break
+            records += 1
+            if length < MIN_PACKET_LENGTH or buf[pos] != HEADER_ID or length_field(buf, pos + 1)[0] != length:
+                bad_framing += 1
+                if len(errors) < max_errors:
+                    errors.append({"record": records - 1, "conn": conn_id, "error": 'framing',
+                                   "raw": buf[pos:pos + min(length, 64)].hex()})
+            else:
+                framed.append((records - 1, conn_id, buf[pos:pos + length]))
+            pos += length
+        truncated = end - pos
+        for (record, conn_id, packet), ok in zip(framed, crc16_check_frames([f[2] for f in framed])):
+            if ok:
+                continue
+            bad_crc += 1
+            if len(errors) < max_errors:
+                errors.append({"record": record, "conn": conn_id, "error": 'crc', "raw": packet[:64].hex()})
+        framed = packet = None # 釋放 mmap 前先放掉所有切片
+    errors.sort(key=lambda e: e["record"])
+    return {"records": records, "bad_crc": bad_crc, "bad_framing": bad_framing,
+            "truncated_bytes": truncated, "errors": errors}
+
+
+# --- 重播 ---
+def _event_id(packet) -> int:
+    return EVENT_ID_STRUCT.unpack_from(packet, EVENT_ID_OFFSET)[0]
+
+
+def _with_event_id(packet, event_id: int) -> bytes:
+    """改寫封包的事件序號並重新計算 CRC"""
+    out = bytearray(packet)
+    EVENT_ID_STRUCT.pack_into(out, EVENT_ID_OFFSET, event_id)
+    crc = crc16_ccitt(memoryview(out)[:-CRC_LENGTH])
+    out[-2] = crc >> 8
+    out[-1] = crc & 0xFF
+    return bytes(out)
+
+
+def _without_data(packet) -> bytes:
+    """移除封包的資料欄位 (改寫長度並重新計算 CRC)"""
+    out = bytearray(packet[:FIXED_HEADER_LENGTH + CRC_LENGTH])
+    _LENGTH_FIELD.pack_into(out, 1, len(out))
+    crc = crc16_ccitt(memoryview(out)[:-CRC_LENGTH])
+    out[-2] = crc >> 8
+    out[-1] = crc & 0xFF
+    return bytes(out)
+
+
+def _online_notices(records) -> set:
+    """錄製時走完整網路重建 (HNA 送出 01/01 讀取 ID) 的連線中，HNA 01/00 上線通知的事件序號"""
+    notices = set()
+    rebuilt = False
+    for _, direction, packet in records:
+        if direction == CAPTURE_OUT and packet[EVENT_ID_OFFSET + 2] == 0x01:
+            if packet[EVENT_ID_OFFSET + 3] == 0x00:
+                notices.add(_event_id(packet))
+            elif packet[EVENT_ID_OFFSET + 3] == 0x01:
+                rebuilt = True
+    return notices if rebuilt else set()
+
+
+def same_frame(expected, actual, volatile=None) -> bool:
+    """比較兩個封包，忽略事件序號與 CRC；volatile 為資料中同樣忽略的 (起點, 終點)"""
+    if len(expected) != len(actual) or expected[:EVENT_ID_OFFSET] != actual[:EVENT_ID_OFFSET]:
+        return False
+    end = len(expected) - CRC_LENGTH
+    if volatile is None:
+        return expected[EVENT_ID_OFFSET + 2:end] == actual[EVENT_ID_OFFSET + 2:end]
+    start = min(end, FIXED_HEADER_LENGTH + volatile[0])
+    stop = min(end, FIXED_HEADER_LENGTH + volatile[1])
+    return (expected[EVENT_ID_OFFSET + 2:start] == actual[EVENT_ID_OFFSET + 2:start]
+            and expected[stop:end] == actual[stop:end])
+
+
+def _volatile_fields(records) -> list:
+    """錄製的每個伺服器封包在比對時要忽略的欄位 (依 HC 請求的事件序號找出回覆對應的功能碼)"""
+    codes = {} # HC 請求的事件序號 -> F << 8 | SF
+    fields = []
+    for _, direction, packet in records:
+        if direction == CAPTURE_IN:
+            if not _is_reply(packet):
+                codes[_event_id(packet)] = packet[EVENT_ID_OFFSET + 2] << 8 | packet[EVENT_ID_OFFSET + 3]
+        elif _is_reply(packet):
+            fields.append(VOLATILE_REPLY_FIELDS.get(codes.get(_event_id(packet))))
+        else:
+            fields.append(None)
+    return fields
+
+
+def _is_reply(packet) -> bool:
+    return packet[EVENT_ID_OFFSET + 2] in (0xF0, 0xF1)
+
+
+async def _replay_connection(conn_id: int, records: list, host: str, port: int, origin: float, wall: float,
+                             speed: float, timeout: float, result: dict) -> None:
+    loop = asyncio.get_running_loop()
+
+    async def sleep_until(t):
+        if speed > 0:
+            delay = wall + (t - origin) / speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    expected = [packet for _, direction, packet in records if direction == CAPTURE_OUT]
+    volatile = _volatile_fields(records)
+    notices = _online_notices(records)
+    await sleep_until(records[0][0])
+    try:
+        reader, writer = await asyncio.open_connection(host, port)
+    except OSError as e:
+        result["connect_errors"] += 1
+        result["mismatches"].append({"conn": conn_id, "error": str(e)})
+        return
+
+    live = []
+    arrived = asyncio.Event()
+
+    async def receive():
+        async for frame in read_frames(reader):
+            live.append(bytes(frame))
+            arrived.set()
+
+    async def wait_live(count):
+        """等到伺服器送出 count 個封包；逾時回傳 False"""
+        deadline = loop.time() + timeout
+        while len(live) < count:
+            arrived.clear()
+            remaining = deadline - loop.time()
+            if remaining <= 0 or receiver.done():
+                return False
+            try:
+                await asyncio.wait_for(arrived.wait(), remaining)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    receiver = asyncio.create_task(receive())
+    event_ids = {} # 錄製時 HNA 主動封包的事件序號 -> 這次重播的事件序號
+    mapped = 0
+    outbound = 0
+    stalled = False
+    try:
+        for t, direction, packet in records:
+            if direction == CAPTURE_OUT:
+                outbound += 1
+                continue
+            # 錄製時此封包之前 HNA 已送出 outbound 個封包，等伺服器送到相同數量再送
+            if not stalled and not await wait_live(outbound):
+                stalled = True
+            while mapped < min(len(live), len(expected)):
+                if not _is_reply(expected[mapped]):
+                    event_ids[_event_id(expected[mapped])] = _event_id(live[mapped])
+                mapped += 1
+            await sleep_until(t)
+            if _is_reply(packet):
+                if _event_id(packet) in notices and len(packet) > MIN_PACKET_LENGTH:
+                    packet = _without_data(packet) # 不要求快速恢復，與錄製時相同走完整重建
+                live_id = event_ids.get(_event_id(packet))
+                if live_id is not None and live_id != _event_id(packet):
+                    packet = _with_event_id(packet, live_id)
+            writer.write(packet)
+            result["frames_sent"] += 1
+        await wait_live(len(expected))
+    finally:
+        receiver.cancel()
+        writer.close()
+
+    result["frames_expected"] += len(expected)
+    result["frames_received"] += len(live)
+    for index, want in enumerate(expected):
+        if index >= len(live):
+            result["missing"] += len(expected) - index
+            break
+        if same_frame(want, live[index], volatile[index]):
+            result["matched"] += 1
+            continue
+        result["mismatched"] += 1
+        if len(result["mismatches"]) < result["max_mismatches"]:
+            result["mismatches"].append({"conn": conn_id, "index": index,
+                                         "expected": bytes(want).hex(), "actual": live[index].hex()})
+    result["extra"] += max(0, len(live) - len(expected))
+
+
+async def replay_capture(path: str, host: str, port: int, speed: float = 1.0, timeout: float = 5.0,
+                         max_mismatches: int = 20) -> dict:
+    """重播錄製檔中所有連線 (各自在錄製時的相對時間開始)；speed 為倍速，0 表示不等待"""
+    result = dict(connections=0, frames_sent=0, frames_expected=0, frames_received=0, matched=0,
+                  mismatched=0, missing=0, extra=0, connect_errors=0, mismatches=[],
+                  max_mismatches=max_mismatches)
+    with open_capture(path) as buf:
+        connections = load_connections(buf)
+        result["connections"] = len(connections)
+        if connections:
+            origin = min(records[0][0] for records in connections.values())
+            start = time.perf_counter()
+            wall = asyncio.get_running_loop().time()
+            await asyncio.gather(*(
+                _replay_connection(conn_id, records, host, port, origin, wall, speed, timeout, result)
+                for conn_id, records in connections.items()))
+            result["elapsed_s"] = round(time.perf_counter() - start, 3)
+        connections = None # 釋放 mmap 前先放掉所有切片
+    del result["max_mismatches"]
+    return result
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="TaiSEIA HNA traffic capture tools")
+    commands = parser.add_subparsers(dest='command', required=True)
+    info = commands.add_parser('info', help="錄製檔摘要")
+    info.add_argument('path')
+    validate = commands.add_parser('validate', help="檢查所有封包的分框與 CRC")
+    validate.add_argument('path')
+    replay = commands.add_parser('replay', help="對伺服器重播錄製的 HC 流量並比對回應")
+    replay.add_argument('path')
+    replay.add_argument('--server', default=f"127.0.0.1:{TCP_SERVICE_PORT}", help="host:port")
+    replay.add_argument('--speed', type=float, default=1.0, help="倍速 (1 = 原速，0 = 不等待)")
+    replay.add_argument('--timeout', type=float, default=5.0, help="等待伺服器封包的逾時秒數")
+    args = parser.parse_args(argv)
+
+    if args.command == 'info':
+        print(json.dumps(capture_info(args.path), indent=2))
+        return 0
+    if args.command == 'validate':
+        start = time.perf_counter()
+        result = validate_capture(args.path)
+        result["elapsed_s"] = round(time.perf_counter() - start, 3)
+        print(json.dumps(result, indent=2))
+        return 1 if result["bad_crc"] or result["bad_framing"] else 0
+    host, _, port = args.server.rpartition(':')
+    result = asyncio.run(replay_capture(args.path, host, int(port), args.speed, args.timeout))
+    print(json.dumps(result, indent=2))
+    return 1 if result["mismatched"] or result["missing"] or result["connect_errors"] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
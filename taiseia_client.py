@@ -1,192 +1,309 @@
 # taiseia_client.py
 import asyncio
-import socket
-import json
-import struct
-import time
+import logging
 from taiseia_common import * # 引入共用模組
 
-# 輔助函數：發送 ACK
-def build_ack_packet(sender_id: bytes, receiver_id: bytes, ack_code: int) -> bytes:
-    """建構 F0 認可 (ACK) 封包"""
-    return build_taiseia_packet(
-        sender_id=sender_id,
-        receiver_id=receiver_id,
-        group_id=0xFF,
-        function_id=0xF0, # 認可 (ACK)
-        sub_function_id=ack_code,
-        data=b''
-    )
+log = logging.getLogger('taiseia.client')
+
+SEEN_EVENT_IDS = 64 # 保留最近多少個 HNA 事件序號以辨識重送
+
+
+class DiscoveryClientProtocol(asyncio.DatagramProtocol):
+    """收集 HNA 的服務發現回覆，解析後放進佇列"""
+    def __init__(self, queue: asyncio.Queue):
+        self.queue = queue
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        result = parse_discovery_reply(data)
+        if result is not None:
+            self.queue.put_nowait(result)
 
-def parse_id_data(data: bytes) -> dict:
-    """解析 H'01 / H'01 回應中的 14 bytes ID 數據"""
-    if len(data) < 14:
-        return {"error": "ID Data too short"}
-        
-    return {
-        "User ID": data[0:4].hex(),
-        "HC ID": data[4:6].hex(),
-        "HNA ID": data[6:8].hex(),
-        "CS ID": data[8:14].hex()
-    }
+    def error_received(self, exc):
+        log.warning("[UDP] Error received: %s", exc)
+
+
+async def discover_hnas(search_ip: str = '255.255.255.255', udp_port: int = UDP_DISCOVERY_PORT,
+                        window: float = 2.0, retries: int = 3, backoff: float = 0.25, binary: bool = False):
+    """廣播搜尋封包並在 window 秒內逐一產生 (ip, port)。
+
+    搜尋封包會在 backoff、2*backoff、4*backoff ... 秒後重送 (最多 retries 次)，
+    以彌補 UDP 遺失；同一個 HNA 的重複回覆只產生一次。
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: DiscoveryClientProtocol(queue), local_addr=('0.0.0.0', 0), allow_broadcast=True
+    )
+    search = SEARCH_MAGIC_WORD_BINARY if binary else SEARCH_MAGIC_WORD
+    deadline = loop.time() + window
+    next_send = loop.time()
+    delay = backoff
+    sends = 0
+    seen = set()
+    try:
+        while True:
+            now = loop.time()
+            if now >= deadline:
+                return
+            if sends <= retries and now >= next_send:
+                transport.sendto(search, (search_ip, udp_port))
+                sends += 1
+                next_send = now + delay
+                delay *= 2
+            wait = deadline - now
+            if sends <= retries:
+                wait = min(wait, next_send - now)
+            try:
+                result = await asyncio.wait_for(queue.get(), wait)
+            except asyncio.TimeoutError:
+                continue
+            if result not in seen:
+                seen.add(result)
+                yield result
+    finally:
+        transport.close()
 
 
 async def discovery_server(search_ip='127.0.0.1') -> tuple[str, int]:
-    """步驟 1: 發送 UDP 搜尋並獲取 TCP 服務資訊"""
-    # ... (此處使用 taiseia_common.py 中的 UDP 邏輯，與 client 腳本中相同) ...
+    """步驟 1: 發送 UDP 搜尋並獲取 TCP 服務資訊 (取第一個回覆的 HNA)"""
     print(f"\n--- 步驟 1: 服務發現 (UDP) ---")
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1) 
-    sock.settimeout(2.0)
-    
+    results = discover_hnas(search_ip)
     try:
-        sock.sendto(SEARCH_MAGIC_WORD, (search_ip, UDP_DISCOVERY_PORT)) 
-        data, addr = sock.recvfrom(1024)
-        response = json.loads(data.decode())
-        if response.get('type') == 'discovery':
-            ip, port = response['ip'], response['port']
+        async for ip, port in results:
             print(f"✅ 成功發現伺服器: TCP @ {ip}:{port}")
             return ip, port
-        print("UDP 回覆格式錯誤。")
-    except socket.timeout:
         print("❌ 錯誤：未收到伺服器回覆 (Timeout)。")
-    except Exception as e:
+    except OSError as e:
         print(f"❌ UDP 錯誤: {e}")
     finally:
-        sock.close()
+        await results.aclose()
     return None, None
 
 
+# ----------------------------------------------------
+# 可重複使用的 HC 客戶端 (單一連線、多個請求同時進行)
+# ----------------------------------------------------
+class TaiseiaClient:
+    """HC 端的 TaiSEIA 101 連線。
+
+    保持一條 TCP 連線，由背景讀取工作依事件序號把 F0/F1 回應配對到
+    對應請求的 Future，因此可同時送出多個請求。HNA 主動發送的封包
+    (01/00、01/01、05/04、05/05) 會自動回覆，並轉交給 on() 登錄的回呼。
+    指定 trace (taiseia_log.FrameTrace) 時記錄此連線收發的每個封包。
+    resume 為真時在 01/00 的 ACK 中附上 ID 資料，要求 HNA 以快取的身分快速恢復連線
+    (HNA 接受時直接送出 05/04 報告，略過讀取 ID)。
+    """
+
+    def __init__(self, host: str, port: int, local_id: bytes = SENDER_ID, peer_id: bytes = RECEIVER_ID,
+                 id_data: bytes = ALL_ID_DATA, request_timeout: float = 5.0, trace=None, resume: bool = True):
+        self.host = host
+        self.port = port
+        self.id_data = id_data # 回覆 H'01/H'01 (讀取 ID) 的 14 bytes ID 資料
+        self.request_timeout = request_timeout
+        self.trace = trace
+        self.resume = resume
+        self.session = TaiseiaSession(local_id, peer_id)
+        self.rebuilt = asyncio.Event() # 網路重建流程完成
+        self._reader = None
+        self._writer = None
+        self._read_task = None
+        self._pending = {}   # event_id -> Future
+        self._callbacks = {} # (function_id, sub_function_id) -> [callback(frame)]
+        self._seen = {}      # 最近處理過的 HNA 事件序號 (依收到順序，用來辨識重送)
+
+    async def connect(self, wait_rebuild: bool = True, timeout: float = None) -> None:
+        """建立連線；預設等待 HNA 主導的網路重建流程完成後才返回"""
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        self._seen.clear()
+        self.rebuilt.clear() # 重新連線時等待新的網路重建
+        self._read_task = asyncio.create_task(self._read_loop())
+        if wait_rebuild:
+            rebuilt = asyncio.ensure_future(self.rebuilt.wait())
+            done, _ = await asyncio.wait((rebuilt, self._read_task), timeout=timeout or self.request_timeout,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if rebuilt not in done:
+                rebuilt.cancel()
+                # HNA 在重建完成前關閉連線 (例如超過連線數上限) 時不必等到逾時
+                if self._read_task in done:
+                    raise ConnectionError("connection closed by HNA during rebuild")
+                raise asyncio.TimeoutError("network rebuild timed out")
+
+    async def close(self) -> None:
+        if self._read_task is not None:
+            self._read_task.cancel()
+            self._read_task = None
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+            self._writer = None
+        self._fail_pending(ConnectionError("connection closed"))
+
+    async def wait_closed(self) -> None:
+        """等到連線中斷 (HNA 關閉連線或讀取錯誤)；尚未連線或已 close() 時立即返回"""
+        if self._read_task is not None:
+            await asyncio.wait((self._read_task,))
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def on(self, function_id: int, sub_function_id: int, callback) -> None:
+        """登錄 HNA 主動發送封包的回呼 callback(frame)，可為同步或 async 函式"""
+        self._callbacks.setdefault((function_id, sub_function_id), []).append(callback)
+
+    def send_request(self, function_id: int, sub_function_id: int, data: bytes = b'') -> asyncio.Future:
+        """送出請求並立即回傳等待回應 (Frame) 的 Future，不等待 drain"""
+        if self._writer is None:
+            raise ConnectionError("not connected")
+        event_id = self.session.next_event_id()
+        future = asyncio.get_running_loop().create_future()
+        self._pending[event_id] = future
+        self._send(self.session.build(function_id, sub_function_id, data, event_id=event_id))
+        future.add_done_callback(lambda f, eid=event_id: self._pending.pop(eid, None))
+        return future
+
+    async def request(self, function_id: int, sub_function_id: int, data: bytes = b'',
+                      timeout: float = None) -> Frame:
+        """送出請求並等待 HNA 的 F0/F1 回應，逾時拋出 asyncio.TimeoutError"""
+        future = self.send_request(function_id, sub_function_id, data)
+        await self._writer.drain()
+        return await asyncio.wait_for(future, timeout or self.request_timeout)
+
+    def _send(self, packet: bytes) -> None:
+        if self.trace is not None:
+            self.trace.record('out', packet)
+        self._writer.write(packet)
+
+    def _fail_pending(self, exc: Exception) -> None:
+        for future in list(self._pending.values()):
+            if not future.done():
+                future.set_exception(exc)
+        self._pending.clear()
+
+    async def _read_loop(self) -> None:
+        reason = "connection closed by HNA"
+        try:
+            async for data in read_frames(self._reader):
+                if self.trace is not None:
+                    self.trace.record('in', data)
+                try:
+                    frame = Frame.decode(data)
+                except FrameError as e:
+                    log.warning("[HC] 解析錯誤: %s", e)
+                    continue
+                func_id = frame.function_id
+                log.debug("[HC] 收到 F=H'%02X', SF=H'%02X' event=%d", func_id, frame.sub_function_id, frame.event_id)
+                if func_id == 0xF0 or func_id == 0xF1:
+                    future = self._pending.get(frame.event_id)
+                    if future is not None and not future.done():
+                        future.set_result(frame)
+                    continue
+                self._handle_unsolicited(frame)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            reason = f"connection lost ({e!r})"
+        # HNA 關閉連線或讀取錯誤：等待中的請求立即失敗，之後的請求不再寫入已中斷的連線
+        writer, self._writer = self._writer, None
+        if writer is not None:
+            writer.close()
+        self._fail_pending(ConnectionError(reason))
+
+    def _handle_unsolicited(self, frame: Frame) -> None:
+        func_id, sub_func_id = frame.function_id, frame.sub_function_id
+        session = self.session
+        # HNA 主動發送的封包一律回覆，且沿用 HNA 的事件序號
+        if func_id == 0x01 and sub_func_id == 0x01: # 讀取 ID
+            self._send(session.build(0xF1, 0x00, self.id_data, event_id=frame.event_id))
+        elif func_id == 0x01 and sub_func_id == 0x00 and self.resume: # 上線通知：要求快速恢復
+            self._send(session.build(0xF0, ACK_OK, self.id_data, event_id=frame.event_id))
+        else:
+            self._send(session.ack(ACK_OK, frame.event_id))
+        # HNA 逾時重送的封包沿用原事件序號：照樣回覆 (前一次的回覆可能遺失)，但不重複處理
+        seen = self._seen
+        if frame.event_id in seen:
+            return
+        seen[frame.event_id] = None
+        if len(seen) > SEEN_EVENT_IDS:
+            del seen[next(iter(seen))]
+        # 網路重建：H'01 之後收到 H'05/H'04 即完成 (快速恢復時不會收到 H'01/H'01)
+        if func_id == 0x01:
+            self.rebuilt.clear()
+            session.mode, session.rebuild_step = 1, sub_func_id + 1
+        elif session.mode == 1 and func_id == 0x05 and sub_func_id == 0x04:
+            session.mode, session.rebuild_step = 0, 0
+            self.rebuilt.set()
+            return
+        for callback in self._callbacks.get((func_id, sub_func_id), ()):
+            result = callback(frame)
+            if asyncio.iscoroutine(result):
+                asyncio.create_task(result)
+
+
 async def run_taiseia_test(server_ip: str, server_port: int):
     # --- 步驟 2: 建立 TCP 連線 (Client 進入網路重建模式) ---
     print(f"\n--- 步驟 2: 建立 TCP 連線 (Client 進入重建等待模式) ---")
+    client = TaiseiaClient(server_ip, server_port)
     try:
-        reader, writer = await asyncio.open_connection(server_ip, server_port)
-        print(f"✅ 成功連線到 {server_ip}:{server_port}。")
+        await client.connect()
+        print(f"✅ 成功連線到 {server_ip}:{server_port}，網路重建流程完成。")
     except ConnectionRefusedError:
         print(f"❌ 錯誤：拒絕連線，請確認伺服器正在運行。")
         return
-
-    # --- 流程狀態機 ---
-    test_step = 1 # 1-網路重建, 2-註冊, 3-管理, 4-監控, 5-結束
-    rebuild_step = 1 # 網路重建流程狀態
-    relay_step = 0 # 轉傳流程狀態
+    except asyncio.TimeoutError:
+        print(f"❌ 錯誤：網路重建流程逾時。")
+        await client.close()
+        return
+    except ConnectionError as e:
+        print(f"❌ 錯誤：重建期間連線中斷 ({e})。")
+        await client.close()
+        return
 
     try:
-        while True:
-            # 讀取數據 (等待 HNA 主動發送或回覆)
-            response_data = await reader.read(4096)
-            if not response_data:
-                break
-            
-            response = parse_taiseia_response(response_data)
-            if "error" in response:
-                print(f"❌ 解析錯誤: {response['error']}")
-                break
-
-            func_id = response['function_id']
-            sub_func_id = response['sub_function_id']
-            
-            print(f"[HC] 收到封包 F=H'{func_id:02X}', SF=H'{sub_func_id:02X}'. 狀態: {test_step}-{rebuild_step}-{relay_step}")
-
-            # ----------------------------------------------------
-            # 狀態 1: 網路重建 (HC 被動處理)
-            # ----------------------------------------------------
-            if test_step == 1:
-                if rebuild_step == 1 and func_id == 0x01 and sub_func_id == 0x00: # 收到 H'01/H'00 (通知已上線)
-                    ack_packet = build_ack_packet(SENDER_ID, RECEIVER_ID, 0x00)
-                    writer.write(ack_packet); await writer.drain()
-                    rebuild_step = 2 # 等待 H'01/H'01 (讀取 ID)
-                elif rebuild_step == 2 and func_id == 0x01 and sub_func_id == 0x01: # 收到 H'01/H'01 (讀取 ID)
-                    id_data = b'\x11\x11\x11\x11\xAA\xBB\x33\x33\x55\x55\x55\x55\x66\x66' 
-                    reply_packet = build_taiseia_packet(SENDER_ID, RECEIVER_ID, 0xFF, 0xF1, 0x00, id_data)
-                    writer.write(reply_packet); await writer.drain()
-                    rebuild_step = 3 # 等待 H'05/H'04 (報告)
-                elif rebuild_step == 3 and func_id == 0x05 and sub_func_id == 0x04: # 收到 H'05/H'04 (報告)
-                    ack_packet = build_ack_packet(SENDER_ID, RECEIVER_ID, 0x00)
-                    writer.write(ack_packet); await writer.drain()
-                    print("✅ 網路重建流程完成。")
-                    test_step = 2 # 進入下一步驟：註冊
-                    rebuild_step = 0
-                    break # 跳出等待迴圈，開始主動測試
-
-            # ----------------------------------------------------
-            # 狀態 3: SA 管理/轉傳 (HC 主動後，被動處理通知和報告)
-            # ----------------------------------------------------
-            elif test_step == 3:
-                # 轉傳 Step 6 (收到 H'05/H'05 通知封包)
-                if relay_step == 1 and func_id == 0x05 and sub_func_id == 0x05:
-                    ack_packet = build_ack_packet(SENDER_ID, RECEIVER_ID, 0x00)
-                    writer.write(ack_packet); await writer.drain()
-                    relay_step = 2 # 等待 H'05/H'04 (報告)
-
-                # 轉傳 Step 8 (收到 H'05/H'04 報告封包)
-                elif relay_step == 2 and func_id == 0x05 and sub_func_id == 0x04:
-                    ack_packet = build_ack_packet(SENDER_ID, RECEIVER_ID, 0x00)
-                    writer.write(ack_packet); await writer.drain()
-                    print("✅ SA 管理/轉傳流程完成。")
-                    test_step = 4 # 流程結束，進入下一步驟
-                    break # 跳出等待迴圈，開始主動測試
-            
-            # 忽略所有非流程中的 ACK/回應
-            elif func_id in [0xF0, 0xF1]:
-                pass
-            
-            else:
-                print(f"[HC] 收到未處理封包 F=H'{func_id:02X}', SF=H'{sub_func_id:02X}'.")
-
-    except Exception as e:
-        print(f"Client Error during TCP loop: {e}")
-    
-    # ----------------------------------------------------
-    # 流程控制：主動發送指令 (只有在狀態機流程完成後才會執行)
-    # ----------------------------------------------------
-    
-    if test_step == 2: # 步驟 2：執行註冊流程
         print(f"\n--- 步驟 2: HNA 註冊 (H'03) ---")
-        # H'03/H'00 (啟動註冊)
-        request_reg_start = build_taiseia_packet(SENDER_ID, RECEIVER_ID, 0xFF, 0x03, 0x00, b'')
-        writer.write(request_reg_start); await writer.drain()
-        await reader.read(4096) # 讀取 HNA 的 ACK
-        
-        # H'03/H'02 (讀取 HNA 支援能力)
-        request_read_cap = build_taiseia_packet(SENDER_ID, RECEIVER_ID, 0xFF, 0x03, 0x02, b'')
-        writer.write(request_read_cap); await writer.drain()
-        response_data = await reader.read(4096)
-        response = parse_taiseia_response(response_data)
-        print(f"✅ 註冊：讀取能力回覆 F=H'{response.get('function_id',0):02X}'/SF=H'{response.get('sub_function_id',0):02X}'")
-        test_step = 3 # 進入下一步驟：SA 管理/轉傳
-
-    if test_step == 3: # 步驟 3：SA 管理/轉傳流程 (啟動)
+        # H'03/H'00 (啟動註冊) 與 H'03/H'02 (讀取 HNA 支援能力) 同時送出
+        reg_ack, response = await asyncio.gather(
+            client.request(0x03, 0x00),
+            client.request(0x03, 0x02),
+        )
+        print(f"✅ 註冊：讀取能力回覆 F=H'{response.function_id:02X}'/SF=H'{response.sub_function_id:02X}' data={response.data.hex()}")
+
         print(f"\n--- 步驟 3: SA 管理/轉傳 (H'05/H'01 啟動) ---")
-        request_management = build_taiseia_packet(SENDER_ID, RECEIVER_ID, 0xFF, 0x05, 0x01, b'\x01\x00\x01')
-        writer.write(request_management); await writer.drain()
-        relay_step = 1 # 等待通知/報告
-        # 重新進入 while 迴圈處理 HNA 主動發送的封包
-        
-    if test_step == 4: # 步驟 4：執行單次/批次監控
+        relay_done = asyncio.Event()
+        client.on(0x05, 0x05, lambda frame: print(f"[HC] 收到 H'05/H'05 通知 data={frame.data.hex()}"))
+        client.on(0x05, 0x04, lambda frame: relay_done.set())
+        await client.request(0x05, 0x01, b'\x01\x00\x01')
+        await asyncio.wait_for(relay_done.wait(), client.request_timeout)
+        print("✅ SA 管理/轉傳流程完成。")
+
         print(f"\n--- 步驟 4: SA 裝置監控 (H'04) ---")
-        # H'04/H'02 (設定狀態)
-        request_monitor_set = build_taiseia_packet(SENDER_ID, RECEIVER_ID, 0xFF, 0x04, 0x02, b'\x01\x01')
-        writer.write(request_monitor_set); await writer.drain()
-        await reader.read(4096) # 讀取 HNA 的 ACK
-        
-        # H'04/H'01 (讀取狀態)
-        request_read_status = build_taiseia_packet(SENDER_ID, RECEIVER_ID, 0xFF, 0x04, 0x01, b'')
-        writer.write(request_read_status); await writer.drain()
-        response = parse_taiseia_response(await reader.read(4096))
-        print(f"✅ 監控：讀取狀態回覆 F=H'{response.get('function_id',0):02X}'/SF=H'{response.get('sub_function_id',0):02X}'")
-        test_step = 5 # 進入下一步驟：結束
-
-    if test_step == 5:
+        # H'04/H'02 (設定狀態) 後 H'04/H'01 (讀取狀態)
+        await client.request(0x04, 0x02, encode_sa_records([(1, 1, 1), (1, 2, 30)]))
+        response = await client.request(0x04, 0x01, encode_sa_query([(1, 1), (1, 2)]))
+        print(f"✅ 監控：讀取狀態回覆 F=H'{response.function_id:02X}'/SF=H'{response.sub_function_id:02X}' "
+              f"(裝置, 服務, 數值)={parse_sa_records(response.data)}")
+        # H'04/H'03 (讀取變更)：第一次從頭讀取，之後以回應的 (epoch, 版本) 只取回新的變更
+        response = await client.request(0x04, 0x03, encode_sa_delta_request())
+        epoch, version, records = parse_sa_delta(response.data)
+        print(f"✅ 監控：讀取變更回覆 版本={version} (裝置, 服務, 數值)={records}")
+    except asyncio.TimeoutError:
+        print("❌ 錯誤：等待 HNA 回應逾時。")
+    except ConnectionError as e:
+        print(f"❌ 連線錯誤: {e}")
+    finally:
         print(f"\n--- 步驟 5: 關閉 TCP 連線 ---")
-        writer.close()
-        await writer.wait_closed()
+        await client.close()
         print("✅ TCP 連線已關閉，所有流程測試完成。")
-    
-    if test_step < 5:
-        # 如果流程未結束，且當前不在等待被動回覆，則再次運行迴圈，觸發下一個主動步驟
-        await run_taiseia_test(server_ip, server_port)
 
 
 async def main():
@@ -194,10 +311,6 @@ async def main():
     ip, port = await discovery_server('127.0.0.1')
     
     if ip and port:
-        # 重設全局事件計數器以確保測試流程從正確的事件 ID 開始
-        global EVENT_ID_COUNTER
-        EVENT_ID_COUNTER = 1 
-        
         # 啟動測試流程
         await run_taiseia_test(ip, port)
     else:
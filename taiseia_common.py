@@ -1,13 +1,16 @@
 # taiseia_common.py
 import struct
-import json
-import socket
-import asyncio
+# json、socket、asyncio 只在服務發現與 asyncio 介面中用到，於使用時才載入
+# (嵌入式設定只需要編解碼，啟動時不必載入這些模組)
 
 # --- 服務設定與 ID 資訊 ---
 UDP_DISCOVERY_PORT = 50000
 TCP_SERVICE_PORT = 50001
 SEARCH_MAGIC_WORD = b'TAISEIA_SEARCH_REQUEST'
+# 要求精簡二進位回覆的搜尋字 (回覆格式見 encode_discovery_reply)
+SEARCH_MAGIC_WORD_BINARY = SEARCH_MAGIC_WORD + b'_BIN'
+DISCOVERY_BINARY_MAGIC = b'TSD1'
+DISCOVERY_BINARY_STRUCT = struct.Struct('!4s4sH') # magic, IPv4, TCP port
 
 # 伺服器/接收端 ID: 6 bytes 範例
 RECEIVER_ID = b'\x44\x44\x44\x44\x33\x33' 
@@ -23,32 +26,136 @@ ALL_ID_DATA = SIMULATED_USER_ID + SIMULATED_HC_ID + SIMULATED_HNA_ID + SIMULATED
 
 # 模擬 HNA 支援能力
 HNA_SUPPORT_CAPABILITY = b'\x01\x00\x01\x00'
-# 模擬 SA 狀態數據
-SIMULATED_SA_STATUS_DATA = b'\x01\x01\x02' 
+# 模擬 SA 狀態：裝置 1 / 服務 1 的初始值 (舊版 04/01 固定回覆 01 01 02)
+SIMULATED_SA_STATUS = ((1, 1, 2),)
 # 模擬 SA 報告數據
 SA_REPORT_DATA = b'\x1A\x1B\x1C\x1D' 
 # 模擬 SA 通知數據
 SA_NOTIFICATION_DATA = b'\x01\x01'
 
 
+# --- TaiSEIA 101 封包格式 ---
+# 標頭: Header(1) 長度(2) 發送端ID(6) 接收端ID(6) Group(1) 事件序號(2) F(1) SF(1) 保留(2) 保留(2)
+HEADER_ID = 0x13
+HEADER_FORMAT = '!BH6s6sBHBBHH'
+FIXED_HEADER_LENGTH = 24
+CRC_LENGTH = 2
+MIN_PACKET_LENGTH = FIXED_HEADER_LENGTH + CRC_LENGTH # 26 bytes (無資料)
+MAX_PACKET_LENGTH = 0xFFFF # 長度欄位為 2 bytes
+HEADER_STRUCT = struct.Struct(HEADER_FORMAT)
+CRC_STRUCT = struct.Struct('!H')
+EVENT_ID_STRUCT = struct.Struct('!H')
+EVENT_ID_OFFSET = 16 # Header(1) + 長度(2) + ID(6+6) + Group(1)
+MAX_FRAME_LENGTH = 8192 # 分框時接受的最大封包長度，超過視為雜訊以便重新同步
+
+
+# --- F0 認可 (ACK) 回應碼 ---
+ACK_OK = 0x00
+ACK_CRC_ERROR = 0x03
+ACK_UNSUPPORTED = 0x10
+
+
 # --- 全域事件序號，確保每次發送的事件序號遞增 ---
+# 僅供未指定 event_id 的舊介面使用；每條連線應使用自己的 TaiseiaSession
 EVENT_ID_COUNTER = 1 
+MAX_EVENT_ID = 0xFFFF # 事件序號為 2 bytes，超過後回到 1 (0 保留給封包範本)
+
+def next_event_id() -> int:
+    """取用並遞增全域事件序號 (1..0xFFFF 循環)"""
+    global EVENT_ID_COUNTER
+    event_id = EVENT_ID_COUNTER
+    EVENT_ID_COUNTER = event_id + 1 if event_id < MAX_EVENT_ID else 1
+    return event_id
 
 
 # --- 輔助函數：CRC-16 計算 ---
-def crc16_ccitt(data: bytes, initial_value: int = 0xFFFF) -> int:
+# CRC-16/CCITT (多項式 0x1021，初始值 0xFFFF，不反射、不做最終 XOR)
+CRC16_POLY = 0x1021
+CRC16_INIT = 0xFFFF
+
+try:
+    # CPython 內建的 C 實作，演算法與下方逐位元版本完全相同
+    from binascii import crc_hqx as _crc_hqx
+except ImportError:  # MicroPython 等平台沒有 crc_hqx
+    _crc_hqx = None
+
+
+def crc16_ccitt_bitwise(data, initial_value: int = CRC16_INIT) -> int:
+    """逐位元計算 CRC-16 (參考實作，用於驗證與效能比較)"""
     crc = initial_value
     for byte in data:
         crc ^= byte << 8
         for _ in range(8):
             if crc & 0x8000:
-                crc = (crc << 1) ^ 0x1021
+                crc = (crc << 1) ^ CRC16_POLY
             else:
                 crc = crc << 1
             crc &= 0xFFFF
     return crc
 
 
+def _build_crc16_tables():
+    # T0: 單一位元組查表；T1: slicing-by-2 用的第二張表 (一次處理兩個位元組)
+    t0 = [crc16_ccitt_bitwise((i,), 0) for i in range(256)]
+    t1 = [((t0[i] << 8) & 0xFFFF) ^ t0[t0[i] >> 8] for i in range(256)]
+    return tuple(t0), tuple(t1)
+
+CRC16_TABLE, CRC16_TABLE_HI = _build_crc16_tables()
+
+
+def crc16_ccitt_table(data, initial_value: int = CRC16_INIT) -> int:
+    """查表計算 CRC-16 (slicing-by-2，純 Python，可直接移植到無 crc_hqx 的平台)"""
+    t0, t1 = CRC16_TABLE, CRC16_TABLE_HI
+    crc = initial_value
+    it = iter(data)
+    for hi, lo in zip(it, it):
+        crc ^= (hi << 8) | lo
+        crc = t1[crc >> 8] ^ t0[crc & 0xFF]
+    if len(data) & 1:
+        crc = ((crc << 8) & 0xFFFF) ^ t0[(crc >> 8) ^ data[-1]]
+    return crc
+
+
+def crc16_ccitt(data, initial_value: int = CRC16_INIT) -> int:
+    """計算 CRC-16/CCITT，接受 bytes/bytearray/memoryview 且不複製資料。
+
+    傳入上一次的結果作為 initial_value 即可增量計算 (先標頭、再資料)。
+    """
+    return _crc_hqx(data, initial_value)
+
+if _crc_hqx is None:
+    crc16_ccitt = crc16_ccitt_table
+
+
+class Crc16:
+    """增量式 CRC-16 計算器，例如：Crc16().update(header).update(data).value"""
+    __slots__ = ('value',)
+
+    def __init__(self, initial_value: int = CRC16_INIT):
+        self.value = initial_value
+
+    def update(self, data) -> 'Crc16':
+        self.value = crc16_ccitt(data, self.value)
+        return self
+
+    def digest(self) -> bytes:
+        """以封包尾端的 2 bytes (big-endian) 形式回傳"""
+        return self.value.to_bytes(2, 'big')
+
+    def copy(self) -> 'Crc16':
+        return Crc16(self.value)
+
+
+def crc16_check_frames(frames) -> list:
+    """批次驗證多個完整封包 (最後 2 bytes 為 CRC)，回傳每個封包是否通過。
+
+    對整個封包 (含 big-endian CRC) 再做一次 CRC，正確時結果必為 0，
+    因此每個封包只需一次計算、不需切片。
+    """
+    crc = crc16_ccitt
+    return [len(f) >= 2 and crc(f) == 0 for f in frames]
+
+
 # --- 輔助函數：TaiSEIA 101 封包建構 ---
 def build_taiseia_packet(
         sender_id: bytes,
@@ -56,20 +163,16 @@ def build_taiseia_packet(
         group_id: int,
         function_id: int,
         sub_function_id: int,
-        data: bytes = b''
+        data: bytes = b'',
+        event_id: int = None
 ) -> bytes:
-    """建構 TaiSEIA 101 二進制封包"""
-    global EVENT_ID_COUNTER
-    
-    HEADER_ID = 0x13
-    FIXED_HEADER_LENGTH = 24 
-    TOTAL_LENGTH = FIXED_HEADER_LENGTH + len(data) + 2 
+    """建構 TaiSEIA 101 二進制封包 (未指定 event_id 時取用全域事件序號)"""
+    TOTAL_LENGTH = FIXED_HEADER_LENGTH + len(data) + CRC_LENGTH
     
-    event_id = EVENT_ID_COUNTER 
-    EVENT_ID_COUNTER += 1       
+    if event_id is None:
+        event_id = next_event_id()
     
-    header_part = struct.pack(
-        '!BH6s6sBHBHH', 
+    header_part = HEADER_STRUCT.pack(
         HEADER_ID, TOTAL_LENGTH, sender_id, receiver_id, group_id,
         event_id, function_id, sub_function_id,
         0, 0
@@ -78,39 +181,430 @@ def build_taiseia_packet(
     payload_no_crc = header_part + data
     crc = crc16_ccitt(payload_no_crc)
     
-    return payload_no_crc + struct.pack('!H', crc)
+    return payload_no_crc + CRC_STRUCT.pack(crc)
+
+
+def build_into(
+        buffer,
+        offset: int,
+        sender_id: bytes,
+        receiver_id: bytes,
+        group_id: int,
+        function_id: int,
+        sub_function_id: int,
+        data: bytes = b'',
+        event_id: int = None
+) -> int:
+    """把封包直接寫入呼叫端提供的 bytearray (從 offset 開始)，回傳寫入的位元組數"""
+    total_length = FIXED_HEADER_LENGTH + len(data) + CRC_LENGTH
+    if event_id is None:
+        event_id = next_event_id()
+
+    HEADER_STRUCT.pack_into(
+        buffer, offset,
+        HEADER_ID, total_length, sender_id, receiver_id, group_id,
+        event_id, function_id, sub_function_id,
+        0, 0
+    )
+    crc_offset = offset + total_length - CRC_LENGTH
+    buffer[offset + FIXED_HEADER_LENGTH:crc_offset] = data
+    with memoryview(buffer) as view:
+        crc = crc16_ccitt(view[offset:crc_offset])
+    CRC_STRUCT.pack_into(buffer, crc_offset, crc)
+    return total_length
+
+
+# --- 輔助類別：固定內容封包範本 ---
+# CRC 對 (初始值, 訊息) 是 GF(2) 上的線性運算：事件序號 eid 對最終 CRC 的影響
+# 只取決於它後面還有幾個位元組，與內容無關。因此
+#   CRC(eid) = CRC(eid=0) ^ hi[eid >> 8] ^ lo[eid & 0xFF]
+# 兩張表依「事件序號之後的長度」共用。
+_EVENT_CRC_TABLES = {}
+
+def _event_crc_tables(tail_length: int):
+    tables = _EVENT_CRC_TABLES.get(tail_length)
+    if tables is None:
+        zeros = bytes(tail_length)
+        hi = tuple(crc16_ccitt(bytes((i, 0)) + zeros, 0) for i in range(256))
+        lo = tuple(crc16_ccitt(bytes((0, i)) + zeros, 0) for i in range(256))
+        tables = _EVENT_CRC_TABLES[tail_length] = (hi, lo)
+    return tables
+
+
+class FrameTemplate:
+    """預先編碼好的封包，只有事件序號會變動。
+
+    render() 以 pack_into 就地改寫事件序號，CRC 由事件序號為 0 時的 CRC
+    查兩次表修正，不必重新打包標頭，也不必重算整個封包的 CRC。
+    """
+    __slots__ = ('buffer', '_base_crc', '_crc_offset', '_crc_hi', '_crc_lo')
+
+    def __init__(self, sender_id: bytes, receiver_id: bytes, group_id: int,
+                 function_id: int, sub_function_id: int, data: bytes = b''):
+        self.buffer = bytearray(FIXED_HEADER_LENGTH + len(data) + CRC_LENGTH)
+        build_into(self.buffer, 0, sender_id, receiver_id, group_id,
+                   function_id, sub_function_id, data, event_id=0)
+        self._crc_offset = len(self.buffer) - CRC_LENGTH
+        self._base_crc = CRC_STRUCT.unpack_from(self.buffer, self._crc_offset)[0]
+        self._crc_hi, self._crc_lo = _event_crc_tables(self._crc_offset - EVENT_ID_OFFSET - 2)
+
+    def fill(self, data) -> None:
+        """以相同長度的新資料取代資料段 (標頭不變)，只重算一次事件序號為 0 時的 CRC"""
+        buf = self.buffer
+        crc_offset = self._crc_offset
+        if len(data) != crc_offset - FIXED_HEADER_LENGTH:
+            raise ValueError(f"template data is {crc_offset - FIXED_HEADER_LENGTH} bytes, got {len(data)}")
+        buf[FIXED_HEADER_LENGTH:crc_offset] = data
+        EVENT_ID_STRUCT.pack_into(buf, EVENT_ID_OFFSET, 0)
+        with memoryview(buf) as view:
+            self._base_crc = crc16_ccitt(view[:crc_offset])
+
+    def _patch(self, event_id: int) -> None:
+        buf = self.buffer
+        EVENT_ID_STRUCT.pack_into(buf, EVENT_ID_OFFSET, event_id)
+        CRC_STRUCT.pack_into(buf, self._crc_offset,
+                             self._base_crc ^ self._crc_hi[event_id >> 8] ^ self._crc_lo[event_id & 0xFF])
+
+    def render(self, event_id: int) -> bytes:
+        """產生指定事件序號的封包"""
+        self._patch(event_id)
+        return bytes(self.buffer)
+
+    def render_into(self, buffer, offset: int, event_id: int) -> int:
+        """把指定事件序號的封包寫入呼叫端的 bytearray，回傳寫入的位元組數"""
+        self._patch(event_id)
+        size = len(self.buffer)
+        buffer[offset:offset + size] = self.buffer
+        return size
+
+
+# --- 輔助類別：解析 TaiSEIA 101 封包 ---
+class FrameError(ValueError):
+    """封包解碼錯誤的基底類別 (伺服器端一律回覆 F0/03)"""
+
+class FrameTooShortError(FrameError):
+    """封包長度小於固定標頭 + CRC"""
+
+class FrameHeaderError(FrameError):
+    """第一個 byte 不是 Header ID (0x13)"""
+
+class FrameLengthError(FrameError):
+    """標頭長度欄位與實際封包長度不符"""
+
+class CrcMismatchError(FrameError):
+    """CRC 檢查失敗"""
+
+
+# 熱路徑只解出常用欄位，略過 Header、發送端/接收端 ID 與保留欄位
+_FRAME_FIELDS = struct.Struct('!xH12xBHBB')
+_SENDER_ID_SLICE = slice(3, 9)
+_RECEIVER_ID_SLICE = slice(9, 15)
+
+
+class Frame:
+    """解碼後的 TaiSEIA 101 封包。
+
+    raw 為原始封包的 memoryview，data 為資料段的 memoryview (皆不複製)；
+    sender_id / receiver_id 只有在讀取時才解碼。
+    """
+    __slots__ = ('raw', 'packet_length', 'group_id', 'event_id', 'function_id', 'sub_function_id')
+
+    def __init__(self, raw, packet_length, group_id, event_id, function_id, sub_function_id):
+        self.raw = raw
+        self.packet_length = packet_length
+        self.group_id = group_id
+        self.event_id = event_id
+        self.function_id = function_id
+        self.sub_function_id = sub_function_id
+
+    @classmethod
+    def decode(cls, packet, check_crc: bool = True) -> 'Frame':
+        """解碼完整封包，失敗時拋出 FrameError 的子類別"""
+        raw = packet if isinstance(packet, memoryview) else memoryview(packet)
+        size = len(raw)
+        if size < MIN_PACKET_LENGTH:
+            raise FrameTooShortError(f"Packet too short ({size} bytes)")
+        if raw[0] != HEADER_ID:
+            raise FrameHeaderError(f"Bad header ID 0x{raw[0]:02X}")
+        length, group_id, event_id, function_id, sub_function_id = _FRAME_FIELDS.unpack_from(raw)
+        if length != size:
+            raise FrameLengthError(f"Length field {length} != packet size {size}")
+        # 含 CRC 的整個封包再做一次 CRC，正確時結果為 0
+        if check_crc and crc16_ccitt(raw) != 0:
+            raise CrcMismatchError("CRC Mismatch")
+        return cls(raw, length, group_id, event_id, function_id, sub_function_id)
+
+    @property
+    def header_id(self) -> int:
+        return self.raw[0]
+
+    @property
+    def sender_id(self) -> bytes:
+        return self.raw[_SENDER_ID_SLICE].tobytes()
+
+    @property
+    def receiver_id(self) -> bytes:
+        return self.raw[_RECEIVER_ID_SLICE].tobytes()
+
+    @property
+    def data(self) -> memoryview:
+        return self.raw[FIXED_HEADER_LENGTH:-CRC_LENGTH]
+
+    @property
+    def crc(self) -> int:
+        return (self.raw[-2] << 8) | self.raw[-1]
+
+    def as_dict(self) -> dict:
+        return {
+            "header_id": self.header_id,
+            "packet_length": self.packet_length,
+            "sender_id": self.sender_id,
+            "receiver_id": self.receiver_id,
+            "event_id": self.event_id,
+            "function_id": self.function_id,
+            "sub_function_id": self.sub_function_id,
+            "data": self.data.tobytes()
+        }
+
+    def __repr__(self):
+        return (f"Frame(F=H'{self.function_id:02X}', SF=H'{self.sub_function_id:02X}', "
+                f"event_id={self.event_id}, data={self.data.hex()})")
+
 
 # --- 輔助函數：解析 TaiSEIA 101 封包 ---
 def parse_taiseia_response(packet: bytes) -> dict:
-    """解析 TaiSEIA 101 封包的固定標頭和 CRC"""
-    if len(packet) < 26:
+    """解析 TaiSEIA 101 封包的固定標頭和 CRC (舊介面，錯誤以 "error" 鍵回傳；熱路徑請用 Frame.decode)"""
+    try:
+        return Frame.decode(packet).as_dict()
+    except FrameTooShortError:
         return {"error": "Packet too short", "length": len(packet)}
+    except FrameError as e:
+        return {"error": str(e)}
 
-    header_format = '!BH6s6sBHBHH' 
-    header_size = struct.calcsize(header_format)
+# --- 輔助類別：TCP 串流分框 ---
+class TaiseiaFramer:
+    """依標頭 0x13 後的 2 bytes 長度欄位，把 TCP 串流切成完整的 TaiSEIA 封包。
+
+    一次 read 可能包含多個封包，也可能只有半個封包；feed() 收進緩衝區後，
+    frames() 逐一產生完整封包的 memoryview (不複製)。遇到非 0x13 或長度不合理
+    的資料時會丟棄位元組直到下一個 0x13 重新同步。只有整個封包 (含 CRC) 的 CRC
+    為 0 才視為封包；否則 (雜訊中的 0x13 或損壞的封包) 計入 crc_errors、呼叫
+    on_crc_error() 並只跳過一個位元組，避免以錯誤的長度吞掉之後的真正封包。
+    長度欄位指向尚未收到的資料時，若緩衝區中之後已有完整且 CRC 正確的封包，
+    同樣視為假同步，不必等到湊滿錯誤的長度。
+    """
+    __slots__ = ('_buf', '_pos', 'max_length', 'dropped_bytes', 'crc_errors', 'on_crc_error')
+
+    def __init__(self, max_length: int = MAX_FRAME_LENGTH, on_crc_error=None):
+        self._buf = b''
+        self._pos = 0
+        self.max_length = max_length
+        self.dropped_bytes = 0 # 重新同步時丟棄的位元組數
+        self.crc_errors = 0    # CRC 不符而放棄的同步位置數
+        self.on_crc_error = on_crc_error
+
+    def feed(self, data) -> None:
+        """收進一段串流資料"""
+        if self._pos < len(self._buf):
+            # 只有殘留的半個封包需要與新資料合併
+            self._buf = bytes(memoryview(self._buf)[self._pos:]) + data
+        else:
+            self._buf = data if isinstance(data, bytes) else bytes(data)
+        self._pos = 0
+
+    def pending(self) -> int:
+        """緩衝區中尚未成框的位元組數"""
+        return len(self._buf) - self._pos
+
+    def frames(self):
+        """產生目前緩衝區內所有完整的封包 (memoryview)"""
+        buf = self._buf
+        end = len(buf)
+        view = memoryview(buf)
+        pos = self._pos
+        while end - pos >= 3:
+            if buf[pos] != HEADER_ID:
+                nxt = buf.find(HEADER_ID, pos + 1)
+                if nxt < 0:
+                    nxt = end
+                self.dropped_bytes += nxt - pos
+                pos = nxt
+                continue
+            length = (buf[pos + 1] << 8) | buf[pos + 2]
+            if length < MIN_PACKET_LENGTH or length > self.max_length:
+                # 長度欄位不合理：視為雜訊，跳過此 0x13 重新同步
+                self.dropped_bytes += 1
+                pos += 1
+                continue
+            if end - pos < length:
+                if not self._valid_frame_after(buf, view, pos + 1, end):
+                    break # 封包尚未收齊
+            elif not crc16_ccitt(view[pos:pos + length]):
+                self._pos = pos + length
+                yield view[pos:pos + length]
+                pos = self._pos
+                continue
+            # 假同步或損壞的封包：從下一個位元組重新尋找 0x13
+            self.crc_errors += 1
+            self.dropped_bytes += 1
+            pos += 1
+            if self.on_crc_error is not None:
+                self.on_crc_error()
+        self._pos = pos
+
+    def _valid_frame_after(self, buf, view, start: int, end: int) -> bool:
+        """buf[start:end] 中是否已有完整且 CRC 正確的封包"""
+        pos = buf.find(HEADER_ID, start, end)
+        while pos >= 0 and end - pos >= MIN_PACKET_LENGTH:
+            length = (buf[pos + 1] << 8) | buf[pos + 2]
+            if MIN_PACKET_LENGTH <= length <= min(self.max_length, end - pos) \
+                    and not crc16_ccitt(view[pos:pos + length]):
+                return True
+            pos = buf.find(HEADER_ID, pos + 1, end)
+        return False
+
+    def __iter__(self):
+        return self.frames()
+
+
+async def read_frames(reader: 'asyncio.StreamReader', framer: TaiseiaFramer = None, chunk_size: int = 4096):
+    """以非同步迭代器的方式從 StreamReader 讀出完整封包：async for frame in read_frames(reader)"""
+    if framer is None:
+        framer = TaiseiaFramer()
+    while True:
+        data = await reader.read(chunk_size)
+        if not data:
+            return
+        framer.feed(data)
+        for frame in framer.frames():
+            yield frame
+
+
+# --- 輔助類別：嵌入式設定的固定收送緩衝區 ---
+EMBEDDED_FRAME_SIZE = 512 # 嵌入式設定接受的最大封包長度 (rx/tx 各一個)
+
+
+class FrameBuffer:
+    """預先配置的收/送緩衝區與就地編解碼 (嵌入式設定，供 ESP32/MicroPython 移植)。
+
+    收到的資料寫入 rx (rx_space() 交給 recv_into)，next_frame() 在原地分框並檢查
+    CRC，欄位直接存成屬性；回覆由 encode() 寫入 tx。回傳的 memoryview 依長度快取，
+    穩定狀態下處理一個封包不會建立 bytes、dict 或 Frame 物件。
+    """
+    __slots__ = ('size', 'rx', 'tx', 'rx_used', 'length', 'group_id', 'event_id', 'function_id',
+                 'sub_function_id', 'dropped_bytes', '_rx_view', '_tx_view', '_rx_slices', '_tx_slices')
+
+    MAX_CACHED_VIEWS = 32 # 每個緩衝區最多快取幾種長度的 memoryview
+
+    def __init__(self, size: int = EMBEDDED_FRAME_SIZE):
+        self.size = size
+        self.rx = bytearray(size)
+        self.tx = bytearray(size)
+        self.rx_used = 0
+        self.length = 0 # next_frame() 找到的封包長度
+        self.group_id = self.event_id = self.function_id = self.sub_function_id = 0
+        self.dropped_bytes = 0 # 重新同步時丟棄的位元組數
+        self._rx_view = memoryview(self.rx)
+        self._tx_view = memoryview(self.tx)
+        self._rx_slices = {}
+        self._tx_slices = {}
+
+    def _prefix(self, cache: dict, view: memoryview, length: int) -> memoryview:
+        prefix = cache.get(length)
+        if prefix is None:
+            prefix = view[:length]
+            if len(cache) < self.MAX_CACHED_VIEWS:
+                cache[length] = prefix
+        return prefix
+
+    def rx_space(self) -> memoryview:
+        """rx 尚未使用的部分 (交給 sock.recv_into / stream.readinto)"""
+        if self.rx_used == 0:
+            return self._rx_view
+        return self._rx_view[self.rx_used:] # 只有封包分段到達時才需要
+
+    def received(self, count: int) -> None:
+        self.rx_used += count
+
+    def next_frame(self) -> int:
+        """rx 開頭若有完整封包則解出欄位並回傳長度，否則回傳 0。
+
+        不是 0x13 開頭或長度不合理的資料會丟棄到下一個 0x13。CRC 錯誤時 (雜訊中的
+        0x13 或損壞的封包) 只丟棄這個 0x13 並拋出 CrcMismatchError (欄位仍已解出，
+        呼叫端可回覆 F0/03，不需 consume())，之後從下一個 0x13 重新同步，不會以錯誤的
+        長度吞掉後面的封包。長度欄位指向尚未收到的資料、但之後已有完整且 CRC 正確的
+        封包時，同樣視為假同步。
+        """
+        rx = self.rx
+        while self.rx_used >= 3:
+            length = (rx[1] << 8) | rx[2]
+            if rx[0] == HEADER_ID and MIN_PACKET_LENGTH <= length <= self.size:
+                if self.rx_used >= length:
+                    break
+                if not self._valid_frame_after():
+                    return 0 # 封包尚未收齊
+            self._skip()
+        else:
+            return 0
+        self.length = length
+        self.group_id = rx[15]
+        self.event_id = (rx[16] << 8) | rx[17]
+        self.function_id = rx[18]
+        self.sub_function_id = rx[19]
+        if crc16_ccitt(self._prefix(self._rx_slices, self._rx_view, length)) != 0:
+            self.length = 0
+            self._skip()
+            raise CrcMismatchError("CRC Mismatch")
+        return length
+
+    def _skip(self) -> None:
+        """丟棄開頭的位元組直到下一個 0x13"""
+        nxt = self.rx.find(HEADER_ID, 1, self.rx_used)
+        self._discard(nxt if nxt > 0 else self.rx_used)
+
+    def _valid_frame_after(self) -> bool:
+        """rx 開頭之後是否已有完整且 CRC 正確的封包"""
+        rx, end = self.rx, self.rx_used
+        pos = rx.find(HEADER_ID, 1, end)
+        while pos > 0 and end - pos >= MIN_PACKET_LENGTH:
+            length = (rx[pos + 1] << 8) | rx[pos + 2]
+            if MIN_PACKET_LENGTH <= length <= end - pos and not crc16_ccitt(self._rx_view[pos:pos + length]):
+                return True
+            pos = rx.find(HEADER_ID, pos + 1, end)
+        return False
+
+    def data(self) -> memoryview:
+        """目前封包的資料欄位 (會建立一個 memoryview；只在需要讀資料的處理中使用)"""
+        return self._rx_view[FIXED_HEADER_LENGTH:self.length - CRC_LENGTH]
+
+    def consume(self) -> None:
+        """丟棄目前的封包 (next_frame() 之後呼叫)"""
+        self._discard(self.length)
+        self.length = 0
+
+    def _discard(self, count: int) -> None:
+        rest = self.rx_used - count
+        if rest > 0:
+            self._rx_view[:rest] = self._rx_view[count:self.rx_used]
+        self.rx_used = rest if rest > 0 else 0
+        if self.length == 0:
+            self.dropped_bytes += count
+
+    def encode(self, local_id: bytes, peer_id: bytes, function_id: int, sub_function_id: int,
+               data=b'', event_id: int = 1, group_id: int = 0xFF) -> memoryview:
+        """把封包寫入 tx，回傳 tx 中該封包的 memoryview (下次 encode 前有效)"""
+        length = MIN_PACKET_LENGTH + len(data)
+        tx = self.tx
+        HEADER_STRUCT.pack_into(tx, 0, HEADER_ID, length, local_id, peer_id, group_id,
+                                event_id, function_id, sub_function_id, 0, 0)
+        if data:
+            tx[FIXED_HEADER_LENGTH:length - CRC_LENGTH] = data
+        crc = crc16_ccitt(self._prefix(self._tx_slices, self._tx_view, length - CRC_LENGTH))
+        tx[length - 2] = crc >> 8
+        tx[length - 1] = crc & 0xFF
+        return self._prefix(self._tx_slices, self._tx_view, length)
 
-    # CRC 檢查
-    payload_no_crc = packet[:-2]
-    received_crc = struct.unpack('!H', packet[-2:])[0]
-    calculated_crc = crc16_ccitt(payload_no_crc)
-    
-    if received_crc != calculated_crc:
-        return {"error": "CRC Mismatch"}
 
-    # 解析標頭
-    header_tuple = struct.unpack(header_format, payload_no_crc[:header_size])
-    
-    return {
-        "header_id": header_tuple[0],
-        "packet_length": header_tuple[1],
-        "sender_id": header_tuple[2], 
-        "receiver_id": header_tuple[3], 
-        "event_id": header_tuple[5],
-        "function_id": header_tuple[6],
-        "sub_function_id": header_tuple[7],
-        "data": packet[header_size:-2]
-    }
-    
 # --- 輔助函數：建構 ACK ---
 def create_ack_response(sender_id: bytes, receiver_id: bytes, func_id: int, sub_func_id: int, ack_code: int) -> bytes:
     """創建 F0 認可 (ACK) 封包"""
@@ -123,8 +617,157 @@ def create_ack_response(sender_id: bytes, receiver_id: bytes, func_id: int, sub_
         data=b''
     )
 
+# --- 輔助類別：連線 Session ---
+class TaiseiaSession:
+    """一條 TCP 連線的協定狀態。
+
+    每個 Session 擁有自己的事件序號 (1..0xFFFF 循環)、本端/對端 ID 與
+    網路重建、SA 轉傳流程狀態，不共用任何模組層級的可變狀態，
+    因此連線可以任意分散到不同 worker。
+    """
+    __slots__ = ('local_id', 'peer_id', 'mode', 'rebuild_step', '_event_id')
+
+    def __init__(self, local_id: bytes, peer_id: bytes, first_event_id: int = 1):
+        self.local_id = local_id # 本端 ID (封包中的發送端)
+        self.peer_id = peer_id   # 對端 ID (封包中的接收端)
+        # 0: 正常模式, 1: 處理網路重建, 2: 處理 SA 轉傳
+        self.mode = 0
+        self.rebuild_step = 0 # 網路重建流程狀態
+        self._event_id = first_event_id
+
+    def next_event_id(self) -> int:
+        event_id = self._event_id
+        self._event_id = event_id + 1 if event_id < MAX_EVENT_ID else 1
+        return event_id
+
+    def build(self, function_id: int, sub_function_id: int, data: bytes = b'',
+              group_id: int = 0xFF, event_id: int = None) -> bytes:
+        """以本 Session 的 ID 與事件序號建構封包"""
+        if event_id is None:
+            event_id = self.next_event_id()
+        return build_taiseia_packet(self.local_id, self.peer_id, group_id,
+                                    function_id, sub_function_id, data, event_id)
+
+    def ack(self, ack_code: int = ACK_OK, event_id: int = None) -> bytes:
+        """建構 F0 認可 (ACK) 封包"""
+        return self.build(0xF0, ack_code, event_id=event_id)
+
+
+# --- 輔助類別：RTT 估計與重送逾時 (RFC 6298) ---
+class RttEstimator:
+    """以 SRTT/RTTVAR 估計往返時間並計算重送逾時 (RTO)。
+
+    重送過的封包不取樣 (Karn 演算法)；每次逾時重送 RTO 加倍，直到下一個有效樣本。
+    """
+    __slots__ = ('srtt', 'rttvar', 'rto', 'min_rto', 'max_rto')
+
+    def __init__(self, initial_rto: float = 1.0, min_rto: float = 0.05, max_rto: float = 10.0):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = initial_rto
+        self.min_rto = min_rto # 區域網路的 RTT 遠小於 RFC 建議的 1 秒下限
+        self.max_rto = max_rto
+
+    def sample(self, rtt: float) -> None:
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(self.max_rto, max(self.min_rto, self.srtt + 4 * self.rttvar))
+
+    def backoff(self) -> None:
+        self.rto = min(self.max_rto, self.rto * 2)
+
+
+# --- 輔助函數：SA 狀態讀寫資料 ---
+# 04/01 請求：重複的 (裝置 ID H, 服務 ID B)；資料為空時讀取 SIMULATED_SA_STATUS 的屬性
+# (舊版固定回覆 3 bytes 的 01 01 02，現在同一筆狀態以 5 bytes 的紀錄格式回覆)
+# 04/01 回應與 04/02 請求：重複的 (裝置 ID H, 服務 ID B, 數值 H)
+SA_QUERY_STRUCT = struct.Struct('!HB')
+SA_RECORD_STRUCT = struct.Struct('!HBH')
+# 單一回應可容納的紀錄數 (回應封包不超過 MAX_FRAME_LENGTH)
+SA_MAX_RECORDS = (MAX_FRAME_LENGTH - MIN_PACKET_LENGTH) // SA_RECORD_STRUCT.size
+
+def encode_sa_query(attributes) -> bytes:
+    """[(device, service), ...] -> 04/01 請求資料"""
+    return b''.join(SA_QUERY_STRUCT.pack(device, service) for device, service in attributes)
+
+SA_DEFAULT_QUERY = encode_sa_query((device, service) for device, service, _ in SIMULATED_SA_STATUS)
+
+
+def encode_sa_records(records) -> bytes:
+    """[(device, service, value), ...] -> 04/02 請求資料"""
+    return b''.join(SA_RECORD_STRUCT.pack(device, service, value) for device, service, value in records)
+
+
+def parse_sa_records(data) -> list:
+    """04/01 回應資料 -> [(device, service, value), ...]"""
+    if len(data) % SA_RECORD_STRUCT.size:
+        raise FrameError(f"SA record data length {len(data)} is not a multiple of {SA_RECORD_STRUCT.size}")
+    return list(SA_RECORD_STRUCT.iter_unpack(data))
+
+
+# 04/00 請求 (訂閱條件)：重複的 (裝置 ID H, 服務 ID B)，資料為空時訂閱所有屬性；
+# 服務 ID 為 SA_ALL_SERVICES 時代表該裝置的所有服務
+SA_ALL_SERVICES = 0xFF
+# 04/03 請求：(epoch I, 版本 I)，資料為空時從頭讀取
+# 04/03 回應：(epoch I, 版本 I) + 該版本之後變更的 SA_RECORD_STRUCT 紀錄 (依變更順序)
+SA_DELTA_STRUCT = struct.Struct('!II')
+SA_DELTA_MAX_RECORDS = (MAX_FRAME_LENGTH - MIN_PACKET_LENGTH - SA_DELTA_STRUCT.size) // SA_RECORD_STRUCT.size
+
+def encode_sa_delta_request(epoch: int = 0, version: int = 0) -> bytes:
+    """上次 04/03 回應的 (epoch, 版本) -> 04/03 請求資料"""
+    return SA_DELTA_STRUCT.pack(epoch, version)
+
+
+def parse_sa_delta(data) -> tuple:
+    """04/03 回應資料 -> (epoch, 版本, [(device, service, value), ...])。
+
+    紀錄超過一個封包時只回傳較早的部分，版本為最後一筆紀錄的版本，以此版本再次請求即可
+    取得其餘變更；epoch 與上次不同表示 HNA 的狀態表已重新建立，回應內容為完整狀態。
+    """
+    if len(data) < SA_DELTA_STRUCT.size:
+        raise FrameError(f"SA delta data length {len(data)} is shorter than {SA_DELTA_STRUCT.size}")
+    epoch, version = SA_DELTA_STRUCT.unpack_from(data)
+    return epoch, version, parse_sa_records(data[SA_DELTA_STRUCT.size:])
+
+
+# --- 輔助函數：UDP 服務發現回覆 ---
+def encode_discovery_reply(ip: str, port: int, binary: bool = False) -> bytes:
+    """編碼服務發現回覆：JSON (預設) 或 10 bytes 的二進位格式"""
+    if binary:
+        import socket
+        return DISCOVERY_BINARY_STRUCT.pack(DISCOVERY_BINARY_MAGIC, socket.inet_aton(ip), port)
+    import json
+    return json.dumps({
+        "type": "discovery",
+        "ip": ip,
+        "port": port,
+        "protocol": "TaiSEIA 101"
+    }).encode()
+
+
+def parse_discovery_reply(data: bytes):
+    """解析服務發現回覆 (JSON 或二進位)，回傳 (ip, port)；格式不符時回傳 None"""
+    if len(data) == DISCOVERY_BINARY_STRUCT.size and data.startswith(DISCOVERY_BINARY_MAGIC):
+        import socket
+        _, ip, port = DISCOVERY_BINARY_STRUCT.unpack(data)
+        return socket.inet_ntoa(ip), port
+    import json
+    try:
+        response = json.loads(data.decode())
+    except ValueError:
+        return None
+    if isinstance(response, dict) and response.get('type') == 'discovery':
+        return response.get('ip'), response.get('port')
+    return None
+
+
 # --- 輔助函數：獲取 IP ---
 def get_server_ip():
+    import socket
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     try:
         s.connect(('8.8.8.8', 80))
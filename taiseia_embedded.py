@@ -0,0 +1,249 @@
+# taiseia_embedded.py
+# 嵌入式設定的 HNA 伺服器迴圈 (ESP32/MicroPython 移植的參考實作)
+#
+# 不使用 asyncio：以阻塞式 socket 一次服務一個 HC，收送都在 FrameBuffer 預先配置的
+# rx/tx 緩衝區內完成，回覆資料為常數或就地更新的 bytearray，穩定狀態下處理一個封包
+# 不會留下任何配置 (以 python taiseia_microbench.py --embedded 檢查記憶體預算)。
+# 只依賴 taiseia_common，socket 在 serve() 中才載入。
+#
+# 與 taiseia_server 的差異：SA 狀態表為固定容量、不推送狀態變更 (04/00 只回 ACK，忽略訂閱條件)、
+# 不支援版本化的變更讀取 (04/03)、SA 轉傳的通知與報告連續送出而不等待 HC 的 ACK、
+# 沒有快速恢復與重送。
+#
+#   python taiseia_embedded.py [--port 50001]
+import struct
+import time
+
+from taiseia_common import *
+
+# 網路重建：HNA 依序送出 (F, SF, 資料)，等待 HC 以相同事件序號回覆的 F
+REBUILD_STEPS = (
+    (0x01, 0x00, b'', 0xF0),     # 上線通知 (回覆的 ACK 帶有 HC 的 ID)
+    (0x01, 0x01, b'', 0xF1),     # 讀取 ID
+    (0x05, 0x04, b'\x00', 0xF0), # 報告，HC ACK 後進入正常模式
+)
+
+# 正常模式中固定內容的回覆：F << 8 | SF -> (回覆 F, 回覆 SF, 資料)
+FIXED_REPLIES = {
+    0x0101: (0xF1, 0x00, ALL_ID_DATA),
+    0x0300: (0xF0, ACK_OK, b''),
+    0x0302: (0xF1, 0x00, HNA_SUPPORT_CAPABILITY),
+    0x0400: (0xF0, ACK_OK, b''), # 只接受訂閱，不推送狀態變更
+}
+
+RTC_STRUCT = struct.Struct('!BBBBBBB')
+STATUS_CAPACITY = 16 # SA 狀態表最多幾個 (裝置, 服務)
+
+
+class EmbeddedHNA:
+    """單一 HC 連線的 HNA 協定處理；緩衝區與狀態表在建立時配置，之後每條連線重複使用"""
+    __slots__ = ('buf', 'send', 'local_id', 'peer_id', 'event_id', 'step', 'awaiting', 'frames',
+                 'status', 'status_count', 'reply', 'rtc', '_status_views', '_reply_views')
+
+    def __init__(self, size: int = EMBEDDED_FRAME_SIZE, status=SIMULATED_SA_STATUS,
+                 capacity: int = STATUS_CAPACITY):
+        self.buf = FrameBuffer(size)
+        self.send = None
+        self.local_id = RECEIVER_ID
+        self.peer_id = bytearray(SENDER_ID) # 收到上線通知的 ACK 後改為該 HC 的 ID
+        self.event_id = 0
+        self.step = -1     # 網路重建步驟；-1 表示正常模式
+        self.awaiting = 0  # 網路重建中等待回覆的事件序號
+        self.frames = 0
+        record = SA_RECORD_STRUCT.size
+        self.status = bytearray(capacity * record) # (裝置, 服務, 數值) 紀錄，04/02 就地更新
+        self.status_count = 0
+        self.reply = bytearray(capacity * record)  # 04/01 指定查詢的回覆資料
+        self.rtc = bytearray(RTC_STRUCT.size)
+        self._status_views = {} # 長度 -> memoryview (狀態表與查詢回覆各自快取)
+        self._reply_views = {}
+        for device, service, value in status:
+            SA_RECORD_STRUCT.pack_into(self.status, self.status_count * record, device, service, value)
+            self.status_count += 1
+
+    @staticmethod
+    def _view(cache: dict, buffer: bytearray, length: int) -> memoryview:
+        view = cache.get(length)
+        if view is None:
+            view = cache[length] = memoryview(buffer)[:length]
+        return view
+
+    def start(self, send) -> None:
+        """新連線：清空緩衝區並開始網路重建。
+
+        send(memoryview) 必須在返回前送出 (或複製) 資料，例如 sock.sendall；
+        下一次送出會覆寫同一個 tx 緩衝區。
+        """
+        self.send = send
+        self.buf.rx_used = 0
+        self.peer_id[:] = SENDER_ID
+        self.step = 0
+        self._send_step()
+
+    def _next_event_id(self) -> int:
+        self.event_id = self.event_id + 1 if self.event_id < MAX_EVENT_ID else 1
+        return self.event_id
+
+    def _send(self, function_id: int, sub_function_id: int, data, event_id: int) -> None:
+        self.send(self.buf.encode(self.local_id, self.peer_id, function_id, sub_function_id, data, event_id))
+
+    def _send_step(self) -> None:
+        function_id, sub_function_id, data, _ = REBUILD_STEPS[self.step]
+        self.awaiting = self._next_event_id()
+        self._send(function_id, sub_function_id, data, self.awaiting)
+
+    def process(self) -> None:
+        """處理 rx 中所有完整的封包"""
+        buf = self.buf
+        while True:
+            try:
+                if not buf.next_frame():
+                    return
+            except CrcMismatchError:
+                self._send(0xF0, ACK_CRC_ERROR, b'', buf.event_id) # 已丟棄該 0x13，繼續重新同步
+                continue
+            self.frames += 1
+            if self.step >= 0:
+                self._rebuild()
+            else:
+                self._dispatch()
+            buf.consume()
+
+    def _rebuild(self) -> None:
+        buf = self.buf
+        if buf.event_id != self.awaiting or buf.function_id != REBUILD_STEPS[self.step][3]:
+            return # 網路重建期間其餘封包一律丟棄
+        if self.step == 0:
+            self.peer_id[:] = buf.rx[3:9] # 之後的封包都送往此 HC
+        self.step += 1
+        if self.step < len(REBUILD_STEPS):
+            self._send_step()
+        else:
+            self.step = -1
+
+    def _dispatch(self) -> None:
+        buf = self.buf
+        function_id = buf.function_id
+        if function_id == 0xF0 or function_id == 0xF1:
+            return # HC 的 ACK/回應不需回覆
+        event_id = buf.event_id
+        code = function_id << 8 | buf.sub_function_id
+        reply = FIXED_REPLIES.get(code)
+        if reply is not None:
+            self._send(reply[0], reply[1], reply[2], event_id)
+        elif code == 0x0401:
+            length = self._read_status()
+            if length < 0:
+                self._send(0xF0, ACK_UNSUPPORTED, b'', event_id)
+            elif length == 0: # 未指定查詢：回覆整個狀態表
+                table = self._view(self._status_views, self.status, self.status_count * SA_RECORD_STRUCT.size)
+                self._send(0xF1, 0x00, table, event_id)
+            else:
+                self._send(0xF1, 0x00, self._view(self._reply_views, self.reply, length), event_id)
+        elif code == 0x0402:
+            self._send(0xF0, ACK_OK if self._write_status() else ACK_UNSUPPORTED, b'', event_id)
+        elif code == 0x0006:
+            now = time.localtime()
+            RTC_STRUCT.pack_into(self.rtc, 0, now[0] % 100, now[1], now[2], now[3], now[4], now[5], now[6])
+            self._send(0xF1, 0x00, self.rtc, event_id)
+        elif code == 0x0501:
+            # SA 管理/轉傳：ACK 後連續送出通知與報告
+            self._send(0xF0, ACK_OK, b'', event_id)
+            self._send(0x05, 0x05, SA_NOTIFICATION_DATA, self._next_event_id())
+            self._send(0x05, 0x04, SA_REPORT_DATA, self._next_event_id())
+        else:
+            self._send(0xF0, ACK_UNSUPPORTED, b'', event_id)
+
+    def _find(self, data, offset: int) -> int:
+        """data[offset:] 的 (裝置, 服務) 在狀態表中的位移；沒有時回傳 -1"""
+        status = self.status
+        for index in range(0, self.status_count * SA_RECORD_STRUCT.size, SA_RECORD_STRUCT.size):
+            if status[index] == data[offset] and status[index + 1] == data[offset + 1] \
+                    and status[index + 2] == data[offset + 2]:
+                return index
+        return -1
+
+    def _read_status(self) -> int:
+        """04/01：把查詢的紀錄寫入 reply 並回傳長度 (未指定查詢時回傳 0，無效時回傳 -1)"""
+        data = self.buf.data()
+        stride = SA_QUERY_STRUCT.size
+        size = SA_RECORD_STRUCT.size
+        if len(data) % stride or len(data) // stride * size > len(self.reply):
+            return -1
+        reply = self.reply
+        length = 0
+        for offset in range(0, len(data), stride):
+            index = self._find(data, offset)
+            if index < 0:
+                return -1
+            reply[length:length + size] = self.status[index:index + size]
+            length += size
+        return length
+
+    def _write_status(self) -> bool:
+        """04/02：更新 (或新增) 狀態表中的紀錄；資料無效或超過容量時不做任何變更"""
+        data = self.buf.data()
+        size = SA_RECORD_STRUCT.size
+        if not data or len(data) % size:
+            return False
+        added = 0
+        for offset in range(0, len(data), size):
+            if self._find(data, offset) < 0:
+                added += 1
+        if (self.status_count + added) * size > len(self.status):
+            return False
+        status = self.status
+        for offset in range(0, len(data), size):
+            index = self._find(data, offset)
+            if index < 0:
+                index = self.status_count * size
+                status[index] = data[offset]
+                status[index + 1] = data[offset + 1]
+                status[index + 2] = data[offset + 2]
+                self.status_count += 1
+            status[index + 3] = data[offset + 3]
+            status[index + 4] = data[offset + 4]
+        return True
+
+
+def serve(host: str = '0.0.0.0', port: int = TCP_SERVICE_PORT, size: int = EMBEDDED_FRAME_SIZE) -> None:
+    """阻塞式伺服器：一次服務一個 HC 連線"""
+    import socket
+    hna = EmbeddedHNA(size)
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen(1)
+    print(f"*** Embedded TaiSEIA 101 HNA serving on {host}:{port} (rx/tx {size} bytes) ***")
+    try:
+        while True:
+            conn, addr = listener.accept()
+            print(f"[TCP] Connection established from {addr}")
+            try:
+                hna.start(conn.sendall)
+                while True:
+                    count = conn.recv_into(hna.buf.rx_space())
+                    if not count:
+                        break
+                    hna.buf.received(count)
+                    hna.process()
+            except OSError as e:
+                print(f"[TCP] Connection error: {e}")
+            finally:
+                conn.close()
+                print(f"[TCP] Closing connection with {addr}")
+    finally:
+        listener.close()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="TaiSEIA 101 HNA server (embedded profile)")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=TCP_SERVICE_PORT)
+    parser.add_argument('--buffer-size', type=int, default=EMBEDDED_FRAME_SIZE, help="rx/tx 緩衝區大小 (bytes)")
+    args = parser.parse_args()
+    try:
+        serve(args.host, args.port, args.buffer_size)
+    except KeyboardInterrupt:
+        print("Server process interrupted by user.")
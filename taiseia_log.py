@@ -0,0 +1,87 @@
+# taiseia_log.py
+# 伺服器/客戶端共用的紀錄設定與單一連線封包追蹤
+#
+# 各模組以 logging.getLogger('taiseia.xxx') 取得 logger，訊息參數採 % 格式延遲展開，
+# 未啟用的等級只做一次等級比對，不會格式化字串。setup_logging() 讓 event loop 只把
+# 紀錄放進佇列，實際寫入 stdout 由背景執行緒 (QueueListener) 負責。
+#
+# FrameTrace 把一條連線收發的每個封包寫成 JSONL 或精簡的二進位紀錄：
+#   JSONL : {"t": 時間, "dir": "in"/"out", "f": F, "sf": SF, "eid": 事件序號, "len": 長度, "raw": hex}
+#   二進位: TRACE_RECORD (時間 d, 方向 B (0=in, 1=out), 長度 H) 之後接原始封包
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import struct
+import sys
+import time
+
+from taiseia_common import EVENT_ID_STRUCT, EVENT_ID_OFFSET
+
+LOG = logging.getLogger('taiseia')
+LOG.addHandler(logging.NullHandler()) # 未呼叫 setup_logging 時不輸出
+
+LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR')
+
+_listener = None
+
+
+def _stop_listener() -> None:
+    """停止目前的輸出執行緒並送出佇列中剩餘的紀錄 (已停止或未啟動時不做事)"""
+    if _listener is not None and _listener._thread is not None and _listener._thread.is_alive():
+        _listener.stop()
+
+
+atexit.register(_stop_listener) # 只註冊一次，結束時停止最後一次 setup_logging 建立的執行緒
+
+
+def setup_logging(level=logging.INFO, stream=None, fmt: str = '%(message)s') -> logging.handlers.QueueListener:
+    """設定 taiseia.* 的輸出：QueueHandler 放入佇列，由 QueueListener 執行緒寫入 stream。
+
+    可重複呼叫 (例如 fork 出的 worker 重新建立自己的輸出執行緒)。
+    """
+    global _listener
+    for handler in list(LOG.handlers):
+        if isinstance(handler, logging.handlers.QueueHandler):
+            LOG.removeHandler(handler)
+    _stop_listener()
+
+    records = queue.SimpleQueue()
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(logging.Formatter(fmt))
+    _listener = logging.handlers.QueueListener(records, output)
+    _listener.start()
+    LOG.addHandler(logging.handlers.QueueHandler(records))
+    LOG.setLevel(level)
+    LOG.propagate = False
+    return _listener
+
+
+class FrameTrace:
+    """單一連線的封包追蹤檔 (以附加模式開啟，多條連線可依序寫入同一個檔案)"""
+    TRACE_RECORD = struct.Struct('!dBH')
+    __slots__ = ('path', 'binary', 'label', '_file')
+
+    def __init__(self, path: str, binary: bool = False, label: str = ''):
+        self.path = path
+        self.binary = binary
+        self.label = label # 寫入 JSONL 的連線標示 (對端位址)
+        self._file = open(path, 'ab' if binary else 'a')
+
+    def record(self, direction: str, packet) -> None:
+        """direction: 'in' (收到) 或 'out' (送出)"""
+        if self.binary:
+            self._file.write(self.TRACE_RECORD.pack(time.time(), direction == 'out', len(packet)))
+            self._file.write(packet)
+            return
+        entry = {"t": round(time.time(), 6), "conn": self.label, "dir": direction, "len": len(packet)}
+        if len(packet) >= EVENT_ID_OFFSET + 4:
+            entry["f"] = packet[EVENT_ID_OFFSET + 2]
+            entry["sf"] = packet[EVENT_ID_OFFSET + 3]
+            entry["eid"] = EVENT_ID_STRUCT.unpack_from(packet, EVENT_ID_OFFSET)[0]
+        entry["raw"] = bytes(packet).hex()
+        self._file.write(json.dumps(entry) + '\n')
+
+    def close(self) -> None:
+        self._file.close()
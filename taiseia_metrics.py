@@ -0,0 +1,176 @@
+# taiseia_metrics.py
+# HNA 伺服器的功能碼層級量測與 Prometheus 文字格式輸出
+#
+# Metrics 以 (F << 8 | SF) 整數為 key 的 dict 記錄每個功能碼的收發封包數與位元組數、
+# 處理函式延遲與網路重建/SA 轉傳流程完成時間 (固定邊界的直方圖，記錄一次只需
+# bisect 與兩次加法)，因此可以在正式環境常駐開啟。
+#
+#   python taiseia_server.py --metrics-port 9108
+#   curl http://127.0.0.1:9108/metrics
+import asyncio
+import json
+import logging
+from bisect import bisect_left
+
+log = logging.getLogger('taiseia.metrics')
+
+# 延遲直方圖的上界 (秒)
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25)
+FLOW_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Histogram:
+    """固定邊界的累計直方圖 (輸出時才轉成 Prometheus 的累加 bucket)"""
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1) # 最後一格為 +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self) -> dict:
+        buckets, total = {}, 0
+        for bound, count in zip(self.bounds, self.counts):
+            total += count
+            buckets[repr(bound)] = total
+        buckets['+Inf'] = self.count
+        return {"count": self.count, "sum": round(self.sum, 6), "buckets": buckets}
+
+
+def _code(code: int) -> str:
+    return f"{code >> 8:02X}/{code & 0xFF:02X}"
+
+
+class Metrics:
+    """伺服器量測值；key 為 function_id << 8 | sub_function_id"""
+
+    def __init__(self):
+        self.traffic_in = {}      # code -> [封包數, 位元組數]
+        self.traffic_out = {}
+        self.handler_latency = {} # code -> Histogram
+        self.flow_duration = {}   # 'rebuild' / 'relay' -> Histogram
+
+    def frame_in(self, code: int, length: int) -> None:
+        entry = self.traffic_in.get(code)
+        if entry is None:
+            entry = self.traffic_in[code] = [0, 0]
+        entry[0] += 1
+        entry[1] += length
+
+    def frame_out(self, packet) -> None:
+        code = packet[18] << 8 | packet[19] # F、SF 位於事件序號之後
+        entry = self.traffic_out.get(code)
+        if entry is None:
+            entry = self.traffic_out[code] = [0, 0]
+        entry[0] += 1
+        entry[1] += len(packet)
+
+    def observe_handler(self, code: int, seconds: float) -> None:
+        histogram = self.handler_latency.get(code)
+        if histogram is None:
+            histogram = self.handler_latency[code] = Histogram()
+        histogram.observe(seconds)
+
+    def observe_flow(self, flow: str, seconds: float) -> None:
+        histogram = self.flow_duration.get(flow)
+        if histogram is None:
+            histogram = self.flow_duration[flow] = Histogram(FLOW_BUCKETS)
+        histogram.observe(seconds)
+
+    def snapshot(self) -> dict:
+        """目前所有量測值 (功能碼以 'FF/SS' 字串表示)"""
+        return {
+            "frames_in": {_code(k): v[0] for k, v in sorted(self.traffic_in.items())},
+            "bytes_in": {_code(k): v[1] for k, v in sorted(self.traffic_in.items())},
+            "frames_out": {_code(k): v[0] for k, v in sorted(self.traffic_out.items())},
+            "bytes_out": {_code(k): v[1] for k, v in sorted(self.traffic_out.items())},
+            "handler_latency": {_code(k): h.snapshot() for k, h in sorted(self.handler_latency.items())},
+            "flow_duration": {k: h.snapshot() for k, h in sorted(self.flow_duration.items())},
+        }
+
+
+def render_prometheus(metrics: Metrics, stats: dict = None, gauges=()) -> str:
+    """以 Prometheus 文字格式 (0.0.4) 輸出；stats 為 ServerStats.snapshot()，gauges 中的欄位輸出為 gauge"""
+    lines = []
+
+    def family(name, kind, help_text):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+
+    def labels(code):
+        return f'function="{code >> 8:02X}",sub_function="{code & 0xFF:02X}"'
+
+    for name, traffic, index, help_text in (
+        ('taiseia_frames_in_total', metrics.traffic_in, 0, "Frames received per function code"),
+        ('taiseia_bytes_in_total', metrics.traffic_in, 1, "Bytes received per function code"),
+        ('taiseia_frames_out_total', metrics.traffic_out, 0, "Frames sent per function code"),
+        ('taiseia_bytes_out_total', metrics.traffic_out, 1, "Bytes sent per function code"),
+    ):
+        family(name, 'counter', help_text)
+        for code, entry in sorted(traffic.items()):
+            lines.append(f"{name}{{{labels(code)}}} {entry[index]}")
+
+    def histogram(name, label, hist):
+        total = 0
+        for bound, count in zip(hist.bounds, hist.counts):
+            total += count
+            lines.append(f'{name}_bucket{{{label},le="{bound!r}"}} {total}')
+        lines.append(f'{name}_bucket{{{label},le="+Inf"}} {hist.count}')
+        lines.append(f"{name}_sum{{{label}}} {hist.sum!r}")
+        lines.append(f"{name}_count{{{label}}} {hist.count}")
+
+    family('taiseia_handler_latency_seconds', 'histogram', "Handler latency per function code")
+    for code, hist in sorted(metrics.handler_latency.items()):
+        histogram('taiseia_handler_latency_seconds', labels(code), hist)
+    family('taiseia_flow_duration_seconds', 'histogram', "Rebuild/relay flow completion time")
+    for flow, hist in sorted(metrics.flow_duration.items()):
+        histogram('taiseia_flow_duration_seconds', f'flow="{flow}"', hist)
+
+    for field, value in (stats or {}).items():
+        if field in gauges:
+            family(f"taiseia_{field}", 'gauge', field.replace('_', ' '))
+            lines.append(f"taiseia_{field} {value}")
+        else:
+            name = f"taiseia_{field}" if field.endswith('_total') else f"taiseia_{field}_total"
+            family(name, 'counter', field.replace('_', ' '))
+            lines.append(f"{name} {value}")
+    return '\n'.join(lines) + '\n'
+
+
+async def start_metrics_server(render_text, render_json, host: str = '127.0.0.1', port: int = 9108):
+    """啟動只處理 GET 的小型 HTTP 服務：/metrics (Prometheus 文字) 與 /metrics.json (snapshot)"""
+
+    async def handle(reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 5.0)
+            while (await asyncio.wait_for(reader.readline(), 5.0)) not in (b'\r\n', b'\n', b''):
+                pass # 略過標頭
+            parts = request.split()
+            path = parts[1].decode() if len(parts) >= 2 else ''
+            if parts and parts[0] != b'GET':
+                status, content_type, body = '405 Method Not Allowed', 'text/plain', b'method not allowed\n'
+            elif path == '/metrics':
+                status, content_type = '200 OK', 'text/plain; version=0.0.4; charset=utf-8'
+                body = render_text().encode()
+            elif path == '/metrics.json':
+                status, content_type = '200 OK', 'application/json'
+                body = json.dumps(render_json()).encode()
+            else:
+                status, content_type, body = '404 Not Found', 'text/plain', b'not found\n'
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError, OSError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    log.info("[HTTP] Metrics endpoint on http://%s:%d/metrics", host, server.sockets[0].getsockname()[1])
+    return server
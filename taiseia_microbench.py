@@ -0,0 +1,253 @@
+# taiseia_microbench.py
+# taiseia_common 編解碼基本函式的微基準測試
+#
+# 量測 crc16_ccitt、build_taiseia_packet、parse_taiseia_response、Frame.decode、
+# create_ack_response 與 FrameTemplate.render 在不同資料長度 (0 B、14 B ID 資料、256 B、4 KB)
+# 下的每次呼叫時間，並以 tracemalloc 量測每次呼叫的配置量。
+#
+#   python taiseia_microbench.py --save-baseline base.json      # 記錄基準
+#   python taiseia_microbench.py --baseline base.json -t 0.15   # 比較，退步超過 15% 時 exit 1
+#   python taiseia_microbench.py --embedded                     # 嵌入式設定的記憶體預算，超過時 exit 1
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import timeit
+import tracemalloc
+
+from taiseia_common import *
+
+PAYLOAD_SIZES = {
+    '0B': b'',
+    '14B': ALL_ID_DATA,
+    '256B': bytes(range(256)),
+    '4KB': bytes(range(256)) * 16,
+}
+
+
+def make_cases(sizes=PAYLOAD_SIZES) -> dict:
+    """建立 {名稱: 無參數函式} 的測試項目"""
+    cases = {}
+    for label, data in sizes.items():
+        packet = build_taiseia_packet(SENDER_ID, RECEIVER_ID, 0xFF, 0xF1, 0x00, data, event_id=1)
+        body = packet[:-CRC_LENGTH]
+        template = FrameTemplate(SENDER_ID, RECEIVER_ID, 0xFF, 0xF1, 0x00, data)
+        cases[f'crc16_ccitt/{label}'] = lambda body=body: crc16_ccitt(body)
+        cases[f'crc16_ccitt_table/{label}'] = lambda body=body: crc16_ccitt_table(body)
+        cases[f'build_taiseia_packet/{label}'] = (
+            lambda data=data: build_taiseia_packet(SENDER_ID, RECEIVER_ID, 0xFF, 0xF1, 0x00, data, event_id=1))
+        cases[f'template.render/{label}'] = lambda template=template: template.render(1)
+        cases[f'parse_taiseia_response/{label}'] = lambda packet=packet: parse_taiseia_response(packet)
+        cases[f'Frame.decode/{label}'] = lambda packet=packet: Frame.decode(packet)
+    cases['create_ack_response'] = lambda: create_ack_response(SENDER_ID, RECEIVER_ID, 0x03, 0x00, ACK_OK)
+    return cases
+
+
+# 嵌入式設定 (taiseia_embedded) 的記憶體預算，供 MicroPython 移植對照
+EMBEDDED_RETAINED_BUDGET = 0.0 # 穩定狀態下每個封包留下的 bytes
+EMBEDDED_PEAK_BUDGET = 1024    # 處理過程中暫時配置的高峰 (bytes，不含預先配置的緩衝區)
+EMBEDDED_LAZY_MODULES = ('asyncio', 'json', 'socket') # 載入 taiseia_embedded 時不應載入的模組
+
+
+def embedded_requests() -> list:
+    """嵌入式迴圈穩定狀態的請求組合 (HC -> HNA 封包)"""
+    requests = [
+        (0x03, 0x00, b''),
+        (0x03, 0x02, b''),
+        (0x04, 0x01, b''),
+        (0x04, 0x01, encode_sa_query([(1, 1)])),
+        (0x04, 0x02, encode_sa_records([(1, 1, 1)])),
+        (0x05, 0x01, b'\x01\x00\x01'),
+        (0xF0, ACK_OK, b''),
+        (0x00, 0x06, b''),
+        (0x0E, 0x00, b''), # 不支援的功能碼
+    ]
+    return [build_taiseia_packet(SENDER_ID, RECEIVER_ID, 0xFF, f, sf, data, event_id=1000 + i)
+            for i, (f, sf, data) in enumerate(requests)]
+
+
+def _feed(hna, packet) -> None:
+    """模擬 recv_into：把封包放進 rx 並處理"""
+    buf = hna.buf
+    used = buf.rx_used
+    buf.rx[used:used + len(packet)] = packet
+    buf.received(len(packet))
+    hna.process()
+
+
+def measure_embedded(frames: int = 20000) -> dict:
+    """以 tracemalloc 量測嵌入式迴圈每個封包留下的配置量與暫時配置的高峰"""
+    from taiseia_embedded import EmbeddedHNA
+    sent = [0]
+
+    def send(view):
+        sent[0] += 1
+
+    hna = EmbeddedHNA()
+    hna.start(send)
+    # 完成網路重建：依序回覆上線通知 (ACK)、讀取 ID (F1/00) 與報告 (ACK)
+    for event_id, (f, sf, data) in enumerate(((0xF0, ACK_OK, b''), (0xF1, 0x00, ALL_ID_DATA),
+                                              (0xF0, ACK_OK, b'')), 1):
+        _feed(hna, build_taiseia_packet(SENDER_ID, RECEIVER_ID, 0xFF, f, sf, data, event_id=event_id))
+    assert hna.step < 0, "embedded rebuild did not complete"
+
+    requests = embedded_requests()
+    count = len(requests)
+    for packet in requests * 4: # 暖身：建立 memoryview 快取
+        _feed(hna, packet)
+    tracemalloc.start()
+    try:
+        base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        # 分兩段量測：每個封包留下的量以兩段之間的增加計算，排除量測本身的少量固定配置
+        for half in (0, 1):
+            for i in range(frames // 2):
+                _feed(hna, requests[i % count])
+            if half == 0:
+                middle = tracemalloc.get_traced_memory()[0]
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    # 另開直譯器量測載入後保留的記憶體，並確認延遲載入的模組沒有被載入
+    probe = ("import sys, tracemalloc; tracemalloc.start(); import taiseia_embedded; "
+             "print(tracemalloc.get_traced_memory()[0]); "
+             f"print(','.join(m for m in {EMBEDDED_LAZY_MODULES!r} if m in sys.modules))")
+    output = subprocess.run([sys.executable, '-c', probe], capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.split('\n')
+    buf = hna.buf
+    return {
+        "frames": frames,
+        "replies": sent[0],
+        "retained_bytes_per_frame": round((current - middle) / (frames // 2), 3),
+        "peak_bytes": peak - base,
+        "buffer_bytes": len(buf.rx) + len(buf.tx) + len(hna.status) + len(hna.reply),
+        "import_bytes": int(output[0]),
+        "lazy_modules_loaded": [m for m in output[1].split(',') if m],
+    }
+
+
+def check_embedded(result: dict) -> list:
+    """回傳超出預算的項目說明"""
+    failures = []
+    if result["retained_bytes_per_frame"] > EMBEDDED_RETAINED_BUDGET:
+        failures.append(f"retained {result['retained_bytes_per_frame']} B/frame > {EMBEDDED_RETAINED_BUDGET}")
+    if result["peak_bytes"] > EMBEDDED_PEAK_BUDGET:
+        failures.append(f"peak {result['peak_bytes']} B > {EMBEDDED_PEAK_BUDGET}")
+    if result["lazy_modules_loaded"]:
+        failures.append(f"modules loaded at import: {', '.join(result['lazy_modules_loaded'])}")
+    return failures
+
+
+def time_call(func, repeat: int = 5, min_time_ns: int = 50_000_000) -> float:
+    """回傳每次呼叫的最短時間 (ns)"""
+    timer = timeit.Timer(func, timer=time.perf_counter_ns)
+    number = 1
+    while timer.timeit(number) < min_time_ns // 10:
+        number *= 2
+    return min(timer.repeat(repeat, number)) / number
+
+
+def measure_allocations(func, calls: int = 1000) -> tuple:
+    """回傳 (單次呼叫的配置高峰 bytes, 每次呼叫保留下來的記憶體區塊數)"""
+    func() # 先暖身，排除首次呼叫的快取建立
+    results = [None] * calls
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        results[0] = func()
+        peak = tracemalloc.get_traced_memory()[1] - base
+        for i in range(1, calls):
+            results[i] = func()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    trace_filter = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    stats = after.filter_traces(trace_filter).compare_to(before.filter_traces(trace_filter), 'filename')
+    blocks = sum(stat.count_diff for stat in stats)
+    return peak, round(blocks / calls, 2)
+
+
+def run(cases: dict, repeat: int = 5, allocations: bool = True) -> dict:
+    results = {}
+    for name, func in cases.items():
+        entry = {"ns_per_call": round(time_call(func, repeat), 1)}
+        if allocations:
+            entry["peak_bytes"], entry["blocks_per_call"] = measure_allocations(func)
+        results[name] = entry
+    return results
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """回傳退步超過 threshold (比例) 的項目清單 [(名稱, 基準 ns, 目前 ns)]"""
+    regressions = []
+    for name, entry in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        entry["baseline_ns"] = base["ns_per_call"]
+        entry["change"] = round(entry["ns_per_call"] / base["ns_per_call"] - 1, 3)
+        if entry["change"] > threshold:
+            regressions.append((name, base["ns_per_call"], entry["ns_per_call"]))
+    return regressions
+
+
+def print_table(results: dict) -> None:
+    print(f"{'case':<34}{'ns/call':>12}{'baseline':>12}{'change':>9}{'peak B':>9}{'blocks':>8}")
+    for name, entry in results.items():
+        baseline = entry.get("baseline_ns", "")
+        change = f"{entry['change']:+.1%}" if "change" in entry else ""
+        print(f"{name:<34}{entry['ns_per_call']:>12}{baseline:>12}{change:>9}"
+              f"{entry.get('peak_bytes', ''):>9}{entry.get('blocks_per_call', ''):>8}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="taiseia_common codec microbenchmarks")
+    parser.add_argument('-k', '--filter', default='', help="只執行名稱包含此字串的項目")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--no-alloc', action='store_true', help="略過 tracemalloc 配置量測")
+    parser.add_argument('--save-baseline', metavar='PATH', help="把結果存成基準檔")
+    parser.add_argument('--baseline', metavar='PATH', help="與基準檔比較")
+    parser.add_argument('-t', '--threshold', type=float, default=0.10, help="允許的退步比例 (預設 0.10)")
+    parser.add_argument('--embedded', action='store_true',
+                        help="改為檢查嵌入式設定的記憶體預算 (tracemalloc)")
+    parser.add_argument('--embedded-frames', type=int, default=20000)
+    args = parser.parse_args(argv)
+
+    if args.embedded:
+        result = measure_embedded(args.embedded_frames)
+        print(json.dumps(result, indent=2))
+        failures = check_embedded(result)
+        if failures:
+            print(f"\n❌ 嵌入式設定超出記憶體預算: {'; '.join(failures)}")
+            return 1
+        print(f"\n✅ 嵌入式設定符合記憶體預算 (每個封包留下 ≤ {EMBEDDED_RETAINED_BUDGET} B，"
+              f"高峰 ≤ {EMBEDDED_PEAK_BUDGET} B)")
+        return 0
+
+    cases = {name: func for name, func in make_cases().items() if args.filter in name}
+    results = run(cases, args.repeat, not args.no_alloc)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+    print_table(results)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+    if regressions:
+        print(f"\n❌ {len(regressions)} 個項目退步超過 {args.threshold:.0%}:")
+        for name, base, now in regressions:
+            print(f"  {name}: {base} ns -> {now} ns")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
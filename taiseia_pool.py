@@ -0,0 +1,361 @@
+# taiseia_pool.py
+# HC 端的多 HNA 連線池
+#
+# 一個 HC 以同一個 HC ID 維持到多個 HNA 的常駐連線 (由服務發現或手動加入)：
+# - 每個 HNA 只在連線建立時走一次網路重建，之後的請求都沿用同一條連線
+#   (TaiseiaClient 支援同時送出多個請求)；重新連線時以快速恢復略過讀取 ID。
+# - 斷線或連線失敗後以指數退避加上隨機抖動重新連線，避免大量 HNA 同時重連。
+# - 定期以 00/06 (讀取 RTC) 做健康檢查，連續逾時即中斷並重新連線。
+# - 批次操作 (例如對所有 HNA 讀取 04/01) 直接寫入各連線，不為每個 HNA 建立 task，
+#   同時等待回應的數量有上限；HNA 數量不超過上限時整體時間約為最慢的一個 HNA 的
+#   回應時間，HC 端每個 HNA 只多一次封包編碼與一個回呼。
+# - 變更掃描 (04/03) 記住每個 HNA 上次回應的版本，只取回之後變更的屬性，
+#   穩定狀態下的流量與處理時間取決於變更頻率而不是裝置數。
+#
+#   python taiseia_pool.py --discover 255.255.255.255 --scan-interval 5 [--delta]
+#   python taiseia_pool.py --hna 192.168.1.20:50001 --hna 192.168.1.21:50001
+import argparse
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+
+from taiseia_common import *
+from taiseia_client import TaiseiaClient, discover_hnas
+
+log = logging.getLogger('taiseia.pool')
+
+REQUEST_ERRORS = (asyncio.TimeoutError, ConnectionError, OSError)
+
+
+class PoolMember:
+    """連線池中的一個 HNA"""
+    __slots__ = ('host', 'port', 'client', 'state', 'ready', 'failures', 'misses', 'connects',
+                 'last_ok', 'last_error', 'task', 'sa_version')
+
+    STATES = ('connecting', 'ready', 'backoff', 'closed')
+
+    def __init__(self, host: str, port: int, client: TaiseiaClient):
+        self.host = host
+        self.port = port
+        self.client = client
+        self.state = 'connecting'
+        self.ready = asyncio.Event() # 已完成網路重建且連線中
+        self.failures = 0   # 連續連線失敗次數 (決定退避時間)
+        self.misses = 0     # 連續健康檢查逾時次數
+        self.connects = 0   # 成功建立連線的次數
+        self.last_ok = 0.0  # 最後一次健康檢查成功的時間 (time.monotonic)
+        self.last_error = None
+        self.task = None
+        self.sa_version = (0, 0) # 上次 04/03 回應的 (epoch, 版本)
+
+    @property
+    def key(self) -> tuple:
+        return self.host, self.port
+
+    def snapshot(self) -> dict:
+        return {"state": self.state, "connects": self.connects, "failures": self.failures,
+                "misses": self.misses, "last_error": self.last_error}
+
+
+class TaiseiaPool:
+    """多個 HNA 的常駐連線池：自動重連、健康檢查與限制並行數的批次請求"""
+
+    def __init__(self, concurrency: int = 256, health_interval: float = 30.0, health_timeout: float = 2.0,
+                 max_misses: int = 2, backoff: float = 0.5, max_backoff: float = 30.0, **client_options):
+        self.concurrency = concurrency # 批次操作同時等待回應的數量上限
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.max_misses = max_misses   # 連續幾次健康檢查逾時後重新連線
+        self.backoff = backoff         # 第一次重連的基本等待秒數
+        self.max_backoff = max_backoff
+        self.client_options = client_options # 傳給 TaiseiaClient (local_id、id_data、request_timeout ...)
+        self.request_timeout = client_options.get('request_timeout', 5.0)
+        self.members = {}              # (host, port) -> PoolMember
+        self._closing = False
+
+    # --- 成員管理 ---
+    def add(self, host: str, port: int = TCP_SERVICE_PORT) -> PoolMember:
+        """加入 HNA 並在背景建立連線 (已存在時直接回傳)"""
+        member = self.members.get((host, port))
+        if member is None:
+            member = PoolMember(host, port, TaiseiaClient(host, port, **self.client_options))
+            self.members[member.key] = member
+            member.task = asyncio.create_task(self._maintain(member))
+        return member
+
+    async def remove(self, host: str, port: int = TCP_SERVICE_PORT) -> None:
+        member = self.members.pop((host, port), None)
+        if member is not None:
+            await self._stop(member)
+
+    async def discover(self, search_ip: str = '255.255.255.255', window: float = 2.0, **options) -> int:
+        """以服務發現加入回覆的 HNA，回傳新加入的數量"""
+        added = 0
+        async for host, port in discover_hnas(search_ip, window=window, **options):
+            if (host, port) not in self.members:
+                self.add(host, port)
+                added += 1
+        return added
+
+    def ready_members(self) -> list:
+        return [member for member in self.members.values() if member.state == 'ready']
+
+    async def wait_ready(self, timeout: float = None) -> int:
+        """等到所有成員完成網路重建 (或逾時)，回傳已就緒的數量"""
+        waits = [member.ready.wait() for member in self.members.values()]
+        if waits:
+            try:
+                await asyncio.wait_for(asyncio.gather(*waits), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return len(self.ready_members())
+
+    # --- 連線維護 ---
+    def _backoff_delay(self, failures: int) -> float:
+        """指數退避加上抖動：在 [delay/2, delay] 之間隨機取值"""
+        delay = min(self.max_backoff, self.backoff * (2 ** min(failures, 16)))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    async def _maintain(self, member: PoolMember) -> None:
+        client = member.client
+        while not self._closing:
+            member.state = 'connecting'
+            try:
+                await client.connect()
+            except REQUEST_ERRORS as e:
+                member.failures += 1
+                member.last_error = repr(e)
+                log.info("[Pool] %s:%d connect failed (%s), retry #%d", member.host, member.port, e, member.failures)
+                await client.close()
+                member.state = 'backoff'
+                await asyncio.sleep(self._backoff_delay(member.failures))
+                continue
+            member.connects += 1
+            member.failures = member.misses = 0
+            member.last_ok = time.monotonic()
+            member.state = 'ready'
+            member.ready.set()
+            log.info("[Pool] %s:%d ready", member.host, member.port)
+            try:
+                await self._watch(member)
+            finally:
+                member.ready.clear()
+                await client.close()
+            if self._closing:
+                break
+            member.state = 'backoff'
+            log.info("[Pool] %s:%d disconnected (%s), reconnecting", member.host, member.port, member.last_error)
+            await asyncio.sleep(self._backoff_delay(member.failures))
+        member.state = 'closed'
+
+    async def _watch(self, member: PoolMember) -> None:
+        """連線期間定期健康檢查；連線中斷或連續逾時時返回"""
+        client = member.client
+        closed = asyncio.ensure_future(client.wait_closed())
+        # 第一次檢查的時間隨機錯開，避免所有 HNA 同時檢查
+        delay = random.uniform(0, self.health_interval)
+        try:
+            while True:
+                done, _ = await asyncio.wait((closed,), timeout=delay)
+                if done:
+                    member.last_error = 'connection closed by HNA'
+                    return
+                delay = self.health_interval
+                try:
+                    await client.request(0x00, 0x06, timeout=self.health_timeout) # 讀取 RTC
+                except asyncio.TimeoutError:
+                    member.misses += 1
+                    if member.misses >= self.max_misses:
+                        member.last_error = f'{member.misses} health checks timed out'
+                        return
+                    continue
+                except (ConnectionError, OSError) as e:
+                    member.last_error = repr(e)
+                    return
+                member.misses = 0
+                member.last_ok = time.monotonic()
+        finally:
+            closed.cancel()
+
+    async def _stop(self, member: PoolMember) -> None:
+        if member.task is not None:
+            member.task.cancel()
+            await asyncio.gather(member.task, return_exceptions=True)
+        await member.client.close()
+        member.ready.clear()
+        member.state = 'closed'
+
+    async def close(self) -> None:
+        self._closing = True
+        await asyncio.gather(*(self._stop(member) for member in self.members.values()))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    # --- 批次操作 ---
+    async def bulk(self, function_id: int, sub_function_id: int, data: bytes = b'',
+                   members=None, timeout: float = None) -> dict:
+        """對所有已就緒 (或指定) 的 HNA 送出同一個請求，回傳 {(host, port): Frame 或例外}。
+
+        data 也可以是 data(member) -> bytes，為每個 HNA 產生各自的請求資料。
+
+        不為每個 HNA 建立 task：請求直接寫入各連線，回應由完成回呼收集並立即補送下一個，
+        同時等待回應的數量不超過 concurrency。timeout 為整個批次的期限，
+        期限內未回應的 HNA 結果為 asyncio.TimeoutError。
+        """
+        queue = deque(self.ready_members() if members is None else members)
+        results = {}
+        if not queue:
+            return results
+        loop = asyncio.get_running_loop()
+        finished = loop.create_future()
+        inflight = {} # Future -> PoolMember
+
+        def send_next():
+            while queue and len(inflight) < self.concurrency:
+                member = queue.popleft()
+                try:
+                    payload = data(member) if callable(data) else data
+                    future = member.client.send_request(function_id, sub_function_id, payload)
+                except (ConnectionError, OSError) as e:
+                    results[member.key] = e
+                    continue
+                inflight[future] = member
+                future.add_done_callback(on_reply)
+            if not inflight and not finished.done():
+                finished.set_result(None)
+
+        def on_reply(future):
+            member = inflight.pop(future, None)
+            if member is None:
+                return # 批次已逾時
+            results[member.key] = future.exception() or future.result()
+            send_next()
+
+        send_next()
+        try:
+            await asyncio.wait_for(finished, timeout or self.request_timeout)
+        except asyncio.TimeoutError:
+            pending, _ = list(inflight.items()), inflight.clear()
+            for future, member in pending:
+                future.cancel()
+                results[member.key] = asyncio.TimeoutError()
+            for member in queue:
+                results[member.key] = asyncio.TimeoutError()
+        return results
+
+    async def scan_status(self, query: bytes = b'', timeout: float = None) -> dict:
+        """對所有已就緒的 HNA 讀取 SA 狀態 (04/01)：{(host, port): [(裝置, 服務, 數值), ...] 或例外}"""
+        results = await self.bulk(0x04, 0x01, query, timeout=timeout)
+        for key, frame in results.items():
+            if isinstance(frame, Frame):
+                if frame.function_id == 0xF1:
+                    results[key] = parse_sa_records(frame.data)
+                else:
+                    results[key] = FrameError(f"HNA replied F=H'{frame.function_id:02X}'/"
+                                              f"SF=H'{frame.sub_function_id:02X}'")
+        return results
+
+    async def scan_changes(self, timeout: float = None) -> dict:
+        """對所有已就緒的 HNA 讀取上次掃描後的 SA 狀態變更 (04/03)：{(host, port): [(裝置, 服務, 數值), ...] 或例外}。
+
+        第一次掃描 (或 HNA 的狀態表重新建立後) 回傳所有變更過的屬性；變更超過一個封包時
+        對該 HNA 繼續請求，直到取得所有變更。
+        """
+        changes = {}
+        members = self.ready_members()
+        while members:
+            results = await self.bulk(0x04, 0x03, lambda member: encode_sa_delta_request(*member.sa_version),
+                                      members, timeout)
+            remaining = []
+            for member in members:
+                frame = results[member.key]
+                if isinstance(frame, Exception):
+                    changes[member.key] = frame
+                    continue
+                if frame.function_id != 0xF1:
+                    changes[member.key] = FrameError(f"HNA replied F=H'{frame.function_id:02X}'/"
+                                                     f"SF=H'{frame.sub_function_id:02X}'")
+                    continue
+                try:
+                    epoch, version, records = parse_sa_delta(frame.data)
+                except FrameError as e:
+                    changes[member.key] = e
+                    continue
+                if epoch != member.sa_version[0] or member.key not in changes:
+                    changes[member.key] = records # 狀態表重新建立時之前取得的變更作廢
+                else:
+                    changes[member.key].extend(records)
+                member.sa_version = (epoch, version)
+                if len(records) == SA_DELTA_MAX_RECORDS:
+                    remaining.append(member)
+            members = remaining
+        return changes
+
+    def snapshot(self) -> dict:
+        states = dict.fromkeys(PoolMember.STATES, 0)
+        for member in self.members.values():
+            states[member.state] += 1
+        return {"members": len(self.members), "states": states,
+                "hnas": {f"{host}:{port}": member.snapshot() for (host, port), member in self.members.items()}}
+
+
+async def run_pool(hnas: list, search_ip: str = None, scan_interval: float = 5.0, scans: int = 0,
+                   delta: bool = False, **pool_options) -> None:
+    async with TaiseiaPool(**pool_options) as pool:
+        for host, port in hnas:
+            pool.add(host, port)
+        if search_ip:
+            added = await pool.discover(search_ip)
+            print(f"服務發現：加入 {added} 個 HNA")
+        if not pool.members:
+            print("❌ 沒有可連線的 HNA。")
+            return
+        ready = await pool.wait_ready(timeout=10.0)
+        print(f"✅ {ready}/{len(pool.members)} 個 HNA 已完成網路重建")
+        count = 0
+        while not scans or count < scans:
+            start = time.perf_counter()
+            results = await (pool.scan_changes() if delta else pool.scan_status())
+            elapsed = time.perf_counter() - start
+            failed = sum(1 for result in results.values() if isinstance(result, Exception))
+            records = sum(len(result) for result in results.values() if not isinstance(result, Exception))
+            print(f"[Scan] {len(results)} 個 HNA，{failed} 個失敗，{records} 筆紀錄，耗時 {elapsed * 1000:.1f} ms；"
+                  f"狀態 {pool.snapshot()['states']}")
+            count += 1
+            if not scans or count < scans:
+                await asyncio.sleep(scan_interval)
+
+
+def main(argv=None):
+    from taiseia_log import LEVELS, setup_logging
+    parser = argparse.ArgumentParser(description="TaiSEIA HC connection pool for many HNAs")
+    parser.add_argument('--hna', action='append', default=[], metavar='HOST[:PORT]', help="手動加入的 HNA (可重複)")
+    parser.add_argument('--discover', metavar='SEARCH_IP', help="以服務發現加入 HNA (例如 255.255.255.255)")
+    parser.add_argument('--concurrency', type=int, default=256, help="批次操作同時進行的請求數上限")
+    parser.add_argument('--health-interval', type=float, default=30.0, help="健康檢查 (00/06) 間隔秒數")
+    parser.add_argument('--scan-interval', type=float, default=5.0, help="狀態掃描 (04/01，--delta 時為 04/03) 間隔秒數")
+    parser.add_argument('--scans', type=int, default=0, help="掃描次數後結束 (0 = 持續執行)")
+    parser.add_argument('--delta', action='store_true', help="以 04/03 只讀取上次掃描後的變更")
+    parser.add_argument('--log-level', choices=LEVELS, default='WARNING')
+    args = parser.parse_args(argv)
+
+    setup_logging(args.log_level)
+    hnas = []
+    for item in args.hna:
+        host, _, port = item.partition(':')
+        hnas.append((host, int(port) if port else TCP_SERVICE_PORT))
+    try:
+        asyncio.run(run_pool(hnas, args.discover, args.scan_interval, args.scans, args.delta,
+                             concurrency=args.concurrency, health_interval=args.health_interval))
+    except KeyboardInterrupt:
+        print("\nPool interrupted by user.")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,269 +1,1295 @@
 # taiseia_server.py
 import asyncio
+import random
 import struct
-import json
+import sys
 import time
+from array import array
+from bisect import bisect_right
+import logging
+from collections import deque
 from taiseia_common import * # 引入共用模組
+from taiseia_log import FrameTrace
+from taiseia_metrics import Metrics, render_prometheus, start_metrics_server
+
+log = logging.getLogger('taiseia.server')
 
 # ----------------------------------------------------
-# 伺服器狀態管理
+# 伺服器計數器 (多程序模式下由父程序彙總各 worker 的數值)
 # ----------------------------------------------------
-class ServerState:
+class ServerStats:
+    FIELDS = ('connections_total', 'connections_active', 'frames_in', 'frames_out', 'crc_errors',
+              'unsupported_replies', 'discovery_replies', 'discovery_dropped',
+              'connections_rejected', 'connections_evicted', 'connections_timed_out', 'connections_overflowed',
+              'retransmits', 'duplicate_acks', 'flow_failures', 'sessions_resumed', 'resume_misses')
+    GAUGES = ('connections_active',) # 其餘欄位為累計值
+    __slots__ = FIELDS
+
     def __init__(self):
-        # 0: 正常模式, 1: 處理網路重建, 2: 處理 SA 轉傳
-        self.mode = 0 
-        self.rebuild_step = 0 # 網路重建流程狀態
-        self.relay_step = 0   # SA 管理/轉傳流程狀態
+        for field in self.FIELDS:
+            setattr(self, field, 0)
+
+    def snapshot(self) -> dict:
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+STATS = ServerStats()
+METRICS = Metrics() # 各功能碼的封包數、位元組數與延遲 (taiseia_metrics)
+
+# ----------------------------------------------------
+# SA 裝置登錄表 (所有裝置/服務的數值存放在單一 array 中)
+# ----------------------------------------------------
+def _be16_column(data, offset: int, stride: int) -> array:
+    """取出每筆長度 stride 的紀錄中位於 offset 的 big-endian uint16 欄位"""
+    column = bytearray(len(data) // stride * 2)
+    column[0::2] = data[offset::stride]
+    column[1::2] = data[offset + 1::stride]
+    values = array('H', column)
+    if sys.byteorder == 'little':
+        values.byteswap()
+    return values
+
+
+class SaRegistry:
+    """SA 裝置狀態表。
+
+    數值以 array('H') 存放，索引為 device * services + service，不為每個裝置建立
+    Python 物件。批次讀寫以 extended slice 一次搬移整欄資料，時間與屬性數成正比。
+
+    每次數值實際改變時版本加一，並記錄在該屬性的變更序號與變更紀錄中；04/03 以
+    bisect 找到指定版本之後的紀錄，時間與變更數成正比，與裝置數無關。epoch 在
+    狀態表重新建立時改變，HC 持有的版本因此不會被誤用在另一份狀態表上。
+    """
+    __slots__ = ('devices', 'services', 'values', 'epoch', 'version', 'seqs', 'log_versions', 'log_indexes')
+
+    def __init__(self, devices: int = 4096, services: int = 64):
+        self.devices = devices
+        self.services = services
+        self.values = array('H', bytes(2 * devices * services))
+        self.version = 0
+        self.seqs = {}                   # 索引 -> 最後一次變更的版本 (只有變更過的屬性)
+        self.log_versions = array('Q')   # 變更紀錄 (依版本遞增)；屬性再次變更後舊的一筆失效
+        self.log_indexes = array('L')
+        self.new_epoch()
+
+    def new_epoch(self) -> None:
+        """讓 HC 持有的版本失效 (多程序模式下各 worker 的狀態表各自獨立)"""
+        self.epoch = random.getrandbits(32) or 1 # 0 保留給「從頭讀取」
+
+    def get(self, device: int, service: int) -> int:
+        return self.values[device * self.services + service]
+
+    def set(self, device: int, service: int, value: int) -> None:
+        index = device * self.services + service
+        if self.values[index] != value:
+            self.values[index] = value
+            self._changed(index)
+
+    def seq(self, device: int, service: int) -> int:
+        """屬性最後一次變更的版本 (從未變更時為 0)"""
+        return self.seqs.get(device * self.services + service, 0)
+
+    def _changed(self, index: int) -> None:
+        self.version += 1
+        self.seqs[index] = self.version
+        self.log_versions.append(self.version)
+        self.log_indexes.append(index)
+        if len(self.log_indexes) > 2 * len(self.seqs) + 1024:
+            self._compact()
+
+    def _compact(self) -> None:
+        """移除已失效的變更紀錄 (每個屬性只保留最後一筆)"""
+        seqs = self.seqs
+        live = [k for k, (version, index) in enumerate(zip(self.log_versions, self.log_indexes))
+                if seqs[index] == version]
+        self.log_versions = array('Q', [self.log_versions[k] for k in live])
+        self.log_indexes = array('L', [self.log_indexes[k] for k in live])
+
+    def changes(self, epoch: int = 0, version: int = 0, limit: int = SA_DELTA_MAX_RECORDS) -> bytes:
+        """04/03 請求的 (epoch, 版本) -> 回應資料 (該版本之後變更的屬性，每個屬性一筆最新值)。
+
+        epoch 不符或版本超過目前版本時從頭讀取 (所有變更過的屬性)；超過 limit 筆時只回傳
+        較早的 limit 筆，回應的版本為最後一筆的版本。
+        """
+        if epoch != self.epoch or version > self.version:
+            version = 0
+        log_versions, log_indexes, seqs = self.log_versions, self.log_indexes, self.seqs
+        indexes = []
+        through = self.version
+        for k in range(bisect_right(log_versions, version), len(log_indexes)):
+            index = log_indexes[k]
+            if seqs[index] != log_versions[k]:
+                continue # 之後又變更過，以較新的一筆為準
+            if len(indexes) == limit:
+                through = log_versions[indexes[-1][1]]
+                break
+            indexes.append((index, k))
+        n, values = self.services, self.values
+        records = b''.join(SA_RECORD_STRUCT.pack(index // n, index % n, values[index]) for index, _ in indexes)
+        return SA_DELTA_STRUCT.pack(self.epoch, through) + records
+
+    def _indexes(self, devices: array, services) -> list:
+        if devices and (max(devices) >= self.devices or max(services) >= self.services):
+            raise KeyError("unknown SA device or service")
+        n = self.services
+        return [device * n + service for device, service in zip(devices, services)]
+
+    def read(self, query) -> bytes:
+        """04/01 請求資料 -> 回應資料 (每個請求的屬性一筆 SA_RECORD_STRUCT 紀錄)"""
+        stride = SA_QUERY_STRUCT.size
+        if len(query) % stride or len(query) // stride > SA_MAX_RECORDS:
+            raise ValueError("SA query length")
+        if not query:
+            query = SA_DEFAULT_QUERY
+        devices = _be16_column(query, 0, stride)
+        services = query[2::stride]
+        values = self.values
+        result = array('H', [values[i] for i in self._indexes(devices, services)])
+        if sys.byteorder == 'little':
+            result.byteswap()
+        raw = result.tobytes()
+        size = SA_RECORD_STRUCT.size
+        out = bytearray(len(services) * size)
+        out[0::size] = query[0::stride]
+        out[1::size] = query[1::stride]
+        out[2::size] = services
+        out[3::size] = raw[0::2]
+        out[4::size] = raw[1::2]
+        return bytes(out)
+
+    def write(self, records) -> bytes:
+        """套用 04/02 請求資料，回傳數值實際改變的紀錄 (同樣為 SA_RECORD_STRUCT 格式)"""
+        size = SA_RECORD_STRUCT.size
+        if len(records) % size:
+            raise ValueError("SA record length")
+        indexes = self._indexes(_be16_column(records, 0, size), records[2::size])
+        values = self.values
+        changed = []
+        for k, (i, value) in enumerate(zip(indexes, _be16_column(records, 3, size))):
+            if values[i] != value:
+                values[i] = value
+                self._changed(i)
+                changed.append(k)
+        if len(changed) == len(indexes):
+            return bytes(records)
+        return b''.join(records[k * size:(k + 1) * size] for k in changed)
+
+
+REGISTRY = SaRegistry()
+for _device, _service, _value in SIMULATED_SA_STATUS:
+    REGISTRY.set(_device, _service, _value)
+
+# ----------------------------------------------------
+# SA 狀態變更通知 (發布/訂閱)
+# ----------------------------------------------------
+def _percentiles(samples) -> dict:
+    if not samples:
+        return {"count": 0}
+    samples = sorted(samples)
+    n = len(samples)
+    return {
+        "count": n,
+        "p50_ms": round(samples[n // 2] * 1000, 3),
+        "p99_ms": round(samples[min(n - 1, int(n * 0.99))] * 1000, 3),
+        "max_ms": round(samples[-1] * 1000, 3),
+    }
+
+
+def parse_interest(data):
+    """04/00 請求資料 -> 訂閱條件 (device << 8 | service 的 frozenset)；資料為空時為 None (所有屬性)"""
+    if len(data) % SA_QUERY_STRUCT.size:
+        raise ValueError("SA interest length")
+    if not data:
+        return None
+    return frozenset(device << 8 | service for device, service in SA_QUERY_STRUCT.iter_unpack(data))
+
+
+def select_records(records: bytes, interest: frozenset) -> bytes:
+    """只保留符合訂閱條件的 SA_RECORD_STRUCT 紀錄"""
+    size = SA_RECORD_STRUCT.size
+    selected = []
+    for k in range(0, len(records), size):
+        key = records[k] << 16 | records[k + 1] << 8 | records[k + 2]
+        if key in interest or key | SA_ALL_SERVICES in interest:
+            selected.append(records[k:k + size])
+    return b''.join(selected)
+
+
+class Subscriber:
+    """一條訂閱連線尚未送出的更新，以 (裝置, 服務) 合併 (只保留最新值)"""
+    __slots__ = ('ctx', 'interest', 'pending', 'since', 'task')
+
+    def __init__(self, ctx, interest: frozenset = None):
+        self.ctx = ctx
+        self.interest = interest # None 表示所有屬性
+        self.pending = {} # (device << 8 | service) -> value
+        self.since = 0.0  # 最早一筆待送更新的發布時間
+        self.task = None  # 正在送出待送更新的工作
+
+
+class NotificationHub:
+    """把 SA 狀態變更以 H'05/H'05 通知推送給所有訂閱的 HC (04/00)。
+
+    寫入緩衝區未滿且沒有積壓的連線直接送出同一份編碼好的通知 (只依事件序號
+    重新計算 CRC)；跟不上的連線改為把更新放進自己的有限佇列，同一屬性只保留
+    最新值，由該連線的工作在緩衝區消化後整批送出，不會拖慢其他連線。佇列滿時
+    依 overflow 丟棄新屬性的更新 ('drop'，HC 可再以 04/01 讀取) 或中斷該連線
+    ('disconnect')。
+
+    訂閱時可指定感興趣的屬性 (04/00 請求資料)，每份發布只對相同條件篩選一次，
+    沒有符合屬性的連線不會收到通知。
+
+    直送的通知以 FrameTemplate 編碼，依形狀 (HNA ID, HC ID, 資料長度) 快取在 hub 中：
+    每份發布對每個形狀只換上新資料並重算一次 CRC，各連線只修正事件序號。
+    """
+
+    def __init__(self, queue_size: int = 256, overflow: str = 'drop',
+                 high_water: int = 64 * 1024, samples: int = 4096, max_templates: int = 1024):
+        if overflow not in ('drop', 'disconnect'):
+            raise ValueError(f"unknown overflow policy {overflow!r}")
+        self.queue_size = queue_size # 每個訂閱者最多積壓的屬性數
+        self.overflow = overflow
+        self.high_water = high_water # 寫入緩衝區超過此值即改走佇列
+        self.max_templates = max_templates
+        self.subscribers = {}        # ctx -> Subscriber
+        self._templates = {}         # (HNA ID, HC ID, 資料長度) -> FrameTemplate；依建立順序淘汰
+        self.published = 0
+        self.sent_direct = 0
+        self.sent_batched = 0
+        self.coalesced = 0
+        self.filtered = 0
+        self.dropped = 0
+        self.disconnected = 0
+        self.max_depth = 0
+        self.fanout_latency = deque(maxlen=samples) # 發布到交給所有直送連線的時間
+        self.queued_latency = deque(maxlen=samples) # 發布到積壓更新送出的時間
+
+    def subscribe(self, ctx, interest: frozenset = None) -> None:
+        """訂閱 (或以新的條件取代原本的訂閱條件)"""
+        subscriber = self.subscribers.get(ctx)
+        if subscriber is None:
+            self.subscribers[ctx] = Subscriber(ctx, interest)
+        else:
+            subscriber.interest = interest
+
+    def unsubscribe(self, ctx) -> None:
+        subscriber = self.subscribers.pop(ctx, None)
+        if subscriber is not None and subscriber.task is not None:
+            subscriber.task.cancel()
+
+    def publish(self, records: bytes) -> None:
+        """發布 SA_RECORD_STRUCT 紀錄 (04/02 請求資料的格式)"""
+        if not self.subscribers:
+            return
+        start = time.perf_counter()
+        self.published += 1
+        templates = self._templates
+        filled = {} # 形狀 -> 這次發布中範本目前的資料
+        selections = {None: records} # 訂閱條件 -> 符合條件的紀錄
+        for subscriber in list(self.subscribers.values()):
+            interest = subscriber.interest
+            data = selections.get(interest)
+            if data is None:
+                data = selections[interest] = select_records(records, interest)
+            if not data:
+                self.filtered += 1
+                continue
+            ctx = subscriber.ctx
+            if subscriber.pending or ctx.transport.get_write_buffer_size() >= self.high_water:
+                self._enqueue(subscriber, data, start)
+                continue
+            session = ctx.session
+            shape = (session.local_id, session.peer_id, len(data))
+            template = templates.get(shape)
+            if template is None:
+                if len(templates) >= self.max_templates:
+                    del templates[next(iter(templates))]
+                template = templates[shape] = FrameTemplate(session.local_id, session.peer_id,
+                                                            0xFF, 0x05, 0x05, data)
+                filled[shape] = data
+            elif filled.get(shape) is not data:
+                template.fill(data)
+                filled[shape] = data
+            ctx.write(template.render(session.next_event_id()))
+            self.sent_direct += 1
+        self.fanout_latency.append(time.perf_counter() - start)
+
+    def _enqueue(self, subscriber: Subscriber, records: bytes, now: float) -> None:
+        pending = subscriber.pending
+        if not pending:
+            subscriber.since = now
+        for device, service, value in SA_RECORD_STRUCT.iter_unpack(records):
+            key = device << 8 | service
+            if key in pending:
+                self.coalesced += 1
+            elif len(pending) >= self.queue_size:
+                if self.overflow == 'disconnect':
+                    self.disconnected += 1
+                    self.unsubscribe(subscriber.ctx)
+                    subscriber.ctx.transport.abort() # 捨棄積壓的寫入緩衝，立即中斷
+                    return
+                self.dropped += 1
+                continue
+            pending[key] = value
+        if len(pending) > self.max_depth:
+            self.max_depth = len(pending)
+        if subscriber.task is None:
+            subscriber.task = asyncio.ensure_future(self._flush(subscriber))
+
+    async def _flush(self, subscriber: Subscriber) -> None:
+        ctx = subscriber.ctx
+        try:
+            while subscriber.pending and not ctx.closed:
+                await ctx.drain()
+                pending, subscriber.pending = subscriber.pending, {}
+                data = b''.join(SA_RECORD_STRUCT.pack(key >> 8, key & 0xFF, value)
+                                for key, value in pending.items())
+                ctx.write(ctx.session.build(0x05, 0x05, data))
+                self.sent_batched += 1
+                self.queued_latency.append(time.perf_counter() - subscriber.since)
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            subscriber.task = None
+
+    def queue_depth(self) -> int:
+        return sum(len(subscriber.pending) for subscriber in self.subscribers.values())
+
+    def snapshot(self) -> dict:
+        return {
+            "subscribers": len(self.subscribers),
+            "published": self.published,
+            "sent_direct": self.sent_direct,
+            "sent_batched": self.sent_batched,
+            "coalesced": self.coalesced,
+            "filtered": self.filtered,
+            "dropped": self.dropped,
+            "disconnected": self.disconnected,
+            "queue_depth": self.queue_depth(),
+            "max_queue_depth": self.max_depth,
+            "fanout_latency": _percentiles(self.fanout_latency),
+            "queued_latency": _percentiles(self.queued_latency),
+        }
+
+
+HUB = NotificationHub()
 
 # ----------------------------------------------------
-# 1. TCP 服務處理 (HNA 核心邏輯)
+# 1. 功能碼處理函式登錄表
 # ----------------------------------------------------
+# (function_id, sub_function_id) -> (handler, is_async)
+# handler(ctx, frame) 回傳要送出的回應封包 (bytes) 或 None；可為同步或 async 函式。
+# 回應 (F0/F1) 沿用請求的事件序號，HC 端可據此對應同時發出的多個請求。
+HANDLERS = {}
+
+def handler(function_id: int, sub_function_id: int):
+    """以裝飾器登錄功能碼處理函式：@handler(0x03, 0x02)"""
+    def register(func):
+        HANDLERS[(function_id, sub_function_id)] = (func, asyncio.iscoroutinefunction(func))
+        return func
+    return register
+
+
+# 目前所有連線的上下文 (關閉服務時用來中斷連線)
+CONNECTIONS = set()
+
+
+class TraceSlot:
+    """封包追蹤：同一時間只追蹤一條 (符合 peer 條件的) 連線，結束後交給下一條"""
+    __slots__ = ('path', 'peer', 'binary', 'owner')
+
+    def __init__(self):
+        self.path = None   # 未設定時不追蹤
+        self.peer = None   # 'ip' 或 'ip:port'；None 表示任何連線
+        self.binary = False
+        self.owner = None  # 目前被追蹤的 ConnectionContext
+
+    def configure(self, path: str, peer: str = None, binary: bool = False) -> None:
+        self.path, self.peer, self.binary = path, peer, binary
+
+    def attach(self, ctx) -> None:
+        if self.path is None or self.owner is not None:
+            return
+        label = f"{ctx.peer[0]}:{ctx.peer[1]}" if ctx.peer else ''
+        if self.peer is not None and self.peer != label and self.peer != label.rpartition(':')[0]:
+            return
+        self.owner = ctx
+        ctx.trace = FrameTrace(self.path, self.binary, label)
+        log.info("[TCP] Tracing frames of %s to %s", label, self.path)
+
+    def detach(self, ctx) -> None:
+        if self.owner is ctx:
+            ctx.trace.close()
+            ctx.trace = None
+            self.owner = None
+
+
+TRACE = TraceSlot()
+CAPTURE = None # taiseia_capture.CaptureWriter：設定時錄製所有連線收發的封包
+
+
+class AdmissionControl:
+    """連線數上限、依狀態的閒置逾時、網路重建期限與寫入緩衝上限。
+
+    逾時不為每條連線建立計時器：處理封包時只記錄時間，由單一 sweep 工作每
+    sweep_interval 秒檢查一次所有連線。重建中的連線依開始時間保存在
+    handshaking (有序 dict)，期限檢查只需看最前面幾筆。
+
+    連線數超過 max_connections 時依 policy 處理新連線：'reject' 直接中斷新連線，
+    'evict' 改為中斷最早開始、仍未完成重建的連線 (沒有則仍拒絕新連線)。
+    """
+
+    POLICIES = ('reject', 'evict')
+
+    def __init__(self, max_connections: int = 20000, policy: str = 'reject',
+                 idle_timeout: float = 300.0, handshake_idle: float = 10.0, relay_idle: float = 30.0,
+                 handshake_deadline: float = 30.0, write_buffer_limit: int = 256 * 1024,
+                 sweep_interval: float = 1.0):
+        if policy not in self.POLICIES:
+            raise ValueError(f"unknown backlog policy {policy!r}, expected one of {self.POLICIES}")
+        self.max_connections = max_connections
+        self.policy = policy
+        # 依 session.mode 的閒置逾時 (0: 正常, 1: 網路重建, 2: SA 轉傳)；0 表示不限
+        self.idle_timeouts = (idle_timeout, handshake_idle, relay_idle)
+        self.handshake_deadline = handshake_deadline # 連線到完成網路重建的總期限
+        self.write_buffer_limit = write_buffer_limit # 寫入緩衝超過此值視為不讀取的 HC
+        self.sweep_interval = sweep_interval
+        self.handshaking = {} # ctx -> 重建開始時間
+
+    def admit(self, ctx) -> bool:
+        """新連線 (已加入 CONNECTIONS) 是否可以繼續；False 時由呼叫端中斷連線"""
+        if len(CONNECTIONS) <= self.max_connections:
+            return True
+        if self.policy == 'evict' and self.handshaking:
+            victim = next(iter(self.handshaking))
+            log.info("[TCP] Evicting %s (still in rebuild) for %s", victim.peer, ctx.peer)
+            STATS.connections_evicted += 1
+            self._drop(victim)
+            return True
+        STATS.connections_rejected += 1
+        log.info("[TCP] Rejecting %s: %d connections", ctx.peer, len(CONNECTIONS) - 1)
+        return False
+
+    def _drop(self, ctx) -> None:
+        ctx.close()
+        ctx.transport.abort() # 捨棄緩衝資料立即中斷
+
+    def sweep(self, now: float) -> None:
+        handshaking = self.handshaking
+        deadline = self.handshake_deadline
+        while handshaking and deadline:
+            ctx, started = next(iter(handshaking.items()))
+            if now - started < deadline:
+                break
+            log.info("[TCP] %s did not finish rebuild in %.0f s", ctx.peer, deadline)
+            STATS.connections_timed_out += 1
+            self._drop(ctx)
+
+        timeouts = self.idle_timeouts
+        limit = self.write_buffer_limit
+        for ctx in list(CONNECTIONS):
+            timeout = timeouts[ctx.session.mode]
+            if timeout and now - ctx.last_active > timeout:
+                log.info("[TCP] %s idle for %.0f s (mode %d)", ctx.peer, now - ctx.last_active, ctx.session.mode)
+                STATS.connections_timed_out += 1
+                self._drop(ctx)
+            elif limit and ctx.transport.get_write_buffer_size() > limit:
+                log.info("[TCP] %s write buffer over %d bytes", ctx.peer, limit)
+                STATS.connections_overflowed += 1
+                self._drop(ctx)
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            self.sweep(time.monotonic())
+
+
+ADMISSION = AdmissionControl()
+
+
+class IdentityCache:
+    """已驗證 HC 身分 (sender_id -> 14 bytes ID 資料) 的快取，用於快速恢復連線。
+
+    完成完整網路重建的 HC 保留 ttl 秒 (每次恢復都重新計時)。期間重新連線的 HC
+    若在 01/00 的 ACK 中附上相同的 ID 資料，即略過讀取 ID (重建 Step 6/7)，
+    直接進入正常模式。多程序模式下每個 worker 各自保存，重新連線被分到
+    其他 worker 時仍走完整流程。
+    """
+    __slots__ = ('ttl', 'max_entries', '_entries')
+
+    def __init__(self, ttl: float = 300.0, max_entries: int = 100000):
+        self.ttl = ttl # 0 表示停用快速恢復
+        self.max_entries = max_entries
+        self._entries = {} # sender_id -> (ID 資料, 到期時間)；依寫入順序，即到期順序
+
+    def put(self, hc_id: bytes, id_data: bytes) -> None:
+        if self.ttl <= 0:
+            return
+        entries = self._entries
+        entries.pop(hc_id, None)
+        entries[hc_id] = (id_data, time.monotonic() + self.ttl)
+        if len(entries) > self.max_entries:
+            del entries[next(iter(entries))]
+
+    def match(self, hc_id: bytes, id_data) -> bool:
+        """hc_id 是否在有效期限內且 ID 資料相符；相符時延長期限"""
+        entry = self._entries.get(hc_id)
+        if entry is None:
+            return False
+        if entry[1] < time.monotonic():
+            del self._entries[hc_id]
+            return False
+        if entry[0] != id_data:
+            return False
+        self.put(hc_id, entry[0])
+        return True
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+IDENTITIES = IdentityCache()
+
+
+class ConnectionContext:
+    """每條 HC 連線的上下文：協定 Session (事件序號、ID、流程狀態)、對端位址與 transport"""
+    def __init__(self, transport: asyncio.BaseTransport, peer, drain):
+        # 對端 ID 先假設為預設 HC，收到 HC 對上線通知的 ACK 後更新
+        self.session = TaiseiaSession(RECEIVER_ID, SENDER_ID)
+        self.transport = transport
+        self._write = transport.write # 只寫入緩衝不等待 drain
+        self.drain = drain            # async 函式：等到寫入緩衝區消化
+        self.peer = peer
+        self.closed = False
+        self.trace = None             # FrameTrace (只有被追蹤的連線才有)
+        self.capture = CAPTURE.connection() if CAPTURE is not None else None
+        self.flow = None              # 進行中的 FlowRun (網路重建/SA 轉傳)
+        self.rtt = RttEstimator()     # 流程封包的 RTT 估計，決定重送逾時
+        self.last_active = time.monotonic() # 最後一次收到封包的時間 (閒置逾時用)
+        CONNECTIONS.add(self)
+        STATS.connections_total += 1
+        STATS.connections_active += 1
+        TRACE.attach(self)
+
+    def write(self, packet: bytes) -> None:
+        STATS.frames_out += 1
+        METRICS.frame_out(packet)
+        if self.trace is not None:
+            self.trace.record('out', packet)
+        if self.capture is not None:
+            self.capture.record('out', packet)
+        self._write(packet)
+
+    def abort(self) -> None:
+        """主動中斷連線 (連線處理流程會在讀到 EOF 後自行收尾)"""
+        self.transport.close()
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        if self.flow is not None and self.flow.timer is not None:
+            self.flow.timer.cancel()
+        CONNECTIONS.discard(self)
+        ADMISSION.handshaking.pop(self, None)
+        HUB.unsubscribe(self)
+        TRACE.detach(self)
+        STATS.connections_active -= 1
+
+
+def reply_unsupported(ctx, frame):
+    """F0/10：不支援的功能碼或無法處理的請求資料"""
+    STATS.unsupported_replies += 1
+    return ctx.session.ack(ACK_UNSUPPORTED, frame.event_id)
+
+
+@handler(0x00, 0x06) # HNA 設定：讀取 RTC 設定值
+def handle_read_rtc(ctx, frame):
+    now = time.localtime()
+    rtc_data = struct.pack('!BBBBBBB', now[0]%100, now[1], now[2], now[3], now[4], now[5], now[6]) 
+    return ctx.session.build(0xF1, 0x00, rtc_data, event_id=frame.event_id)
+
+@handler(0x01, 0x01) # ID 管理：讀取 ID
+def handle_read_id(ctx, frame):
+    return ctx.session.build(0xF1, 0x00, ALL_ID_DATA, event_id=frame.event_id)
+
+@handler(0x03, 0x00) # HNA 註冊：設定啟動註冊過程
+def handle_ack_only(ctx, frame):
+    return ctx.session.ack(ACK_OK, frame.event_id)
+
+@handler(0x04, 0x00) # SA 裝置監控請求：訂閱 SA 狀態變更通知 (H'05/H'05)，資料為感興趣的屬性
+def handle_subscribe(ctx, frame):
+    try:
+        interest = parse_interest(frame.data)
+    except ValueError:
+        return reply_unsupported(ctx, frame)
+    HUB.subscribe(ctx, interest)
+    return ctx.session.ack(ACK_OK, frame.event_id)
+
+@handler(0x03, 0x02) # HNA 註冊：讀取 HNA 支援能力
+def handle_read_capability(ctx, frame):
+    return ctx.session.build(0xF1, 0x00, HNA_SUPPORT_CAPABILITY, event_id=frame.event_id)
+
+@handler(0x04, 0x01) # SA 裝置監控：讀取單次/批次狀態
+def handle_read_status(ctx, frame):
+    try:
+        data = REGISTRY.read(frame.data)
+    except (KeyError, ValueError):
+        return reply_unsupported(ctx, frame)
+    return ctx.session.build(0xF1, 0x00, data, event_id=frame.event_id)
+
+@handler(0x04, 0x02) # SA 設定狀態 (可一次設定多筆)
+def handle_write_status(ctx, frame):
+    try:
+        changed = REGISTRY.write(frame.data)
+    except (KeyError, ValueError):
+        return reply_unsupported(ctx, frame)
+    if changed:
+        HUB.publish(changed) # 只通知數值實際改變的屬性
+    return ctx.session.ack(ACK_OK, frame.event_id)
+
+@handler(0x04, 0x03) # SA 裝置監控：讀取指定版本之後的狀態變更
+def handle_read_changes(ctx, frame):
+    data = frame.data
+    if not data:
+        epoch = version = 0
+    elif len(data) == SA_DELTA_STRUCT.size:
+        epoch, version = SA_DELTA_STRUCT.unpack(data)
+    else:
+        return reply_unsupported(ctx, frame)
+    return ctx.session.build(0xF1, 0x00, REGISTRY.changes(epoch, version), event_id=frame.event_id)
+
+@handler(0x05, 0x01) # SA 裝置管理：設定 SA 裝置管理設定值 (HC 請求起始轉傳流程)
+def handle_start_relay(ctx, frame):
+    # HNA 回覆 F0/00 ACK (轉傳 Step 2)
+    ctx.write(ctx.session.ack(ACK_OK, frame.event_id))
+    # 轉傳 Step 5 之後由流程引擎處理
+    start_flow(ctx, RELAY_FLOW)
+    return None
+
+
+async def _write_async_result(ctx, pending, code, start):
+    response_packet = await pending
+    METRICS.observe_handler(code, time.perf_counter() - start)
+    if response_packet:
+        ctx.write(response_packet)
+
+
+# ----------------------------------------------------
+# 2. TCP 服務處理 (HNA 核心邏輯)
+# ----------------------------------------------------
+
+# --- HNA 主導的多步驟流程 (網路重建、SA 轉傳) ---
+class FlowStep:
+    """流程中的一步：送出 (F, SF, data)，等待 HC 以相同事件序號回覆 expect=(F, SF)"""
+    __slots__ = ('function_id', 'sub_function_id', 'data', 'expect', 'on_reply', 'label')
+
+    def __init__(self, function_id: int, sub_function_id: int, data: bytes = b'',
+                 expect=(0xF0, 0x00), on_reply=None, label: str = ''):
+        self.function_id = function_id
+        self.sub_function_id = sub_function_id
+        self.data = data
+        self.expect = expect
+        # on_reply(ctx, frame)：收到此步回覆時呼叫；回傳真值時流程提前結束
+        # (回傳字串時以此作為量測用的流程名稱，回傳 Flow 時改為執行該流程)
+        self.on_reply = on_reply
+        self.label = label
+
+
+class Flow:
+    """宣告式流程：依序送出每一步並等待回覆，全部完成後回到正常模式。
+
+    每一步逾時 (依連線的 RTT 估計) 未收到回覆時以相同事件序號重送，
+    最多 max_retries 次後放棄並中斷連線。
+    """
+    __slots__ = ('name', 'mode', 'steps', 'max_retries', 'on_complete')
+
+    def __init__(self, name: str, mode: int, steps, max_retries: int = 4, on_complete=None):
+        self.name = name
+        self.mode = mode # 流程進行中的 session.mode
+        self.steps = tuple(steps)
+        self.max_retries = max_retries
+        self.on_complete = on_complete # on_complete(ctx)
+
+
+class FlowRun:
+    """一條連線上進行中的流程"""
+    __slots__ = ('flow', 'index', 'event_id', 'previous_event_id', 'packet', 'sent_at', 'retries',
+                 'timer', 'started')
+
+    def __init__(self, flow: Flow):
+        self.flow = flow
+        self.index = 0              # 目前等待回覆的步驟
+        self.event_id = 0           # 目前步驟封包的事件序號 (重送沿用)
+        self.previous_event_id = 0  # 上一步的事件序號 (用來辨識重複的 ACK)
+        self.packet = b''
+        self.sent_at = 0.0
+        self.retries = 0
+        self.timer = None
+        self.started = time.perf_counter()
+
+
+def start_flow(ctx: ConnectionContext, flow: Flow) -> None:
+    run = ctx.flow
+    if run is not None and run.timer is not None:
+        run.timer.cancel()
+    ctx.flow = FlowRun(flow)
+    ctx.session.mode = flow.mode
+    _send_step(ctx)
+
+
+def _send_step(ctx: ConnectionContext) -> None:
+    run = ctx.flow
+    step = run.flow.steps[run.index]
+    session = ctx.session
+    run.event_id = session.next_event_id()
+    run.packet = session.build(step.function_id, step.sub_function_id, step.data, event_id=run.event_id)
+    run.retries = 0
+    run.sent_at = time.perf_counter()
+    log.debug("[TCP] %s", step.label)
+    ctx.write(run.packet)
+    run.timer = asyncio.get_running_loop().call_later(ctx.rtt.rto, _retransmit, ctx)
+
+
+def _retransmit(ctx: ConnectionContext) -> None:
+    run = ctx.flow
+    if run is None or ctx.closed:
+        return
+    if run.retries >= run.flow.max_retries:
+        log.info("[TCP] %s flow with %s failed after %d retransmissions", run.flow.name, ctx.peer, run.retries)
+        STATS.flow_failures += 1
+        ctx.flow = None
+        ctx.abort()
+        return
+    run.retries += 1
+    STATS.retransmits += 1
+    ctx.rtt.backoff()
+    ctx.write(run.packet) # 沿用相同事件序號，HC 可辨識為重送
+    run.timer = asyncio.get_running_loop().call_later(ctx.rtt.rto, _retransmit, ctx)
+
+
+def flow_reply(ctx: ConnectionContext, frame: Frame) -> bool:
+    """把回覆交給進行中的流程；回傳 True 表示封包已由流程處理 (含重複的 ACK)"""
+    run = ctx.flow
+    event_id = frame.event_id
+    if event_id == run.event_id:
+        step = run.flow.steps[run.index]
+        if frame.function_id != step.expect[0] or frame.sub_function_id != step.expect[1]:
+            return False
+        run.timer.cancel()
+        if run.retries == 0: # 重送過的步驟無法分辨回覆對應哪一次送出，不取樣
+            ctx.rtt.sample(time.perf_counter() - run.sent_at)
+        finished = step.on_reply(ctx, frame) if step.on_reply is not None else None
+        run.previous_event_id = event_id
+        run.index += 1
+        if isinstance(finished, Flow):
+            # 改走另一個流程 (例如快速恢復略過其餘重建步驟)，耗時從原流程開始計算
+            start_flow(ctx, finished)
+            ctx.flow.started = run.started
+            ctx.flow.previous_event_id = event_id
+        elif finished:
+            _finish_flow(ctx, finished if isinstance(finished, str) else None)
+        elif run.index < len(run.flow.steps):
+            _send_step(ctx)
+        else:
+            _finish_flow(ctx)
+        return True
+    if event_id == run.previous_event_id and (frame.function_id == 0xF0 or frame.function_id == 0xF1):
+        # 上一步重送後 HC 對兩次送出都回覆了
+        STATS.duplicate_acks += 1
+        return True
+    return False
+
+
+def _finish_flow(ctx: ConnectionContext, name: str = None) -> None:
+    run = ctx.flow
+    ctx.flow = None
+    ctx.session.mode = 0
+    name = name or run.flow.name
+    log.debug("[TCP] %s flow with %s completed", name, ctx.peer)
+    METRICS.observe_flow(name, time.perf_counter() - run.started)
+    if run.flow.on_complete is not None:
+        run.flow.on_complete(ctx)
+
+
+def _online_acked(ctx, frame):
+    hc_id = frame.sender_id
+    ctx.session.peer_id = hc_id # 之後的封包都送往此 HC
+    if not frame.data.nbytes:
+        return None
+    # HC 在 ACK 中附上 ID 資料表示要求快速恢復
+    if not IDENTITIES.match(hc_id, frame.data):
+        STATS.resume_misses += 1
+        return None
+    STATS.sessions_resumed += 1
+    # 略過讀取 ID，立即回到正常模式；報告改在正常模式下送出並等待 ACK
+    _rebuild_done(ctx)
+    return RESUME_FLOW
+
+
+def _id_read(ctx, frame):
+    IDENTITIES.put(frame.sender_id, frame.data.tobytes())
+
+
+def _rebuild_done(ctx):
+    ADMISSION.handshaking.pop(ctx, None)
+
+
+# 網路重建：HNA 上線通知 -> 讀取 HC ID -> 報告
+REBUILD_FLOW = Flow('rebuild', 1, (
+    FlowStep(0x01, 0x00, on_reply=_online_acked, label="重建 Step 2: HNA 主動發送 H'01/H'00 通知已上線"),
+    FlowStep(0x01, 0x01, expect=(0xF1, 0x00), on_reply=_id_read, label="重建 Step 6: HNA 發送 H'01/H'01 讀取 ID"),
+    FlowStep(0x05, 0x04, b'\x00', label="重建 Step 8: HNA 發送 H'05/H'04 報告"),
+), on_complete=_rebuild_done)
+
+# 快速恢復：HC 的上線通知 ACK 帶有已知的 ID 資料時，由網路重建改走此流程。
+# 恢復在 01/00 的 ACK 即完成 (mode 0)：報告照常重送到收到 ACK 為止，但 HC 在 ACK
+# 之後立即送出的請求不必等待報告的 ACK，照常分派而不會被網路重建模式丟棄
+RESUME_FLOW = Flow('resume', 0, (
+    FlowStep(0x05, 0x04, b'\x00', label="快速恢復: HNA 發送 H'05/H'04 報告"),
+))
+
+# SA 管理/轉傳：通知 -> 報告 (HC 的 H'05/H'01 請求已在處理函式中 ACK)
+RELAY_FLOW = Flow('relay', 2, (
+    FlowStep(0x05, 0x05, SA_NOTIFICATION_DATA, label="轉傳 Step 5: HNA 發送 H'05/H'05 通知"),
+    FlowStep(0x05, 0x04, SA_REPORT_DATA, label="轉傳 Step 7: HNA 發送 H'05/H'04 報告"),
+))
+
+
+def start_rebuild(ctx: ConnectionContext):
+    """網路重建起始：HNA 主動通知已上線 (重建 Step 2)"""
+    # 這裡模擬 HNA 在每次新連線時啟動網路重建流程
+    ADMISSION.handshaking[ctx] = ctx.last_active
+    start_flow(ctx, REBUILD_FLOW)
+
+
+def reply_crc_error(ctx: ConnectionContext) -> None:
+    """F0/03：CRC 或格式錯誤 (分框器放棄的同步位置也由此回覆)"""
+    STATS.crc_errors += 1
+    ctx.write(ctx.session.ack(ACK_CRC_ERROR))
+
+
+def process_frame(ctx: ConnectionContext, data):
+    """處理一個完整封包。同步處理完畢回傳 None；需等待 async 處理函式時回傳 awaitable。"""
+    STATS.frames_in += 1
+    ctx.last_active = time.monotonic()
+    if ctx.trace is not None:
+        ctx.trace.record('in', data)
+    if ctx.capture is not None:
+        ctx.capture.record('in', data)
+    try:
+        frame = Frame.decode(data)
+    except FrameError:
+        reply_crc_error(ctx)
+        return None
+
+    func_id = frame.function_id
+    sub_func_id = frame.sub_function_id
+    session = ctx.session
+    METRICS.frame_in(func_id << 8 | sub_func_id, frame.packet_length)
+
+    # ----------------------------------------------------
+    # A. 進行中的流程 (網路重建、SA 轉傳) 優先處理回覆
+    # ----------------------------------------------------
+    if ctx.flow is not None:
+        if flow_reply(ctx, frame):
+            return None
+        # 網路重建期間其餘封包一律丟棄；SA 轉傳期間照常分派 (HC 可在流程進行中繼續發送請求)
+        if session.mode == 1:
+            return None
+
+    # ----------------------------------------------------
+    # B. 正常模式 (被動回應，查表分派)
+    # ----------------------------------------------------
+    log.debug("[TCP] 收到指令 F=H'%02X', SF=H'%02X'", func_id, sub_func_id)
+    entry = HANDLERS.get((func_id, sub_func_id))
+    if entry is None:
+        # 不支援的功能碼 (HC 的 ACK/回應不需回覆)
+        if func_id != 0xF0 and func_id != 0xF1:
+            ctx.write(reply_unsupported(ctx, frame)) # F0/10
+        return None
+
+    func, is_async = entry
+    start = time.perf_counter()
+    if is_async:
+        return _write_async_result(ctx, func(ctx, frame), func_id << 8 | sub_func_id, start)
+    response_packet = func(ctx, frame)
+    METRICS.observe_handler(func_id << 8 | sub_func_id, time.perf_counter() - start)
+    if response_packet:
+        ctx.write(response_packet)
+    return None
+
 
 async def handle_taiseia_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
-    global EVENT_ID_COUNTER
-    server_state = ServerState()
-    
     addr = writer.get_extra_info('peername')
-    print(f"\n[TCP] Connection established from {addr}. Initializing State...")
+    log.info("[TCP] Connection established from %s", addr)
+    ctx = ConnectionContext(writer.transport, addr, writer.drain)
+    if not ADMISSION.admit(ctx):
+        ctx.close()
+        writer.transport.abort()
+        return
 
     # --- 流程起始：網路重建判斷 ---
-    # 這裡模擬 HNA 在每次新連線時啟動網路重建流程
-    server_state.mode = 1
-    server_state.rebuild_step = 1 # Step 1: 啟動 HNA 主動通知上線
-    
-    # --- HNA 主動通知已上線 (網路重建步驟 2) ---
     try:
-        if server_state.rebuild_step == 1:
-            print(f"[TCP] HNA 主動發送 H'01/H'00 通知已上線 (重建 Step 2)...")
-            notify_online_packet = build_taiseia_packet(
-                sender_id=RECEIVER_ID, receiver_id=SENDER_ID, group_id=0xFF,
-                function_id=0x01, sub_function_id=0x00, data=b''
-            )
-            writer.write(notify_online_packet)
-            await writer.drain()
-            server_state.rebuild_step = 2 # 等待 HC 對通知的 ACK (Step 3)
-            
+        start_rebuild(ctx)
+        await writer.drain()
     except Exception as e:
-        print(f"[TCP] Error during initial notification: {e}")
+        log.warning("[TCP] Error during initial notification: %s", e)
+        ctx.close()
         writer.close()
-        await writer.wait_closed()
         return
 
-
     # --- 主接收迴圈 (處理 HC 回覆和指令) ---
     try:
-        while True:
-            data = await reader.read(4096) 
-            if not data: break 
-
-            header_info = parse_taiseia_response(data)
-            if "error" in header_info:
-                # CRC 或格式錯誤，回覆 F0/03 CRC 錯誤
-                response_packet = create_ack_response(SENDER_ID, RECEIVER_ID, 0, 0, 0x03)
-                writer.write(response_packet)
-                await writer.drain()
-                continue
-            
-            func_id = header_info['function_id']
-            sub_func_id = header_info['sub_function_id']
-            packet_data = header_info['data']
-            
-            response_packet = b'' # 預設不回覆
-
-            # ----------------------------------------------------
-            # A. 網路重建流程 (優先處理)
-            # ----------------------------------------------------
-            if server_state.mode == 1:
-                # 重建 Step 3 (收到 H'01/H'00 的 ACK)
-                if server_state.rebuild_step == 2 and func_id == 0xF0 and sub_func_id == 0x00:
-                    print(f"[TCP] 收到 HC 對 H'01/H'00 的 ACK (重建 Step 3)。")
-                    # HNA 主動發送 讀取 ID 給 HC (重建 Step 6)
-                    request_id_packet = build_taiseia_packet(
-                        sender_id=RECEIVER_ID, receiver_id=header_info['sender_id'], group_id=0xFF,
-                        function_id=0x01, sub_function_id=0x01, data=b''
-                    )
-                    writer.write(request_id_packet); await writer.drain()
-                    server_state.rebuild_step = 3 # 等待 HC 回覆 ID (Step 7)
-                    continue
-
-                # 重建 Step 7 (收到 HC 回覆 ID 的 F1/00)
-                elif server_state.rebuild_step == 3 and func_id == 0xF1 and sub_func_id == 0x00:
-                    print(f"[TCP] 收到 HC 對 H'01/H'01 的回覆 (重建 Step 7)。")
-                    # HNA 主動發送 報告 (重建 Step 8)
-                    report_packet = build_taiseia_packet(
-                        sender_id=RECEIVER_ID, receiver_id=header_info['sender_id'], group_id=0xFF,
-                        function_id=0x05, sub_function_id=0x04, data=b'\x00'
-                    )
-                    writer.write(report_packet); await writer.drain()
-                    server_state.rebuild_step = 4 # 等待 HC 回覆報告的 ACK (Step 9)
-                    continue
-
-                # 重建 Step 9 (收到 HC 對報告的 ACK)
-                elif server_state.rebuild_step == 4 and func_id == 0xF0 and sub_func_id == 0x00:
-                    print(f"[TCP] 收到 HC 對 H'05/H'04 的 ACK (重建 Step 9)。網路重建完成。")
-                    server_state.mode = 0 # 進入正常模式
-                    server_state.rebuild_step = 0
-                    pass # 使用預設的 ACK (對 ACK 的 ACK)
-
-            # ----------------------------------------------------
-            # B. SA 管理/轉傳流程 (需要狀態追蹤)
-            # ----------------------------------------------------
-            elif server_state.mode == 2:
-                # 轉傳 Step 6 (收到 HC 對 H'05/H'05 通知封包的 ACK)
-                if server_state.relay_step == 1 and func_id == 0xF0 and sub_func_id == 0x00:
-                    print(f"[TCP] 收到 HC 對 H'05/H'05 通知封包的 ACK。準備發送報告 (Step 7)...")
-                    # HNA 主動發送 報告封包 (Step 7)
-                    report_packet = build_taiseia_packet(
-                        sender_id=RECEIVER_ID, receiver_id=header_info['sender_id'], group_id=0xFF,
-                        function_id=0x05, sub_function_id=0x04, data=SA_REPORT_DATA
-                    )
-                    writer.write(report_packet); await writer.drain()
-                    server_state.relay_step = 2 # 等待 HC 對報告的 ACK (Step 8)
-                    continue
-
-                # 轉傳 Step 8 (收到 HC 對 H'05/H'04 報告封包的 ACK)
-                elif server_state.relay_step == 2 and func_id == 0xF0 and sub_func_id == 0x00:
-                    print(f"[TCP] 收到 HC 對 H'05/H'04 報告封包的 ACK。SA 管理流程完成。")
-                    server_state.mode = 0 # 流程結束，回到正常模式
-                    server_state.relay_step = 0
-                    pass # 使用預設的 ACK (對 ACK 的 ACK)
-
-            # ----------------------------------------------------
-            # C. 正常模式 (被動回應)
-            # ----------------------------------------------------
-            elif server_state.mode == 0:
-                print(f"[TCP] 收到指令 F=H'{func_id:02X}', SF=H'{sub_func_id:02X}'")
-
-                if func_id == 0x00: # HNA 設定
-                    if sub_func_id == 0x06: # 讀取 RTC 設定值
-                        now = time.localtime()
-                        rtc_data = struct.pack('!BBBBBBB', now[0]%100, now[1], now[2], now[3], now[4], now[5], now[6]) 
-                        response_packet = build_taiseia_packet(
-                            sender_id=RECEIVER_ID, receiver_id=header_info['sender_id'], group_id=0xFF,
-                            function_id=0xF1, sub_function_id=0x00, data=rtc_data
-                        )
-                
-                elif func_id == 0x01: # ID 管理 (讀取 ID)
-                    if sub_func_id == 0x01: 
-                        response_packet = build_taiseia_packet(
-                            sender_id=RECEIVER_ID, receiver_id=header_info['sender_id'], group_id=0xFF,
-                            function_id=0xF1, sub_function_id=0x00, data=ALL_ID_DATA
-                        )
-
-                elif func_id == 0x03: # HNA 註冊
-                    if sub_func_id == 0x00: # 設定啟動註冊過程
-                        response_packet = create_ack_response(header_info['sender_id'], RECEIVER_ID, func_id, sub_func_id, 0x00)
-                    elif sub_func_id == 0x02: # 讀取 HNA 支援能力
-                        response_packet = build_taiseia_packet(
-                            sender_id=RECEIVER_ID, receiver_id=header_info['sender_id'], group_id=0xFF,
-                            function_id=0xF1, sub_function_id=0x00, data=HNA_SUPPORT_CAPABILITY
-                        )
-
-                elif func_id == 0x04: # SA 裝置監控 (單次/批次)
-                    if sub_func_id in [0x00, 0x02]: # 裝置監控請求/設定狀態
-                        response_packet = create_ack_response(header_info['sender_id'], RECEIVER_ID, func_id, sub_func_id, 0x00)
-                    elif sub_func_id == 0x01: # 讀取單次/批次狀態
-                        response_packet = build_taiseia_packet(
-                            sender_id=RECEIVER_ID, receiver_id=header_info['sender_id'], group_id=0xFF,
-                            function_id=0xF1, sub_function_id=0x00, data=SIMULATED_SA_STATUS_DATA
-                        )
-
-                elif func_id == 0x05: # SA 裝置管理 (轉傳流程起始)
-                    if sub_func_id == 0x01: # 設定 SA 裝置管理設定值 (HC 請求起始)
-                        # HNA 回覆 F0/00 ACK (轉傳 Step 2)，並啟動狀態機
-                        response_packet = create_ack_response(header_info['sender_id'], RECEIVER_ID, func_id, sub_func_id, 0x00)
-                        writer.write(response_packet); await writer.drain() # 先發送 ACK
-                        
-                        # HNA 主動發送通知 (轉傳 Step 5)
-                        notification_packet = build_taiseia_packet(
-                            sender_id=RECEIVER_ID, receiver_id=header_info['sender_id'], group_id=0xFF,
-                            function_id=0x05, sub_function_id=0x05, data=SA_NOTIFICATION_DATA
-                        )
-                        writer.write(notification_packet); await writer.drain()
-                        
-                        server_state.mode = 2 # 進入 SA 管理/轉傳模式
-                        server_state.relay_step = 1 # 等待 HC 對通知的 ACK (Step 6)
-                        continue # 避免發送預設 ACK
-                    
-                # 不支援的功能碼
-                elif func_id not in [0xF0, 0xF1]: 
-                    response_packet = create_ack_response(header_info['sender_id'], RECEIVER_ID, func_id, sub_func_id, 0x10) # F0/10
-
-            # 5. 發送回應封包 (正常模式下，如果有回覆時)
-            if response_packet and server_state.mode == 0:
-                writer.write(response_packet)
-                await writer.drain()
+        framer = TaiseiaFramer(on_crc_error=lambda: reply_crc_error(ctx))
+        async for data in read_frames(reader, framer):
+            pending = process_frame(ctx, data)
+            if pending is not None:
+                await pending
+            await writer.drain()
 
     except Exception as e:
-        print(f"[TCP] An error occurred with {addr}: {e}")
+        log.warning("[TCP] An error occurred with %s: %s", addr, e)
     finally:
-        print(f"[TCP] Closing connection with {addr}")
+        log.info("[TCP] Closing connection with %s", addr)
+        ctx.close()
         writer.close()
-        await writer.wait_closed()
+        try:
+            await writer.wait_closed()
+        except (ConnectionError, OSError):
+            pass
+
+
+class TaiseiaServerProtocol(asyncio.Protocol):
+    """以 asyncio.Protocol 實作的 TCP 引擎，協定行為與 handle_taiseia_client 相同。
+
+    data_received 直接把資料餵給分框器並同步分派，回應以 transport.write 送出，
+    不必每個封包 await drain()。寫入緩衝區過高時 (pause_writing) 暫停讀取此 HC
+    的請求，直到緩衝區消化 (resume_writing) 為止。
+    """
+
+    def __init__(self):
+        self.transport = None
+        self.ctx = None
+        self.framer = TaiseiaFramer()
+        self._task = None # 正在等待 async 處理函式時的工作
+        self._writing_paused = False
+        self._drain_waiters = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+        addr = transport.get_extra_info('peername')
+        log.info("[TCP] Connection established from %s", addr)
+        self.ctx = ConnectionContext(transport, addr, self._drain)
+        self.framer.on_crc_error = lambda: reply_crc_error(self.ctx)
+        if not ADMISSION.admit(self.ctx):
+            self.ctx.close()
+            transport.abort()
+            return
+        start_rebuild(self.ctx)
+
+    def data_received(self, data):
+        self.framer.feed(data)
+        if self._task is None:
+            self._process_frames()
+
+    def _process_frames(self):
+        for frame in self.framer.frames():
+            pending = process_frame(self.ctx, frame)
+            if pending is not None:
+                # async 處理函式：暫停讀取並保持封包順序，完成後再處理剩餘封包
+                self.transport.pause_reading()
+                self._task = asyncio.ensure_future(self._finish_pending(pending))
+                return
+
+    async def _finish_pending(self, pending):
+        try:
+            await pending
+        except Exception as e:
+            log.warning("[TCP] An error occurred with %s: %s", self.ctx.peer, e)
+            self.transport.close()
+            return
+        finally:
+            self._task = None
+        if self.transport.is_closing():
+            return
+        self._process_frames()
+        if self._task is None and not self._writing_paused:
+            self.transport.resume_reading()
+
+    def pause_writing(self):
+        # HC 讀取回應的速度跟不上：先停止接收它的新請求
+        self._writing_paused = True
+        self.transport.pause_reading()
+
+    async def _drain(self):
+        """等到寫入緩衝區低於低水位 (供 ConnectionContext.drain 使用)"""
+        if self.transport.is_closing():
+            raise ConnectionResetError("Connection lost")
+        if not self._writing_paused:
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._drain_waiters.append(waiter)
+        await waiter
+
+    def _wake_drain_waiters(self):
+        waiters, self._drain_waiters = self._drain_waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def resume_writing(self):
+        self._writing_paused = False
+        self._wake_drain_waiters()
+        if self._task is None:
+            self.transport.resume_reading()
+
+    def connection_lost(self, exc):
+        if exc is not None:
+            log.warning("[TCP] An error occurred with %s: %s", self.ctx.peer, exc)
+        log.info("[TCP] Closing connection with %s", self.ctx.peer)
+        self.ctx.close()
+        if self._task is not None:
+            self._task.cancel()
+        self._wake_drain_waiters()
 
 
 # ----------------------------------------------------
-# 2. UDP 服務處理 (服務發現)
+# 3. UDP 服務處理 (服務發現)
 # ----------------------------------------------------
 
+class TokenBucket:
+    """權杖桶：每秒補充 rate 個權杖，最多累積 burst 個"""
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, burst: float, now: float):
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, rate: float, burst: float, now: float) -> bool:
+        tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        if tokens < 1.0:
+            self.tokens = tokens
+            return False
+        self.tokens = tokens - 1.0
+        return True
+
+
 class DiscoveryProtocol(asyncio.DatagramProtocol):
-    # ... (此處代碼與 taiseia_common.py 中的 UDP 邏輯相同) ...
-    def __init__(self, loop):
+    """UDP 服務發現回應者。
+
+    回覆內容 (JSON 與二進位兩種) 預先編碼好，只在定期檢查發現本機 IP 改變時
+    重建，收到搜尋封包時不再建立 socket、組 dict 或編碼 JSON。每個來源 IP
+    以權杖桶限制回覆速率，超過的請求直接丟棄並計數。
+    """
+    def __init__(self, loop, tcp_port: int = TCP_SERVICE_PORT, udp_port: int = UDP_DISCOVERY_PORT,
+                 advertise_ip: str = None, rate: float = 5.0, burst: float = 10.0,
+                 refresh_interval: float = 30.0, max_sources: int = 4096):
         self.loop = loop
         self.transport = None
-        print(f"[UDP] Discovery listener started on port {UDP_DISCOVERY_PORT}")
+        self.tcp_port = tcp_port
+        self.rate = rate                   # 每個來源每秒可得到的回覆數
+        self.burst = burst                 # 每個來源可累積的回覆數
+        self.refresh_interval = refresh_interval
+        self.max_sources = max_sources     # 追蹤的來源數上限，避免偽造來源耗盡記憶體
+        self._fixed_ip = advertise_ip      # 指定時不再自動偵測 IP
+        self._buckets = {}
+        self._refresh_handle = None
+        self.server_ip = None
+        self.replies = {}
+        self.responded = 0
+        self.dropped = 0
+        self.refresh()
+        log.info("[UDP] Discovery listener started on port %s", udp_port)
+
+    def refresh(self) -> None:
+        """重新確認本機 IP，改變時重建預先編碼的回覆"""
+        ip = self._fixed_ip or get_server_ip()
+        if ip != self.server_ip:
+            self.server_ip = ip
+            self.replies = {
+                SEARCH_MAGIC_WORD: encode_discovery_reply(ip, self.tcp_port),
+                SEARCH_MAGIC_WORD_BINARY: encode_discovery_reply(ip, self.tcp_port, binary=True),
+            }
+            log.info("[UDP] Advertising TCP info: %s:%s", ip, self.tcp_port)
+
+    def _schedule_refresh(self) -> None:
+        self.refresh()
+        self._refresh_handle = self.loop.call_later(self.refresh_interval, self._schedule_refresh)
 
     def connection_made(self, transport):
         self.transport = transport
+        if self._fixed_ip is None and self.refresh_interval:
+            self._refresh_handle = self.loop.call_later(self.refresh_interval, self._schedule_refresh)
 
     def datagram_received(self, data, addr):
-        server_ip = get_server_ip()
-        if data.strip() == SEARCH_MAGIC_WORD:
-            discovery_response = {
-                "type": "discovery",
-                "ip": server_ip,
-                "port": TCP_SERVICE_PORT,
-                "protocol": "TaiSEIA 101"
-            }
-            response_data = json.dumps(discovery_response).encode()
-            self.transport.sendto(response_data, addr)
-            print(f"[UDP] Responded with TCP info: {server_ip}:{TCP_SERVICE_PORT}")
+        reply = self.replies.get(data)
+        if reply is None:
+            reply = self.replies.get(data.strip())
+            if reply is None:
+                return
+        now = self.loop.time()
+        bucket = self._buckets.get(addr[0])
+        if bucket is None:
+            if len(self._buckets) >= self.max_sources:
+                del self._buckets[next(iter(self._buckets))]
+            bucket = self._buckets[addr[0]] = TokenBucket(self.burst, now)
+        if not bucket.take(self.rate, self.burst, now):
+            self.dropped += 1
+            STATS.discovery_dropped += 1
+            return
+        self.transport.sendto(reply, addr)
+        self.responded += 1
+        STATS.discovery_replies += 1
 
     def error_received(self, exc):
-        print(f"[UDP] Error received: {exc}")
+        log.warning("[UDP] Error received: %s", exc)
 
     def connection_lost(self, exc):
-        print("[UDP] Socket closed")
+        if self._refresh_handle is not None:
+            self._refresh_handle.cancel()
+        log.info("[UDP] Socket closed")
 
 # ----------------------------------------------------
-# 3. 主程式入口點
+# 4. 主程式入口點
 # ----------------------------------------------------
 
-async def start_services():
-    server_ip = get_server_ip()
+async def close_connections(timeout: float = 2.0) -> None:
+    """中斷所有連線，並等待各連線的處理流程收尾"""
+    for ctx in list(CONNECTIONS):
+        ctx.abort()
+    deadline = time.monotonic() + timeout
+    while CONNECTIONS and time.monotonic() < deadline:
+        await asyncio.sleep(0.01)
+
+
+# TCP 引擎：'stream' 為 StreamReader/StreamWriter，'protocol' 為 asyncio.Protocol
+ENGINES = ('stream', 'protocol')
+
+
+async def create_tcp_server(host: str = None, port: int = TCP_SERVICE_PORT,
+                            engine: str = 'stream', reuse_port: bool = False,
+                            backlog: int = 1024) -> asyncio.AbstractServer:
+    """建立並開始接受連線的 TCP 服務 (未指定 host 時使用本機對外 IP)；port=0 由系統指定。
+
+    reuse_port=True 設定 SO_REUSEPORT，讓多個 worker 程序共用同一個 port；
+    backlog 為核心中等待 accept 的連線佇列長度 (大量 HC 同時重新連線時避免被拒)。
+    """
+    if host is None:
+        host = get_server_ip()
+    if engine == 'stream':
+        return await asyncio.start_server(
+            handle_taiseia_client, host=host, port=port, reuse_address=True, reuse_port=reuse_port,
+            backlog=backlog,
+        )
+    if engine == 'protocol':
+        loop = asyncio.get_running_loop()
+        return await loop.create_server(
+            TaiseiaServerProtocol, host=host, port=port, reuse_address=True, reuse_port=reuse_port,
+            backlog=backlog,
+        )
+    raise ValueError(f"unknown engine {engine!r}, expected one of {ENGINES}")
+
+
+def metrics_snapshot() -> dict:
+    """本程序的計數器、各功能碼量測值與通知推送統計"""
+    return dict(METRICS.snapshot(), stats=STATS.snapshot(), notifications=HUB.snapshot())
+
+
+def metrics_text() -> str:
+    """Prometheus 文字格式的量測值"""
+    return render_prometheus(METRICS, STATS.snapshot(), ServerStats.GAUGES)
+
+
+async def start_services(host: str = None, tcp_port: int = TCP_SERVICE_PORT, udp_port: int = UDP_DISCOVERY_PORT,
+                         engine: str = 'stream', reuse_port: bool = False, discovery: bool = True,
+                         metrics_port: int = None):
     loop = asyncio.get_running_loop()
 
-    tcp_server = await asyncio.start_server(
-        handle_taiseia_client, host=server_ip, port=TCP_SERVICE_PORT, reuse_address=True
-    )
-    print(f"*** TCP TaiSEIA 101 Server is serving on {tcp_server.sockets[0].getsockname()} ***")
+    tcp_server = await create_tcp_server(host, tcp_port, engine, reuse_port)
+    log.info("*** TCP TaiSEIA 101 Server is serving on %s ***", tcp_server.sockets[0].getsockname())
 
-    await loop.create_datagram_endpoint(
-        lambda: DiscoveryProtocol(loop), local_addr=('0.0.0.0', UDP_DISCOVERY_PORT)
-    )
+    # 多程序模式下只有一個 worker 負責 UDP 服務發現
+    if discovery:
+        # 綁定特定 IP 時直接公告該 IP，否則定期偵測本機 IP
+        advertise_ip = host if host not in (None, '0.0.0.0', '') else None
+        await loop.create_datagram_endpoint(
+            lambda: DiscoveryProtocol(loop, tcp_port, udp_port, advertise_ip), local_addr=('0.0.0.0', udp_port)
+        )
+
+    # 量測值只在本機提供 (127.0.0.1)
+    metrics_server = None
+    if metrics_port is not None:
+        metrics_server = await start_metrics_server(metrics_text, metrics_snapshot, port=metrics_port)
+    sweeper = asyncio.create_task(ADMISSION.run())
 
     try:
         await tcp_server.serve_forever()
     except asyncio.CancelledError:
-        print("\nServices are being shut down...")
+        log.info("Services are being shut down...")
     finally:
+        sweeper.cancel()
+        if metrics_server is not None:
+            metrics_server.close()
         tcp_server.close()
+        await close_connections()
         await tcp_server.wait_closed()
 
 if __name__ == '__main__':
-    print(f"Server ID (Receiver ID): {RECEIVER_ID.hex()}")
-    print(f"Client ID (Sender ID) for testing: {SENDER_ID.hex()}")
+    import argparse
+    from taiseia_log import LEVELS, setup_logging
+    parser = argparse.ArgumentParser(description="TaiSEIA 101 HNA server")
+    parser.add_argument('--engine', choices=ENGINES, default='stream', help="TCP 引擎 (預設 stream)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="worker 程序數；大於 1 時以 SO_REUSEPORT 分散連線到多個 CPU 核心")
+    parser.add_argument('--log-level', choices=LEVELS, default='INFO',
+                        help="紀錄等級 (DEBUG 會輸出每個封包)")
+    parser.add_argument('--trace', metavar='PATH', help="把一條連線收發的封包寫入 PATH (JSONL)")
+    parser.add_argument('--trace-peer', metavar='IP[:PORT]', help="只追蹤來自此位址的連線")
+    parser.add_argument('--trace-binary', action='store_true', help="以精簡二進位格式寫入追蹤檔")
+    parser.add_argument('--capture', metavar='PATH',
+                        help="把所有連線收發的封包附加寫入 PATH (taiseia_capture 的二進位格式)")
+    parser.add_argument('--max-connections', type=int, default=20000, help="每個程序的同時連線數上限")
+    parser.add_argument('--backlog-policy', choices=AdmissionControl.POLICIES, default='reject',
+                        help="超過上限時拒絕新連線 (reject) 或中斷最久未完成重建的連線 (evict)")
+    parser.add_argument('--idle-timeout', type=float, default=300.0, help="正常模式的閒置逾時秒數 (0 = 不限)")
+    parser.add_argument('--handshake-idle', type=float, default=10.0, help="網路重建中的閒置逾時秒數")
+    parser.add_argument('--handshake-deadline', type=float, default=30.0, help="完成網路重建的總期限秒數")
+    parser.add_argument('--write-buffer-limit', type=int, default=256 * 1024,
+                        help="單一連線寫入緩衝上限 (bytes)，超過時中斷該連線")
+    parser.add_argument('--resume-ttl', type=float, default=300.0,
+                        help="已驗證 HC 快速恢復連線的有效秒數 (0 = 停用，每次都走完整網路重建)")
+    parser.add_argument('--metrics-port', type=int,
+                        help="在 127.0.0.1 的此 port 提供 /metrics (多程序模式下 worker i 使用 port+i)")
+    args = parser.parse_args()
+    if args.trace and args.workers > 1:
+        parser.error("--trace 只支援單一程序模式")
+    if args.capture and args.workers > 1:
+        parser.error("--capture 只支援單一程序模式")
+
+    setup_logging(args.log_level)
+    limits = dict(max_connections=args.max_connections, policy=args.backlog_policy,
+                  idle_timeout=args.idle_timeout, handshake_idle=args.handshake_idle,
+                  handshake_deadline=args.handshake_deadline, write_buffer_limit=args.write_buffer_limit)
+    ADMISSION = AdmissionControl(**limits)
+    IDENTITIES = IdentityCache(args.resume_ttl)
+    log.info("Server ID (Receiver ID): %s", RECEIVER_ID.hex())
+    log.info("Client ID (Sender ID) for testing: %s", SENDER_ID.hex())
+    if args.trace:
+        TRACE.configure(args.trace, args.trace_peer, args.trace_binary)
+    if args.capture:
+        from taiseia_capture import CaptureWriter
+        CAPTURE = CaptureWriter(args.capture)
+        log.info("Capturing all frames to %s", args.capture)
+    if args.workers > 1:
+        from taiseia_workers import run_workers
+        run_workers(args.workers, engine=args.engine, metrics_port=args.metrics_port, limits=limits,
+                    resume_ttl=args.resume_ttl)
+        raise SystemExit(0)
     try:
-        asyncio.run(start_services())
+        asyncio.run(start_services(engine=args.engine, metrics_port=args.metrics_port))
     except KeyboardInterrupt:
-        print("Server process interrupted by user.")
\ No newline at end of file
+        log.info("Server process interrupted by user.")
+    finally:
+        if CAPTURE is not None:
+            CAPTURE.close()
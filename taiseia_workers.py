@@ -0,0 +1,195 @@
+# taiseia_workers.py
+# HNA 伺服器多程序模式
+#
+# 父程序 fork 出 N 個 worker，每個 worker 以 SO_REUSEPORT 在同一個 TCP port 上
+# 執行自己的 event loop，由核心把新連線分散到各 worker (每條連線的狀態都在
+# 自己的 TaiseiaSession 中，worker 之間沒有共用的可變狀態)。只有 worker 0 負責
+# UDP 服務發現。父程序負責重新啟動異常結束的 worker、在收到 SIGINT/SIGTERM 時
+# 關閉所有 worker，並透過共享記憶體彙總各 worker 的計數器。
+#
+#   python taiseia_server.py --workers 4
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import time
+
+from taiseia_common import *
+from taiseia_log import LOG, setup_logging
+import taiseia_server
+
+log = logging.getLogger('taiseia.workers')
+
+STATS_PUBLISH_INTERVAL = 0.5 # worker 寫入共享計數器的間隔 (秒)
+RESTART_BACKOFF = 1.0        # 同一個 worker 連續重啟的最短間隔 (秒)
+
+
+async def _publish_stats(slot) -> None:
+    fields = taiseia_server.ServerStats.FIELDS
+    while True:
+        stats = taiseia_server.STATS
+        for i, field in enumerate(fields):
+            slot[i] = getattr(stats, field)
+        await asyncio.sleep(STATS_PUBLISH_INTERVAL)
+
+
+async def _worker_serve(index: int, host: str, tcp_port: int, udp_port: int, engine: str, slot,
+                        metrics_port: int = None) -> None:
+    loop = asyncio.get_running_loop()
+    main_task = asyncio.current_task()
+    loop.add_signal_handler(signal.SIGTERM, main_task.cancel)
+    publisher = asyncio.create_task(_publish_stats(slot))
+    try:
+        await taiseia_server.start_services(
+            host, tcp_port, udp_port, engine, reuse_port=True, discovery=(index == 0),
+            metrics_port=None if metrics_port is None else metrics_port + index,
+        )
+    finally:
+        publisher.cancel()
+
+
+def _worker_main(index: int, host: str, tcp_port: int, udp_port: int, engine: str, slot,
+                 metrics_port: int = None, limits: dict = None, resume_ttl: float = None) -> None:
+    # Ctrl-C 會送到整個程序群組，由父程序統一關閉 worker
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # fork 時複製了父程序的計數器，worker 從 0 開始計數
+    taiseia_server.STATS = taiseia_server.ServerStats()
+    # 各 worker 的 SA 狀態表之後各自變更，HC 持有的版本不能沿用到其他 worker
+    taiseia_server.REGISTRY.new_epoch()
+    if limits:
+        taiseia_server.ADMISSION = taiseia_server.AdmissionControl(**limits)
+    if resume_ttl is not None:
+        taiseia_server.IDENTITIES = taiseia_server.IdentityCache(resume_ttl)
+    # 父程序的紀錄輸出執行緒不會被 fork 複製，沿用相同等級重新建立
+    # (子程序結束時不會執行 atexit，需自行停止以送出剩餘紀錄)
+    listener = setup_logging(LOG.getEffectiveLevel())
+    log.info("[Worker %d] pid=%d started", index, os.getpid())
+    try:
+        asyncio.run(_worker_serve(index, host, tcp_port, udp_port, engine, slot, metrics_port))
+    except asyncio.CancelledError:
+        pass
+    except Exception:
+        log.exception("[Worker %d] pid=%d crashed", index, os.getpid())
+        raise
+    finally:
+        log.info("[Worker %d] pid=%d stopped", index, os.getpid())
+        listener.stop()
+
+
+class WorkerSupervisor:
+    """管理 worker 程序：啟動、異常重啟、關閉與計數器彙總"""
+
+    def __init__(self, workers: int, host: str = None, tcp_port: int = TCP_SERVICE_PORT,
+                 udp_port: int = UDP_DISCOVERY_PORT, engine: str = 'stream', metrics_port: int = None,
+                 limits: dict = None, resume_ttl: float = None):
+        self.workers = workers
+        self.host = host or get_server_ip()
+        self.tcp_port = tcp_port
+        self.udp_port = udp_port
+        self.engine = engine
+        self.metrics_port = metrics_port # worker i 的量測端點為 metrics_port + i
+        self.limits = limits             # 各 worker 的 AdmissionControl 參數
+        self.resume_ttl = resume_ttl     # 各 worker 的 IdentityCache 有效秒數
+        self._mp = multiprocessing.get_context('fork')
+        n_fields = len(taiseia_server.ServerStats.FIELDS)
+        # 每個 worker 一段共享記憶體 (單一寫入者，不需要鎖)
+        self.slots = [self._mp.Array('q', n_fields, lock=False) for _ in range(workers)]
+        self.processes = [None] * workers
+        self.restarts = [0] * workers
+        # 已結束的 worker 留下的累計值 (重啟後共享記憶體會歸零)
+        self._retired = dict.fromkeys(taiseia_server.ServerStats.FIELDS, 0)
+        self._started_at = [0.0] * workers
+        self._stopping = False
+
+    def _spawn(self, index: int) -> None:
+        slot = self.slots[index]
+        for i, field in enumerate(taiseia_server.ServerStats.FIELDS):
+            if field not in taiseia_server.ServerStats.GAUGES:
+                self._retired[field] += slot[i]
+            slot[i] = 0
+        sys.stdout.flush() # 避免子程序繼承尚未輸出的緩衝內容
+        process = self._mp.Process(
+            target=_worker_main, name=f"taiseia-worker-{index}", daemon=True,
+            args=(index, self.host, self.tcp_port, self.udp_port, self.engine, slot,
+                  self.metrics_port, self.limits, self.resume_ttl),
+        )
+        process.start()
+        self.processes[index] = process
+        self._started_at[index] = time.monotonic()
+
+    def start(self) -> None:
+        for index in range(self.workers):
+            self._spawn(index)
+
+    def check(self) -> None:
+        """重新啟動已結束的 worker (連續崩潰時至少間隔 RESTART_BACKOFF 秒)"""
+        if self._stopping:
+            return
+        now = time.monotonic()
+        for index, process in enumerate(self.processes):
+            if process.is_alive():
+                continue
+            if now - self._started_at[index] < RESTART_BACKOFF:
+                continue
+            log.warning("[Supervisor] worker %d (pid=%d) exited with %s, restarting",
+                        index, process.pid, process.exitcode)
+            process.join()
+            self.restarts[index] += 1
+            self._spawn(index)
+
+    def stop(self, timeout: float = 5.0) -> None:
+        """以 SIGTERM 關閉所有 worker，逾時仍未結束者強制終止"""
+        self._stopping = True
+        for process in self.processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + timeout
+        for process in self.processes:
+            if process is None:
+                continue
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.kill()
+                process.join()
+
+    def worker_stats(self) -> list:
+        fields = taiseia_server.ServerStats.FIELDS
+        return [dict(zip(fields, slot), pid=process.pid, restarts=restarts)
+                for slot, process, restarts in zip(self.slots, self.processes, self.restarts)]
+
+    def aggregate_stats(self) -> dict:
+        """所有 worker 計數器的總和"""
+        total = dict(self._retired)
+        for slot in self.slots:
+            for field, value in zip(total, slot):
+                total[field] += value
+        total['workers_alive'] = sum(1 for p in self.processes if p is not None and p.is_alive())
+        total['restarts'] = sum(self.restarts)
+        return total
+
+
+def run_workers(workers: int, host: str = None, tcp_port: int = TCP_SERVICE_PORT,
+                udp_port: int = UDP_DISCOVERY_PORT, engine: str = 'stream',
+                stats_interval: float = 10.0, metrics_port: int = None, limits: dict = None,
+                resume_ttl: float = None) -> None:
+    """以多程序模式執行伺服器，直到收到 SIGINT/SIGTERM；limits 為各 worker 的 AdmissionControl 參數"""
+    supervisor = WorkerSupervisor(workers, host, tcp_port, udp_port, engine, metrics_port, limits, resume_ttl)
+    stop = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.append(signum))
+    log.info("[Supervisor] starting %d workers on %s:%d (%s)", workers, supervisor.host, tcp_port, engine)
+    supervisor.start()
+    next_report = time.monotonic() + stats_interval
+    try:
+        while not stop:
+            time.sleep(0.2)
+            supervisor.check()
+            if stats_interval and time.monotonic() >= next_report:
+                next_report += stats_interval
+                log.info("[Supervisor] stats: %s", supervisor.aggregate_stats())
+    except KeyboardInterrupt:
+        pass
+    log.info("[Supervisor] shutting down workers...")
+    supervisor.stop()
+    log.info("[Supervisor] final stats: %s", supervisor.aggregate_stats())
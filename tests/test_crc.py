@@ -0,0 +1,60 @@
+# CRC-16 引擎一致性：查表、binascii.crc_hqx 與逐位元參考實作
+import random
+from binascii import crc_hqx
+
+import pytest
+
+from taiseia_common import *
+
+LENGTHS = [0, 1, 2, 3, 7, 8, 24, 25, 26, 255, 256, 1023, 4096]
+INITS = [CRC16_INIT, 0x0000, 0x1D0F, 0x8000, 0x1234]
+
+
+def payload(length: int) -> bytes:
+    return random.Random(length).randbytes(length)
+
+
+def test_known_vector():
+    # CRC-16/CCITT-FALSE 的標準檢查值
+    assert crc16_ccitt_bitwise(b'123456789') == 0x29B1
+    assert crc16_ccitt_table(b'123456789') == 0x29B1
+    assert crc16_ccitt(b'123456789') == 0x29B1
+
+
+@pytest.mark.parametrize('init', INITS)
+@pytest.mark.parametrize('length', LENGTHS)
+def test_engines_agree(length, init):
+    data = payload(length)
+    expected = crc16_ccitt_bitwise(data, init)
+    assert crc16_ccitt_table(data, init) == expected
+    assert crc_hqx(data, init) == expected
+    assert crc16_ccitt(data, init) == expected
+
+
+@pytest.mark.parametrize('length', [1, 2, 25, 256])
+def test_memoryview_input(length):
+    buf = bytearray(b'\xAA' * 3 + payload(length) + b'\x55' * 3)
+    view = memoryview(buf)[3:-3]
+    expected = crc16_ccitt_bitwise(bytes(view))
+    assert crc16_ccitt_table(view) == expected
+    assert crc16_ccitt(view) == expected
+
+
+@pytest.mark.parametrize('split', [0, 1, 2, 13, 24, 99, 100])
+def test_incremental_update(split):
+    data = payload(100)
+    crc = Crc16().update(data[:split]).update(memoryview(data)[split:])
+    assert crc.value == crc16_ccitt_bitwise(data)
+    assert crc.digest() == crc16_ccitt_bitwise(data).to_bytes(2, 'big')
+    assert crc16_ccitt_table(data[split:], crc16_ccitt_table(data[:split])) == crc.value
+
+
+def test_check_frames():
+    frames = [build_taiseia_packet(SENDER_ID, RECEIVER_ID, 0xFF, 0x04, 0x02, payload(i), event_id=i + 1)
+              for i in range(6)]
+    corrupt = bytearray(frames[2])
+    corrupt[FIXED_HEADER_LENGTH - 1] ^= 0x01
+    bad_crc = frames[4][:-1] + bytes([frames[4][-1] ^ 0xFF])
+    batch = [frames[0], memoryview(frames[1]), bytes(corrupt), frames[3], bad_crc, frames[5], b'\x00', b'']
+    assert crc16_check_frames(batch) == [True, True, False, True, False, True, False, False]
+    assert all(crc16_ccitt_bitwise(f) == 0 for f in frames)
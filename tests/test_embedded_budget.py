@@ -0,0 +1,42 @@
+# 嵌入式設定：記憶體預算 (與 python taiseia_microbench.py --embedded 相同的量測) 與分框重新同步
+import pytest
+
+from taiseia_common import *
+from taiseia_microbench import check_embedded, measure_embedded
+
+
+def test_embedded_memory_budget():
+    result = measure_embedded(frames=5000)
+    assert check_embedded(result) == []
+
+
+def _drain(buf: FrameBuffer, events: list) -> int:
+    errors = 0
+    while True:
+        try:
+            if not buf.next_frame():
+                return errors
+        except CrcMismatchError:
+            errors += 1
+            continue
+        events.append(buf.event_id)
+        buf.consume()
+
+
+@pytest.mark.parametrize('chunk', [1, 7, 512])
+def test_frame_buffer_resyncs_after_garbage(chunk):
+    frames = [build_taiseia_packet(SENDER_ID, RECEIVER_ID, 0xFF, 0x03, 0x02, event_id=i) for i in range(1, 11)]
+    bad = bytearray(frames[5])
+    bad[-1] ^= 0xFF
+    # 0x13 0x00 0x67 是長度 103 的假同步；損壞的封包也不能吞掉之後的封包
+    stream = b'\x00\x13\x00garbage' + b''.join(frames[:5]) + bytes(bad) + b''.join(frames[5:])
+    buf = FrameBuffer()
+    events, errors = [], 0
+    for offset in range(0, len(stream), chunk):
+        piece = stream[offset:offset + chunk]
+        buf.rx_space()[:len(piece)] = piece
+        buf.received(len(piece))
+        errors += _drain(buf, events)
+    assert events == list(range(1, 11))
+    assert errors >= 1
+    assert buf.rx_used == 0
@@ -0,0 +1,142 @@
+# 流程引擎：HC 不回覆時的逾時重送、Karn 演算法、放棄重送與快速恢復
+import asyncio
+import functools
+import time
+
+import pytest
+
+import taiseia_server as server
+from taiseia_common import *
+
+INITIAL_RTO = 0.05
+HC_ID = b'\xAA\xAA\xAA\xAA\xF1\x09'
+
+
+@pytest.fixture
+def fast_rto(monkeypatch):
+    """縮短初始 RTO，讓重送在測試時間內發生"""
+    monkeypatch.setattr(server, 'RttEstimator', functools.partial(RttEstimator, initial_rto=INITIAL_RTO, min_rto=0.01))
+
+
+def run(coro):
+    return asyncio.run(asyncio.wait_for(coro, 10))
+
+
+async def connect():
+    tcp = await server.create_tcp_server('127.0.0.1', 0)
+    reader, writer = await asyncio.open_connection('127.0.0.1', tcp.sockets[0].getsockname()[1])
+    return tcp, reader, writer, read_frames(reader)
+
+
+async def close(tcp, writer):
+    writer.close()
+    tcp.close()
+    await tcp.wait_closed()
+
+
+def reply(frame: Frame, function_id: int = 0xF0, data: bytes = b'') -> bytes:
+    return build_taiseia_packet(HC_ID, RECEIVER_ID, 0xFF, function_id, 0x00, data, event_id=frame.event_id)
+
+
+def server_context():
+    (ctx,) = [ctx for ctx in server.CONNECTIONS if not ctx.closed]
+    return ctx
+
+
+def test_gives_up_after_max_retries(fast_rto):
+    async def scenario():
+        stats = server.STATS.snapshot()
+        tcp, reader, writer, frames = await connect()
+        arrivals = [] # (收到時間, 事件序號)
+        async for packet in frames: # 不回覆上線通知，直到 HNA 中斷連線
+            frame = Frame.decode(packet)
+            assert (frame.function_id, frame.sub_function_id) == (0x01, 0x00)
+            arrivals.append((time.perf_counter(), frame.event_id))
+        closed_at = time.perf_counter()
+        await close(tcp, writer)
+        return stats, arrivals, closed_at
+
+    stats, arrivals, closed_at = run(scenario())
+    max_retries = server.REBUILD_FLOW.max_retries
+    assert len(arrivals) == 1 + max_retries
+    assert len({event_id for _, event_id in arrivals}) == 1 # 重送沿用相同事件序號
+    # 每次重送 RTO 加倍：0.05, 0.1, 0.2, 0.4 秒，最後一次再等 0.8 秒後放棄
+    times = [t for t, _ in arrivals] + [closed_at]
+    for attempt, (sent, next_event) in enumerate(zip(times, times[1:])):
+        expected = INITIAL_RTO * 2 ** attempt
+        assert expected * 0.8 <= next_event - sent <= expected + 0.25
+    after = server.STATS.snapshot()
+    assert after['retransmits'] - stats['retransmits'] == max_retries
+    assert after['flow_failures'] - stats['flow_failures'] == 1
+
+
+def test_retransmitted_step_is_not_sampled(fast_rto):
+    async def scenario():
+        stats = server.STATS.snapshot()
+        tcp, reader, writer, frames = await connect()
+        first = Frame.decode(await frames.__anext__())
+        again = Frame.decode(await frames.__anext__()) # 不回覆，等到重送
+        assert again.event_id == first.event_id
+        ctx = server_context()
+        assert ctx.rtt.rto == pytest.approx(INITIAL_RTO * 2)
+        writer.write(reply(first) + reply(again)) # 對兩次送出都回覆
+
+        read_id = Frame.decode(await frames.__anext__())
+        assert (read_id.function_id, read_id.sub_function_id) == (0x01, 0x01)
+        assert ctx.rtt.srtt is None # 重送過的步驟不取樣 (Karn)
+        writer.write(reply(read_id, 0xF1, ALL_ID_DATA))
+
+        report = Frame.decode(await frames.__anext__())
+        assert (report.function_id, report.sub_function_id) == (0x05, 0x04)
+        assert ctx.rtt.srtt is not None and ctx.rtt.srtt < INITIAL_RTO
+        writer.write(reply(report))
+        await asyncio.sleep(0.05)
+        assert ctx.flow is None and ctx.session.mode == 0
+        await close(tcp, writer)
+        return stats
+
+    stats = run(scenario())
+    after = server.STATS.snapshot()
+    assert after['retransmits'] - stats['retransmits'] == 1
+    assert after['duplicate_acks'] - stats['duplicate_acks'] == 1
+    assert after['flow_failures'] == stats['flow_failures']
+
+
+def test_resume_dispatches_requests_before_report_ack(fast_rto, monkeypatch):
+    monkeypatch.setattr(server, 'IDENTITIES', server.IdentityCache())
+
+    async def rebuild():
+        tcp, reader, writer, frames = await connect()
+        for expected, function_id, data in ((0x01, 0xF0, b''), (0x01, 0xF1, ALL_ID_DATA), (0x05, 0xF0, b'')):
+            frame = Frame.decode(await frames.__anext__())
+            assert frame.function_id == expected
+            writer.write(reply(frame, function_id, data))
+        await asyncio.sleep(0.05)
+        await close(tcp, writer)
+
+    async def resume():
+        stats = server.STATS.snapshot()
+        tcp, reader, writer, frames = await connect()
+        online = Frame.decode(await frames.__anext__())
+        # 快速恢復的 ACK 之後立即送出請求，不等 HNA 的報告
+        request = build_taiseia_packet(HC_ID, RECEIVER_ID, 0xFF, 0x03, 0x02, event_id=0x4242)
+        writer.write(reply(online, data=ALL_ID_DATA) + request)
+        received = {}
+        while len(received) < 2:
+            frame = Frame.decode(await frames.__anext__())
+            received[frame.function_id, frame.sub_function_id] = frame
+        report = received[0x05, 0x04]
+        answer = received[0xF1, 0x00]
+        assert answer.event_id == 0x4242 and answer.data.tobytes() == HNA_SUPPORT_CAPABILITY
+        ctx = server_context()
+        assert ctx.session.mode == 0 and ctx in server.CONNECTIONS and ctx not in server.ADMISSION.handshaking
+        writer.write(reply(report))
+        await asyncio.sleep(0.05)
+        assert ctx.flow is None
+        await close(tcp, writer)
+        return stats
+
+    run(rebuild())
+    stats = run(resume())
+    after = server.STATS.snapshot()
+    assert after['sessions_resumed'] - stats['sessions_resumed'] == 1
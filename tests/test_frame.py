@@ -0,0 +1,97 @@
+# Frame.decode 的錯誤分類、parse_taiseia_response 的舊介面與 FrameTemplate
+import pytest
+
+from taiseia_common import *
+
+
+def make_packet(data: bytes = b'\x01\x02\x03') -> bytes:
+    return build_taiseia_packet(SENDER_ID, RECEIVER_ID, 0xFF, 0x04, 0x02, data, event_id=7)
+
+
+def with_crc(body) -> bytes:
+    """重新計算 CRC (body 不含 CRC)"""
+    return bytes(body) + Crc16().update(body).digest()
+
+
+def test_decode_fields():
+    frame = Frame.decode(make_packet())
+    assert (frame.header_id, frame.packet_length, frame.event_id) == (HEADER_ID, MIN_PACKET_LENGTH + 3, 7)
+    assert (frame.function_id, frame.sub_function_id) == (0x04, 0x02)
+    assert (frame.sender_id, frame.receiver_id) == (SENDER_ID, RECEIVER_ID)
+    assert frame.data.tobytes() == b'\x01\x02\x03'
+
+
+@pytest.mark.parametrize('size', [0, 1, FIXED_HEADER_LENGTH, MIN_PACKET_LENGTH - 1])
+def test_too_short(size):
+    with pytest.raises(FrameTooShortError):
+        Frame.decode(make_packet()[:size])
+
+
+def test_bad_header_id():
+    body = bytearray(make_packet()[:-CRC_LENGTH])
+    body[0] = 0x14
+    with pytest.raises(FrameHeaderError):
+        Frame.decode(with_crc(body)) # CRC 正確仍須拒絕
+
+
+@pytest.mark.parametrize('delta', [-1, 1, 100])
+def test_length_mismatch(delta):
+    body = bytearray(make_packet()[:-CRC_LENGTH])
+    struct.pack_into('!H', body, 1, len(body) + CRC_LENGTH + delta)
+    with pytest.raises(FrameLengthError):
+        Frame.decode(with_crc(body))
+
+
+def test_truncated_packet_is_length_error():
+    with pytest.raises(FrameLengthError):
+        Frame.decode(make_packet()[:-1])
+
+
+@pytest.mark.parametrize('offset', [3, EVENT_ID_OFFSET, FIXED_HEADER_LENGTH, -1])
+def test_crc_mismatch(offset):
+    packet = bytearray(make_packet())
+    packet[offset] ^= 0x40
+    with pytest.raises(CrcMismatchError):
+        Frame.decode(packet)
+    assert Frame.decode(packet, check_crc=False).packet_length == len(packet)
+
+
+def test_errors_are_value_errors():
+    for error in (FrameTooShortError, FrameHeaderError, FrameLengthError, CrcMismatchError):
+        assert issubclass(error, FrameError)
+        assert issubclass(error, ValueError)
+
+
+def test_parse_response_shape():
+    packet = make_packet()
+    result = parse_taiseia_response(packet)
+    assert result == {
+        "header_id": HEADER_ID,
+        "packet_length": len(packet),
+        "sender_id": SENDER_ID,
+        "receiver_id": RECEIVER_ID,
+        "event_id": 7,
+        "function_id": 0x04,
+        "sub_function_id": 0x02,
+        "data": b'\x01\x02\x03',
+    }
+    assert all(type(result[key]) is bytes for key in ("sender_id", "receiver_id", "data"))
+
+
+def test_parse_response_errors():
+    assert parse_taiseia_response(make_packet()[:10]) == {"error": "Packet too short", "length": 10}
+    packet = bytearray(make_packet())
+    packet[-1] ^= 0x01
+    assert parse_taiseia_response(bytes(packet)) == {"error": "CRC Mismatch"}
+
+
+def test_template_render_and_fill():
+    template = FrameTemplate(RECEIVER_ID, SENDER_ID, 0xFF, 0x05, 0x05, b'\x00\x01\x01\x00\x02')
+    for event_id in (1, 0x1234, 0xFFFF):
+        assert template.render(event_id) == build_taiseia_packet(
+            RECEIVER_ID, SENDER_ID, 0xFF, 0x05, 0x05, b'\x00\x01\x01\x00\x02', event_id=event_id)
+    template.fill(b'\x00\x02\x03\xAB\xCD')
+    assert template.render(9) == build_taiseia_packet(
+        RECEIVER_ID, SENDER_ID, 0xFF, 0x05, 0x05, b'\x00\x02\x03\xAB\xCD', event_id=9)
+    with pytest.raises(ValueError):
+        template.fill(b'\x00')
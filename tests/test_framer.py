@@ -0,0 +1,70 @@
+# TaiseiaFramer 分框：合併、分段與雜訊後的重新同步
+import pytest
+
+from taiseia_common import *
+
+
+def make_frames(count: int) -> list:
+    return [build_taiseia_packet(SENDER_ID, RECEIVER_ID, 0xFF, 0x04, 0x01,
+                                 encode_sa_query([(1, i)] * (i % 4)), event_id=i + 1)
+            for i in range(count)]
+
+
+def collect(framer: TaiseiaFramer, chunks) -> list:
+    out = []
+    for chunk in chunks:
+        framer.feed(chunk)
+        out.extend(bytes(frame) for frame in framer.frames())
+    return out
+
+
+def test_coalesced_input():
+    frames = make_frames(10)
+    framer = TaiseiaFramer()
+    assert collect(framer, [b''.join(frames)]) == frames
+    assert framer.pending() == 0
+    assert framer.dropped_bytes == 0
+
+
+@pytest.mark.parametrize('size', [1, 2, 7, 25, 26, 27, 100])
+def test_split_input(size):
+    frames = make_frames(10)
+    stream = b''.join(frames)
+    chunks = [stream[i:i + size] for i in range(0, len(stream), size)]
+    assert collect(TaiseiaFramer(), chunks) == frames
+
+
+def test_leading_garbage_with_false_sync():
+    # 0x13 0x00 0x67 看起來像長度 103 的封包，必須以 CRC 排除而不吞掉之後的封包
+    frames = make_frames(10)
+    errors = []
+    framer = TaiseiaFramer(on_crc_error=lambda: errors.append(1))
+    assert collect(framer, [b'\x00\x13\x00garbage' + b''.join(frames)]) == frames
+    assert framer.crc_errors == len(errors) >= 1
+    assert framer.dropped_bytes == len(b'\x00\x13\x00garbage')
+
+
+def test_corrupted_frame_does_not_swallow_neighbours():
+    frames = make_frames(5)
+    bad = bytearray(frames[2])
+    bad[-1] ^= 0xFF
+    stream = frames[0] + frames[1] + bytes(bad) + frames[3] + frames[4]
+    framer = TaiseiaFramer()
+    assert collect(framer, [stream[:40], stream[40:]]) == [frames[0], frames[1], frames[3], frames[4]]
+    assert framer.crc_errors >= 1
+
+
+def test_false_sync_longer_than_buffered_data():
+    # 假同步的長度超過目前收到的資料：之後已有完整的封包時不必等待
+    frames = make_frames(1)
+    framer = TaiseiaFramer()
+    assert collect(framer, [b'\x00\x13\x00garbage' + frames[0]]) == frames
+    assert framer.pending() == 0
+
+
+def test_incomplete_frame_waits_for_more_data():
+    frame = make_frames(4)[3]
+    framer = TaiseiaFramer()
+    assert collect(framer, [frame[:-1]]) == []
+    assert framer.crc_errors == 0
+    assert collect(framer, [frame[-1:]]) == [frame]